@@ -1,19 +1,32 @@
+from time import perf_counter
+PROCESS_START = perf_counter()  # taken before the remaining imports, so that they count towards the startup time
+
 import pathlib
 import sys
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, time
-import numpy as np
-import pause
+from types import SimpleNamespace
+import yaml
 import logging
-import cv2
 from logging.handlers import RotatingFileHandler
 
-from modules.data_collection import DataCollector
-from modules.object_detection import DetectorBase
+from modules.data_collection import DataCollector, MockDataCollector
 from modules.upload_automation import Uploader
 from modules.behavior_recognition import BehaviorRecognizer
-from modules.config_manager import ConfigManager
-from modules.email_notification import Notifier, Notification
+from modules.config_manager import ConfigManager, classify_parameter, REBUILD_PARAMETERS
+from modules.email_notification import Notifier, Notification, HttpTransport
+from modules.pipeline import Pipeline, FramePacket
+from modules.frame_analysis import FrameAnalyzer, init_detectors
+from modules.metrics import init_metrics
+from modules.scheduler import FrameScheduler
+from modules.detection_log import DetectionLog
+from modules.inference_scheduler import InferenceScheduler
+from modules.clock import SYSTEM_CLOCK
+from modules.checkpoint import RuntimeCheckpoint
+from modules.storage_governor import StorageGovernor
+from modules.resource_governor import ResourceGovernor
 
 # establish filesystem locations
 FILE = pathlib.Path(__file__).resolve()
@@ -22,24 +35,32 @@ MODEL_DIR = REPO_ROOT_DIR / 'models'
 DEFAULT_DATA_DIR = REPO_ROOT_DIR / 'projects'
 LOG_DIR = REPO_ROOT_DIR / 'logs'
 TESTING_RESOURCE_DIR = REPO_ROOT_DIR / 'resources'
+CHECKPOINT_NAME = 'checkpoint.npz'  # runtime state saved in each project dir, never uploaded
+RESOURCE_LOG_NAME = 'resource_log.csv'  # changes to the analysis load made by the resource governor
+STORAGE_EVENTS_NAME = 'storage_events.json'  # times of the events whose videos are never evicted, never uploaded
+NOTIFICATION_QUEUE_NAME = 'NotificationQueue'  # notifications waiting to be sent, holding recipient addresses
 if str(REPO_ROOT_DIR) not in sys.path:
     sys.path.append(str(REPO_ROOT_DIR))
-if not LOG_DIR.exists():
-    LOG_DIR.mkdir()
 
-# initiate logger
+# handlers are attached by the command line entry point only (see setup_logging), so importing this module logs nowhere
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter(fmt='%(asctime)s %(name)-16s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-log_path = str(LOG_DIR / 'debug.log')
-fh = RotatingFileHandler(log_path, maxBytes=500000, backupCount=2)
-fh.setLevel(logging.DEBUG)
-fh.setFormatter(formatter)
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-ch.setFormatter(formatter)
-logger.addHandler(fh)
-logger.addHandler(ch)
+
+
+def setup_logging(log_dir=LOG_DIR):
+    """log everything to a rotating debug.log in log_dir, and info and above to the console"""
+    log_dir = pathlib.Path(log_dir)
+    log_dir.mkdir(exist_ok=True, parents=True)
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(fmt='%(asctime)s %(name)-16s %(levelname)-8s %(message)s',
+                                  datefmt='%Y-%m-%d %H:%M:%S')
+    fh = RotatingFileHandler(str(log_dir / 'debug.log'), maxBytes=500000, backupCount=2)
+    fh.setLevel(logging.DEBUG)
+    fh.setFormatter(formatter)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    ch.setFormatter(formatter)
+    logger.addHandler(fh)
+    logger.addHandler(ch)
 
 
 def new_project(config_path):
@@ -54,12 +75,117 @@ def new_project(config_path):
 
 class Runner:
 
-    def __init__(self, config_path: pathlib.Path):
+    def __init__(self, config_path: pathlib.Path, detectors=None, collector=None, inference=None, clock=SYSTEM_CLOCK):
+        """
+        :param detectors: optional (roi_detector, ooi_detector) shared with other runners. Built from the config if None
+        :param collector: optional stand-in for the DataCollector, e.g. a MockDataCollector
+        :param inference: optional InferenceScheduler shared with other runners, whose workers analyze the frames
+        :param clock: source of the current time and of sleeps (see modules.clock), e.g. a VirtualClock
+        """
         logger.debug('beginning runner initialization')
+        init_start = perf_counter()
+        self.startup_timings = {'before_init': init_start - PROCESS_START}
+        self.startup_pending = True
         self.project_dir = config_path.parent
         self.video_dir = self.project_dir / 'Videos'
-        self.config = ConfigManager(config_path).config_as_namespace()
+        self.config_manager = ConfigManager(config_path)
+        self.config = self.config_manager.config_as_namespace()
+        self.clock = clock
+        self.config_manager.watch(self.config.config_poll_interval, time_func=self.clock.time)
+
+        self.set_schedule_parameters()
+        self.picamera_kwargs = {'framerate': self.config.framerate,
+                                'resolution': (self.config.h_resolution, self.config.v_resolution),
+                                'camera_num': self.config.camera_num}
+        logger.debug(f'camera framerate set to: {self.picamera_kwargs["framerate"]}')
+        logger.debug(f'camera resolution set to: {self.picamera_kwargs["resolution"]}')
+
+        self.metrics = init_metrics(self.config, self.project_dir)
+        self.roi_detector, self.ooi_detector, self.frame_analyzer = None, None, None
+        if detectors is None:
+            # the models load in the background while the camera and everything else initialize, and are only waited
+            # for once the first frame needs analyzing (see wait_for_detectors)
+            detector_loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='detector_loader')
+            self.detectors_future = detector_loader.submit(self.load_detectors)
+            detector_loader.shutdown(wait=False)
+        else:
+            self.detectors_future = None
+            self.set_detectors(detectors)
+        self.inference = inference
+        self.stop_event = threading.Event()
+        self.behavior_recognizer = BehaviorRecognizer(self.config, self.metrics)
+        self.notifier = Notifier(user_email=self.config.user_email,
+                                 from_email=self.config.sendgrid_from_email,
+                                 api_key=self.config.sendgrid_api_key,
+                                 admin_email=self.config.admin_email,
+                                 min_notification_interval=self.config.min_notification_interval,
+                                 max_notifications_per_day=self.config.max_notifications_per_day,
+                                 metrics=self.metrics,
+                                 transport=self.init_notification_transport(),
+                                 queue_dir=self.project_dir / NOTIFICATION_QUEUE_NAME,
+                                 max_attempts=self.config.notification_max_attempts,
+                                 time_func=self.clock.time)
+        self.uploader = Uploader(self.project_dir, self.config.cloud_data_dir, self.config.framerate, self.metrics,
+                                 conversion_workers=self.config.conversion_workers,
+                                 conversion_niceness=self.config.conversion_niceness,
+                                 conversion_max_attempts=self.config.conversion_max_attempts,
+                                 rclone=self.config.rclone_binary,
+                                 upload_workers=self.config.upload_workers,
+                                 upload_bwlimit_kbps=self.config.upload_bwlimit_kbps,
+                                 upload_max_attempts=self.config.upload_max_attempts,
+                                 upload_trickle_kbps=self.config.upload_trickle_kbps,
+                                 upload_exclude=(CHECKPOINT_NAME, STORAGE_EVENTS_NAME, NOTIFICATION_QUEUE_NAME),
+                                 time_func=self.clock.time,
+                                 sleep_func=self.clock.sleep)
+        if self.config.analysis_h_resolution and self.config.analysis_v_resolution:
+            self.analysis_resolution = (self.config.analysis_h_resolution, self.config.analysis_v_resolution)
+        else:
+            self.analysis_resolution = None
+        logger.debug(f'analysis resolution set to: {self.analysis_resolution or "camera resolution"}')
+        # enough buffers for one frame in each pipeline queue and stage, plus the frame being captured
+        if self.inference is not None:
+            frame_pool_size = self.config.pipeline_queue_size + 3
+        else:
+            frame_pool_size = 2 * self.config.pipeline_queue_size + 3 if self.config.pipeline_enabled else 2
+        if collector is None:
+            t0 = perf_counter()
+            collector = DataCollector(self.video_dir, self.picamera_kwargs, self.analysis_resolution, frame_pool_size,
+                                      self.metrics, time_func=self.clock.time)
+            self.startup_timings['camera'] = perf_counter() - t0
+        self.collector = collector
+        if self.config.detection_log_enabled:
+            self.detection_log = DetectionLog(self.project_dir / 'DetectionLog',
+                                              chunk_rows=self.config.detection_log_chunk_rows)
+        else:
+            self.detection_log = None
+        self.scheduler = self.build_scheduler(self.config)
+        # held while a frame's results are recorded and while config edits are applied, so that a frame never sees a
+        # half-applied edit
+        self.analysis_lock = threading.Lock()
+        # held while a frame is analyzed and while the frame analyzer's settings change. Taken before analysis_lock
+        self.inference_lock = threading.Lock()
+        self.checkpoint = RuntimeCheckpoint(self.project_dir / CHECKPOINT_NAME,
+                                            interval=self.config.checkpoint_interval,
+                                            max_age=self.config.checkpoint_max_age,
+                                            time_func=self.clock.time)
+        self.storage_governor = StorageGovernor(self.video_dir, self.project_dir / STORAGE_EVENTS_NAME,
+                                                reserve_mb=self.config.storage_reserve_mb,
+                                                upload_hours=self.config.storage_upload_hours,
+                                                degrade_hours=self.config.storage_degrade_hours,
+                                                evict_hours=self.config.storage_evict_hours,
+                                                check_interval=self.config.storage_check_interval,
+                                                is_uploaded=self.uploader.is_uploaded,
+                                                is_busy=lambda path: self.uploader.converter.in_progress(path.name),
+                                                time_func=self.clock.time,
+                                                metrics=self.metrics)
+        # storage level at which the uploader was last told to upload videos early
+        self.expedited_level = 'ok'
+        self.resource_governor = ResourceGovernor(self.config, log_path=self.project_dir / RESOURCE_LOG_NAME,
+                                                  time_func=self.clock.time, metrics=self.metrics)
+        self.startup_timings['runner_init'] = perf_counter() - init_start
+        logger.info('runner successfully initialized')
 
+    def set_schedule_parameters(self):
         self.start_time = time(hour=self.config.start_hour)
         self.end_time = time(hour=self.config.end_hour)
         logger.debug(f'data collection will run from {self.start_time} to {self.end_time} each day')
@@ -71,135 +197,519 @@ class Runner:
         logger.debug(f'Behavior check interval set to {self.behavior_check_interval}')
         self.video_split_interval = timedelta(hours=self.config.video_split_hours)
         logger.debug(f'Video split interval set to {self.video_split_interval}')
-        self.picamera_kwargs = {'framerate': self.config.framerate,
-                                'resolution': (self.config.h_resolution, self.config.v_resolution)}
-        logger.debug(f'camera framerate set to: {self.picamera_kwargs["framerate"]}')
-        logger.debug(f'camera resolution set to: {self.picamera_kwargs["resolution"]}')
 
-        self.roi_detector = DetectorBase(MODEL_DIR / self.config.roi_model, self.config.roi_confidence_thresh)
-        self.ooi_detector = DetectorBase(MODEL_DIR / self.config.ooi_model, self.config.ooi_confidence_thresh)
-        self.behavior_recognizer = BehaviorRecognizer(self.config)
-        self.notifier = Notifier(user_email=self.config.user_email,
-                                 from_email=self.config.sendgrid_from_email,
-                                 api_key=self.config.sendgrid_api_key,
-                                 admin_email=self.config.admin_email,
-                                 min_notification_interval=self.config.min_notification_interval,
-                                 max_notifications_per_day=self.config.max_notifications_per_day)
-        self.uploader = Uploader(self.project_dir, self.config.cloud_data_dir, self.config.framerate)
-        self.collector = DataCollector(self.video_dir, self.picamera_kwargs)
-        logger.info('runner successfully initialized')
+    def build_scheduler(self, config):
+        return FrameScheduler(config.framegrab_interval,
+                              policy=config.framegrab_policy,
+                              adaptive=config.framegrab_adaptive,
+                              max_interval=config.framegrab_max_interval,
+                              adapt_window=config.framegrab_adapt_window,
+                              time_func=self.clock.time,
+                              sleep_func=self.clock.sleep,
+                              metrics=self.metrics)
+
+    def check_config_changes(self):
+        changes = self.config_manager.poll_changes()
+        if changes:
+            self.apply_config_changes(changes)
+
+    def apply_config_changes(self, changes):
+        """
+        apply config edits between two frames, updating or rebuilding the affected components (see classify_parameter)
+        :param changes: dict mapping changed parameters to their new values
+        """
+        restart = [key for key in changes if classify_parameter(key) == 'restart']
+        if self.inference is not None:
+            # detectors shared with other projects keep the thresholds all of the projects were started with
+            restart += [key for key in ('roi_confidence_thresh', 'ooi_confidence_thresh') if key in changes]
+        if restart:
+            logger.warning(f'changes to {sorted(restart)} will take effect after a restart')
+        changes = {key: value for key, value in changes.items() if key not in restart}
+        if not changes:
+            return
+        config = SimpleNamespace(**dict(vars(self.config), **changes))
+        rebuild = {name for key in changes for name in REBUILD_PARAMETERS.get(key, ())}
+        try:
+            time(hour=config.start_hour), time(hour=config.end_hour)
+            motion_gate = FrameAnalyzer.build_motion_gate(config) if 'motion_gate' in rebuild else None
+            scheduler = self.build_scheduler(config) if 'scheduler' in rebuild else None
+            behavior_recognizer = BehaviorRecognizer(config, self.metrics) if 'behavior_recognizer' in rebuild else None
+        except (ValueError, TypeError, ArithmeticError) as e:
+            logger.warning(f'config edit rejected: {e}')
+            return
+        with self.inference_lock, self.analysis_lock:
+            for key, value in changes.items():
+                setattr(self.config, key, value)
+            if behavior_recognizer is not None:
+                behavior_recognizer.config = self.config
+                behavior_recognizer.refill_from(self.behavior_recognizer)
+                self.metrics.remove_collector(self.behavior_recognizer.collect_metrics)
+                self.behavior_recognizer = behavior_recognizer
+            if 'motion_gate' in rebuild and self.frame_analyzer is not None:
+                self.frame_analyzer.set_motion_gate(motion_gate)
+            self.apply_hot_config()
+        if scheduler is not None:
+            logger.info(f'framegrab schedule stats: {self.scheduler.stats()}')
+            scheduler.set_min_step(self.resource_governor.settings['framegrab_factor'])
+            scheduler.start()
+            self.scheduler = scheduler
+        self.config_manager.accept_changes(changes)
+        self.metrics.increment('config_reloads')
+        logger.info(f'config changes applied: {changes}')
+
+    def apply_hot_config(self):
+        """push the current values of the hot parameters to the components that use them"""
+        self.set_schedule_parameters()
+        self.notifier.min_notification_interval = self.config.min_notification_interval
+        self.notifier.max_notifications_per_day = self.config.max_notifications_per_day
+        self.behavior_recognizer.set_occupancy_range(self.config.behavior_min_individuals_roi,
+                                                     self.config.behavior_max_individuals_roi)
+        self.behavior_recognizer.min_fraction_for_notification = self.config.behavior_min_fraction_for_notification
+        self.behavior_recognizer.set_jpeg_quality(self.config.thumbnail_jpeg_quality)
+        self.checkpoint.interval = self.config.checkpoint_interval
+        self.checkpoint.max_age = self.config.checkpoint_max_age
+        self.config_manager.poll_interval = self.config.config_poll_interval
+        self.storage_governor.configure(self.config.storage_reserve_mb, self.config.storage_upload_hours,
+                                        self.config.storage_degrade_hours, self.config.storage_evict_hours,
+                                        self.config.storage_check_interval)
+        self.resource_governor.configure(self.config)
+        if self.frame_analyzer is not None:
+            self.apply_resource_settings()
+            self.frame_analyzer.configure_roi_tracker(self.config)
+            if self.inference is None:
+                self.roi_detector.set_confidence_thresh(self.config.roi_confidence_thresh)
+                self.ooi_detector.set_confidence_thresh(self.config.ooi_confidence_thresh)
+
+    def load_detectors(self):
+        t0 = perf_counter()
+        detectors = init_detectors(self.config, MODEL_DIR, metrics=self.metrics)
+        self.startup_timings['load_detectors'] = perf_counter() - t0
+        return detectors
+
+    def set_detectors(self, detectors):
+        self.roi_detector, self.ooi_detector = detectors
+        self.frame_analyzer = FrameAnalyzer(self.config, self.roi_detector, self.ooi_detector)
+
+    def wait_for_detectors(self):
+        """block until the detectors loading in the background are ready. Raises any error raised while loading"""
+        if self.frame_analyzer is not None:
+            return
+        t0 = perf_counter()
+        self.set_detectors(self.detectors_future.result())
+        self.startup_timings['wait_for_detectors'] = perf_counter() - t0
+
+    def report_startup(self):
+        """log how long each startup phase took, and warn if the time to the first frame exceeded the budget"""
+        self.startup_pending = False
+        self.startup_timings['total'] = perf_counter() - PROCESS_START
+        for phase, seconds in self.startup_timings.items():
+            self.metrics.set_gauge(f'startup_{phase}_seconds', seconds)
+        timings = ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in self.startup_timings.items())
+        if self.startup_timings['total'] > self.config.startup_budget:
+            logger.warning(f'startup exceeded its {self.config.startup_budget} second budget: {timings}')
+        else:
+            logger.info(f'startup timings: {timings}')
+
+    def init_notification_transport(self):
+        if self.config.notification_transport == 'http':
+            return HttpTransport(self.config.notification_http_url)
+        if self.config.notification_transport != 'sendgrid':
+            raise ValueError(f'unknown notification transport {self.config.notification_transport}. '
+                             f'Choose "sendgrid" or "http"')
+        return None
 
     def run(self):
         logger.info('Entering main run loop. Press Ctrl-C at any time to exit')
         try:
-            while True:
-                current_datetime = datetime.now()
-                if self.start_time < current_datetime.time() < self.end_time:
-                    self.active_mode()
-                else:
-                    self.passive_mode()
+            self.run_loop()
         except KeyboardInterrupt:
             logger.info('Keyboard Interrupt Detected. Running Cleanup operations, please wait until the program exits')
             self.collector.shutdown()
             logger.info('uploading remaining data, please wait')
             self.uploader.convert_and_upload()
+            self.notifier.close(timeout=30)
+            self.close_metrics()
             logger.info('Shutdown complete. Exiting')
             sys.exit(0)
         except Exception as e:
-            logger.exception(f'unknown exception: {e}')
-            logger.warning('shutting down due to unknown exception')
-            notification = Notification(subject=f'Unexpected Error in {self.config.project_id}',
-                                        message=f'{e}',
-                                        attachment_path=log_path)
-            logger.info('attempting to notify user and admin of error')
-            self.notifier.send_user_email(notification)
-            self.notifier.send_admin_email(notification)
-            try:
-                self.collector.shutdown()
-                self.uploader.convert_and_upload()
-            finally:
-                logger.info('shutdown complete. Exiting')
-                sys.exit(0)
+            self.shutdown_after_error(e)
+            sys.exit(0)
 
+    def run_loop(self):
+        while not self.stop_event.is_set():
+            self.check_config_changes()
+            current_datetime = self.clock.now()
+            if self.start_time < current_datetime.time() < self.end_time:
+                self.active_mode()
+            else:
+                self.passive_mode()
+
+    def shutdown_after_error(self, e):
+        logger.exception(f'unknown exception: {e}')
+        logger.warning('shutting down due to unknown exception')
+        notification = Notification(subject=f'Unexpected Error in {self.config.project_id}',
+                                    message=f'{e}',
+                                    attachment_path=log_path)
+        logger.info('attempting to notify user and admin of error')
+        self.notifier.send_user_email(notification)
+        self.notifier.send_admin_email(notification)
+        self.notifier.close(timeout=60)
+        try:
+            self.collector.shutdown()
+            self.uploader.convert_and_upload()
+        finally:
+            self.close_metrics()
+            logger.info('shutdown complete')
 
     def active_mode(self, round_video_split_time=True):
         logger.info('entering active collection mode')
+        t0 = perf_counter()
         self.collector.start_recording()
-        current_datetime = datetime.now()
+        self.storage_governor.segment_opened(getattr(self.collector, 'h264_path', None))
+        if self.startup_pending:
+            self.startup_timings['start_recording'] = perf_counter() - t0
+        self.wait_for_detectors()
+        self.apply_resource_settings()
+        self.uploader.start_trickle()
+        # trickle uploads stop in passive mode, so they are restarted if the disk is still filling
+        self.expedited_level = 'ok'
+        self.uploader.converter.resume()
+        current_datetime = self.clock.now()
         if round_video_split_time:
             next_video_split = (current_datetime + self.video_split_interval).replace(minute=0, second=0, microsecond=0)
         else:
             next_video_split = current_datetime + self.video_split_interval
         end_datetime = current_datetime.replace(hour=self.end_time.hour, minute=self.end_time.minute,
                                                 second=self.end_time.second, microsecond=0)
-        next_roi_update = current_datetime
-        next_behavior_check = current_datetime + timedelta(seconds=self.config.behavior_check_window)
-        roi_det, roi_slice = None, None
-        expected_data_buffer_length = (self.config.behavior_check_window / self.config.framegrab_interval)
-        minimum_viable_data_buffer_length = expected_data_buffer_length // 2
+        self.reset_analysis_state(current_datetime)
+        self.restore_checkpoint(current_datetime)
+        if self.inference is not None:
+            self.inference.add_source(self.config.project_id, self.process_frame, on_drop=self.drop_packet,
+                                      rate=1 / self.scheduler.interval, maxsize=self.config.pipeline_queue_size)
+        pipeline = self.start_pipeline() if self.config.pipeline_enabled and self.inference is None else None
+        pipeline_collector = self.metrics.add_collector(lambda m: self.collect_pipeline_metrics(m, pipeline))
+        self.scheduler.start(current_datetime.timestamp())
 
-        while self.start_time < current_datetime.time() < self.end_time:
-            next_framegrab = current_datetime + self.framegrab_interval
-            img = self.collector.capture_frame()
-            if current_datetime >= next_roi_update:
-                roi_det = self.roi_detector.detect(img)
-                if roi_det:
-                    roi_slice = np.s_[roi_det[0].bbox.ymin:roi_det[0].bbox.ymax,
-                                roi_det[0].bbox.xmin:roi_det[0].bbox.xmax]
-                    next_roi_update = current_datetime + self.roi_update_interval
-            if roi_slice:
-                img = img[roi_slice]
-                dets = self.ooi_detector.detect(img)
-                occupancy = len(self.ooi_detector.detect(img))
-
-                for det in dets:
-                    bbox = det.bbox
-                    cv2.rectangle(img, (bbox.xmin, bbox.ymin), (bbox.xmax, bbox.ymax), (0, 255, 0), 2)
-
-                thumbnail = cv2.resize(img, (img.shape[1] // 4, img.shape[0] // 4))
-                thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_RGB2BGR)
-                self.behavior_recognizer.append_data(current_datetime.timestamp(), occupancy, thumbnail)
-            if current_datetime >= next_behavior_check:
-                if len(self.behavior_recognizer.data_buffer) <  minimum_viable_data_buffer_length:
-                    logger.warning(f'Data buffer unusually short. Expected approximately {expected_data_buffer_length}. '
-                                   f'Got {len(self.behavior_recognizer.data_buffer)}')
-                elif self.behavior_recognizer.check_for_behavior():
-                    if self.notifier.check_conditions():
-                        logger.info('possible behavioral event. Sending notification')
-                        mp4_path = self.video_dir / f'eventclip_{int(current_datetime.timestamp())}.mp4'
-                        self.behavior_recognizer.thumbnails_to_mp4(mp4_path)
-                        notification = Notification(subject=f'possible behavioral event in {self.config.project_id}',
-                                                    message=f'activity fraction: {self.behavior_recognizer.calc_activity_fraction()}',
-                                                    attachment_path=str(mp4_path))
-                        self.notifier.notify(notification)
-                    else:
-                        logger.debug('possible behavior event detected but notification conditions not passed')
-                next_behavior_check = current_datetime + self.behavior_check_interval
-            if current_datetime >= next_video_split:
-                self.collector.split_recording()
-                next_video_split = next_video_split + self.video_split_interval
-                # if the video is going to split less than 30 seconds before the end time, prevent it
-                if -30 < (end_datetime - next_video_split).total_seconds() < 30:
-                    logger.debug(f'skipping video split at {next_video_split.isoformat()}: too close to end time')
-                    next_video_split = next_video_split + timedelta(hours=1)
-            pause.until(next_framegrab)
-            current_datetime = datetime.now()
-        self.collector.shutdown()
+        try:
+            while self.start_time < current_datetime.time() < self.end_time and not self.stop_event.is_set():
+                self.check_config_changes()
+                self.govern_storage()
+                self.govern_resources()
+                image = self.collector.capture_frame()
+                if image is False:
+                    # only a MockDataCollector runs out of frames
+                    logger.info('video source exhausted. Stopping')
+                    self.stop_event.set()
+                    break
+                self.metrics.increment('frames_captured')
+                packet = FramePacket(current_datetime, image)
+                if self.inference is not None:
+                    self.inference.submit(self.config.project_id, packet)
+                elif pipeline is not None:
+                    pipeline.submit(packet)
+                else:
+                    self.process_frame(packet)
+                if self.startup_pending:
+                    self.report_startup()
+                if current_datetime >= next_video_split:
+                    self.split_segment()
+                    next_video_split = next_video_split + self.video_split_interval
+                    # if the video is going to split less than 30 seconds before the end time, prevent it
+                    if -30 < (end_datetime - next_video_split).total_seconds() < 30:
+                        logger.debug(f'skipping video split at {next_video_split.isoformat()}: too close to end time')
+                        next_video_split = next_video_split + timedelta(hours=1)
+                current_datetime = datetime.fromtimestamp(self.scheduler.wait())
+        finally:
+            logger.info(f'framegrab schedule stats: {self.scheduler.stats()}')
+            self.metrics.remove_collector(pipeline_collector)
+            if self.inference is not None:
+                logger.info(f'inference scheduler stats: {self.inference.remove_source(self.config.project_id)}')
+            if pipeline is not None:
+                pipeline.stop()
+                logger.info(f'pipeline queue stats: {pipeline.stats()}')
+        if self.detection_log is not None:
+            self.detection_log.close()
+        self.frame_analyzer.log_stats()
+        self.uploader.queue_conversion(self.storage_governor.segment_closed(self.collector.shutdown()))
         self.notifier.reset()
         self.behavior_recognizer.reset()
+        if not self.stop_event.is_set():
+            # the checkpointed state only applies until the end of the day's active period. When stopped early, it is
+            # kept for the next start
+            self.checkpoint.clear()
+
+    def split_segment(self):
+        """start a new video segment, and queue the one just closed for conversion"""
+        closed_path = self.storage_governor.segment_closed(self.collector.split_recording())
+        self.storage_governor.segment_opened(getattr(self.collector, 'h264_path', None))
+        self.uploader.queue_conversion(closed_path)
+
+    def govern_storage(self):
+        """upload early, or change the recording quality, as the storage governor's latest check calls for"""
+        if getattr(self.collector, 'h264_path', None) is None:
+            # stand-in collectors that do not record have nothing to govern
+            return
+        level = self.storage_governor.check()
+        if level is None:
+            return
+        if level != self.expedited_level:
+            # videos converted after expedite are queued as they are converted, so the videos already waiting only
+            # need to be looked for again when the level changes
+            if level != 'ok':
+                self.uploader.expedite()
+            self.expedited_level = level
+        if self.storage_governor.quality == 'low':
+            self.collector.set_recording_options(**self.low_quality_options())
+        else:
+            self.collector.set_recording_options()
+        if level == 'evict' and self.storage_governor.open_quality not in (None, self.storage_governor.quality):
+            self.split_segment()
+
+    def govern_resources(self):
+        """lower or restore the analysis load according to the resource governor's latest reading of the CPU"""
+        if self.resource_governor.check() is not None:
+            with self.inference_lock, self.analysis_lock:
+                self.apply_resource_settings()
+
+    def apply_resource_settings(self):
+        """push the resource governor's current settings to the framegrab scheduler and the frame analyzer"""
+        settings = self.resource_governor.settings
+        self.scheduler.set_min_step(settings['framegrab_factor'])
+        self.frame_analyzer.ooi_stride = settings['ooi_stride']
+        self.frame_analyzer.thumbnail_scale = settings['thumbnail_scale']
+        self.metrics.set_gauge('ooi_inference_rate', 1 / (self.scheduler.interval * settings['ooi_stride']))
+
+    def low_quality_options(self):
+        """:return: h264 encoder options for recording while disk space is short"""
+        options = {'bitrate': self.config.storage_low_bitrate}
+        if self.config.storage_low_scale < 1:
+            width, height = self.picamera_kwargs['resolution']
+            scale = self.config.storage_low_scale
+            options['resize'] = (max(32, int(width * scale) // 32 * 32), max(16, int(height * scale) // 16 * 16))
+        return options
+
+    def start_pipeline(self):
+        pipeline = Pipeline([('inference', self.analyze_frame),
+                             ('analysis', self.finish_frame)],
+                            maxsize=self.config.pipeline_queue_size,
+                            drop_policy=self.config.pipeline_drop_policy,
+                            on_drop=self.drop_packet)
+        pipeline.start()
+        return pipeline
+
+    @staticmethod
+    def collect_pipeline_metrics(metrics, pipeline):
+        if pipeline is None:
+            return
+        for stage, stats in pipeline.stats().items():
+            metrics.set_gauge(f'{stage}_queue_depth', stats['current_depth'])
+            metrics.set_gauge(f'{stage}_queue_max_depth', stats['max_depth'])
+
+    def close_metrics(self):
+        self.metrics.close(self.project_dir / 'metrics.json' if self.metrics.enabled else None)
+
+    def reset_analysis_state(self, current_datetime):
+        self.frame_analyzer.reset()
+        self.next_behavior_check = current_datetime + timedelta(seconds=self.config.behavior_check_window)
+
+    def save_checkpoint(self):
+        roi_detected_at = self.frame_analyzer.roi_tracker.detected_at
+        state = {'notification_count': self.notifier.notification_count,
+                 'last_notification_timestamp': self.notifier.last_notification_timestamp,
+                 'next_behavior_check': self.next_behavior_check.timestamp(),
+                 'roi_box': self.frame_analyzer.roi_box,
+                 'roi_detected_at': None if roi_detected_at is None else roi_detected_at.timestamp()}
+        with self.metrics.timer('checkpoint_save'):
+            try:
+                self.checkpoint.save(state, self.behavior_recognizer.checkpoint_arrays())
+            except OSError as e:
+                logger.warning(f'failed to save checkpoint: {e}')
+
+    def restore_checkpoint(self, current_datetime):
+        """resume today's notification counts from the checkpoint, plus the behavior data and ROI if it is fresh"""
+        t0 = perf_counter()
+        checkpoint = self.checkpoint.load()
+        if checkpoint is None:
+            return
+        state, arrays = checkpoint
+        if datetime.fromtimestamp(state['saved_at']).date() != current_datetime.date():
+            logger.info('ignoring checkpoint from a previous day')
+            return
+        self.notifier.notification_count = state['notification_count']
+        self.notifier.last_notification_timestamp = state['last_notification_timestamp']
+        if not self.checkpoint.fresh(state):
+            logger.info(f'resumed the notification counts ({self.notifier.notification_count} sent today) from a '
+                        f'checkpoint saved {self.clock.time() - state["saved_at"]:.0f} seconds ago. Its behavior data '
+                        f'and ROI are too old to reuse')
+            return
+        self.behavior_recognizer.restore(arrays['behavior_timestamps'], arrays['behavior_occupancies'])
+        self.next_behavior_check = datetime.fromtimestamp(state['next_behavior_check'])
+        if state['roi_box'] is not None:
+            self.frame_analyzer.restore_roi(state['roi_box'], datetime.fromtimestamp(state['roi_detected_at']))
+        self.startup_timings['restore_checkpoint'] = perf_counter() - t0
+        logger.info(f'resumed from checkpoint: {len(self.behavior_recognizer)} frames of behavior data, '
+                    f'{self.notifier.notification_count} notification(s) sent today, ROI {state["roi_box"]}')
+
+    def process_frame(self, packet: FramePacket):
+        self.finish_frame(self.analyze_frame(packet))
+
+    def finish_frame(self, packet: FramePacket):
+        try:
+            with self.metrics.timer('record_and_check'), self.analysis_lock:
+                self.record_and_check(packet)
+        finally:
+            self.release_packet(packet)
+
+    def release_packet(self, packet: FramePacket):
+        self.collector.release_frame(packet.frame)
+
+    def drop_packet(self, packet: FramePacket):
+        self.metrics.increment('frames_dropped')
+        self.release_packet(packet)
+
+    def analyze_frame(self, packet: FramePacket):
+        with self.metrics.timer('analyze_frame'), self.inference_lock:
+            packet = self.frame_analyzer.analyze(packet)
+        if packet.dets is not None and not packet.inferred:
+            self.metrics.increment('ooi_inferences_skipped')
+        return packet
+
+    def record_and_check(self, packet: FramePacket):
+        if self.detection_log is not None:
+            self.detection_log.append(packet)
+        if packet.dets is not None:
+            self.record_frame(packet)
+        if packet.timestamp >= self.next_behavior_check:
+            self.check_for_behavior(packet.timestamp)
+            self.next_behavior_check = packet.timestamp + self.behavior_check_interval
+        if self.checkpoint.due():
+            self.save_checkpoint()
+
+    def record_frame(self, packet: FramePacket):
+        thumbnail, boxes = self.frame_analyzer.make_thumbnail(packet)
+        self.behavior_recognizer.append_data(packet.timestamp.timestamp(), packet.occupancy, thumbnail, boxes)
+
+    def check_for_behavior(self, current_datetime):
+        expected_data_buffer_length = (self.config.behavior_check_window / self.scheduler.interval)
+        minimum_viable_data_buffer_length = expected_data_buffer_length // 2
+        if len(self.behavior_recognizer) < minimum_viable_data_buffer_length:
+            logger.warning(f'Data buffer unusually short. Expected approximately {expected_data_buffer_length}. '
+                           f'Got {len(self.behavior_recognizer)}')
+        elif self.behavior_recognizer.check_for_behavior():
+            # the footage of a possible event is kept even if the disk fills
+            self.storage_governor.mark_event(current_datetime.timestamp() - self.config.behavior_check_window,
+                                             current_datetime.timestamp())
+            if self.notifier.check_conditions():
+                logger.info('possible behavioral event. Sending notification')
+                mp4_path = self.video_dir / f'eventclip_{int(current_datetime.timestamp())}.mp4'
+                # the clip is rendered and sent from the notifier's dispatcher thread, off the framegrab loop. Right
+                # after a restart there may be no thumbnails to make a clip from yet
+                render_clip = self.behavior_recognizer.clip_renderer()
+                activity_fraction = self.behavior_recognizer.calc_activity_fraction()
+                notification = Notification(subject=f'possible behavioral event in {self.config.project_id}',
+                                            message=f'activity fraction: {activity_fraction}',
+                                            attachment_path=str(mp4_path) if render_clip is not None else None)
+                self.notifier.notify(notification, render_clip=render_clip)
+            else:
+                logger.debug('possible behavior event detected but notification conditions not passed')
 
     def passive_mode(self, ):
         logger.info('entering passive upload mode')
+        if self.startup_pending:
+            self.report_startup()
+        self.notifier.flush(timeout=120)
         logger.info('converting and uploading videos')
         self.uploader.convert_and_upload()
         logger.info('conversion and upload complete')
-        current_datetime = datetime.now()
+        current_datetime = self.clock.now()
         next_start = current_datetime.replace(hour=self.start_time.hour, minute=self.start_time.minute,
                                               second=self.start_time.second, microsecond=0)
         if current_datetime.time() > self.end_time:
             next_start = next_start + timedelta(days=1)
         logger.info(f'pausing until {next_start}')
-        pause.until(next_start)
+        self.clock.sleep_until(next_start)
+
+
+class MultiRunner:
+
+    # config options that must match across projects, since their frames are analyzed by the same detectors
+    SHARED_DETECTOR_OPTIONS = ('roi_model', 'ooi_model', 'roi_cpu_model', 'ooi_cpu_model', 'roi_confidence_thresh',
+                               'ooi_confidence_thresh', 'edgetpu_devices', 'cpu_detector_workers',
+                               'cpu_detector_threads')
+
+    def __init__(self, config_paths, source_videos=None):
+        """
+        runs one Runner per project in one process, sharing a pair of detector pools through an InferenceScheduler
+        :param config_paths: config.yaml path of each project
+        :param source_videos: optional list of videos, one per project, to read instead of cameras. Intended for testing
+        """
+        logger.debug('beginning multi-source runner initialization')
+        if source_videos is not None and len(source_videos) != len(config_paths):
+            raise ValueError(f'got {len(source_videos)} source videos for {len(config_paths)} projects')
+        for config_path in config_paths:
+            if not config_path.exists():
+                raise FileNotFoundError(f'no project config found at {config_path}. Create it with --pid first')
+        configs = [ConfigManager(config_path).config_as_namespace() for config_path in config_paths]
+        for option in self.SHARED_DETECTOR_OPTIONS:
+            values = {str(getattr(config, option)) for config in configs}
+            if len(values) > 1:
+                raise ValueError(f'{option} must be the same for every project run together. Got {sorted(values)}')
+        self.detectors = init_detectors(configs[0], MODEL_DIR)
+        # one worker per OOI detector keeps every detector busy; more would only queue on the pool
+        self.inference = InferenceScheduler(workers=len(self.detectors[1]))
+        self.runners = []
+        for i, (config_path, config) in enumerate(zip(config_paths, configs)):
+            collector = None
+            if source_videos is not None:
+                analysis_resolution = None
+                if config.analysis_h_resolution and config.analysis_v_resolution:
+                    analysis_resolution = (config.analysis_h_resolution, config.analysis_v_resolution)
+                collector = MockDataCollector(source_videos[i], config.framegrab_interval, analysis_resolution,
+                                              config.pipeline_queue_size + 3)
+            self.runners.append(Runner(config_path, self.detectors, collector, self.inference))
+        self.failed = set()
+        logger.info(f'multi-source runner successfully initialized with {len(self.runners)} sources')
+
+    def run(self):
+        logger.info('Entering main run loop. Press Ctrl-C at any time to exit')
+        threads = [threading.Thread(target=self.run_source, args=(runner,), name=f'runner_{runner.config.project_id}',
+                                    daemon=True)
+                   for runner in self.runners]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            logger.info('Keyboard Interrupt Detected. Running Cleanup operations, please wait until the program exits')
+            for runner in self.runners:
+                runner.stop_event.set()
+            for thread in threads:
+                thread.join(timeout=30)
+        for runner, thread in zip(self.runners, threads):
+            if runner in self.failed:
+                continue
+            if thread.is_alive():
+                # still in passive mode. Interrupted conversions and uploads are resumed from their manifests on the
+                # next start
+                logger.info(f'{runner.config.project_id} is busy in passive mode. Skipping its final upload')
+            else:
+                runner.collector.shutdown()
+                logger.info(f'uploading remaining data for {runner.config.project_id}, please wait')
+                runner.uploader.convert_and_upload()
+            runner.notifier.close(timeout=30)
+            runner.close_metrics()
+        self.inference.stop()
+        logger.info('Shutdown complete. Exiting')
+
+    def run_source(self, runner: Runner):
+        try:
+            runner.run_loop()
+        except Exception as e:
+            # a failed source is shut down on its own, and the other sources keep running
+            self.failed.add(runner)
+            runner.shutdown_after_error(e)
 
 
 def parse_opt(known=False):
@@ -211,13 +721,190 @@ def parse_opt(known=False):
                              'Otherwise, a new project with that ID will be created and the program will exit so that'
                              'you can edit the default config.yaml file if necessary.',
                         default=None)
+    parser.add_argument('--multi',
+                        type=str,
+                        nargs='+',
+                        help='Ids of several existing projects (one per camera) to run together in one process, '
+                             'sharing the Edge TPUs / detectors between them.',
+                        default=None)
+    parser.add_argument('--multi_videos',
+                        type=str,
+                        nargs='+',
+                        help='Videos to use in place of the cameras of the --multi projects, one per project, for '
+                             'testing.',
+                        default=None)
+    parser.add_argument('--log_dir',
+                        type=str,
+                        help='Directory the debug log is written to.',
+                        default=str(LOG_DIR))
+    parser.add_argument('--replay',
+                        type=str,
+                        help='Directory of recorded mp4s to re-analyze offline using the config of the project given '
+                             'by --pid, instead of starting data collection.',
+                        default=None)
+    parser.add_argument('--replay_output',
+                        type=str,
+                        help='Directory to write replay results to. Defaults to a "Replay" folder in the project '
+                             'directory.',
+                        default=None)
+    parser.add_argument('--replay_devices',
+                        type=str,
+                        nargs='+',
+                        help='Devices to run replay workers on, one worker per entry. Each entry is either an Edge '
+                             'TPU device string (e.g. ":0") or "cpu". Defaults to all Edge TPUs, or one CPU worker '
+                             'per core.',
+                        default=None)
+    parser.add_argument('--detection_cache',
+                        type=str,
+                        help='Directory of the on-disk detection cache used by --replay. Defaults to a '
+                             '"DetectionCache" folder in the project directory. Pass "none" to disable caching.',
+                        default=None)
+    parser.add_argument('--sweep',
+                        type=str,
+                        help='Directory of replay results to evaluate behavior parameter combinations on, using the '
+                             'config of the project given by --pid for any parameter not in --sweep_grid.',
+                        default=None)
+    parser.add_argument('--sweep_grid',
+                        type=str,
+                        help='yaml file mapping behavior parameters (e.g. behavior_check_window) to lists of values '
+                             'to try.',
+                        default=None)
+    parser.add_argument('--sweep_processes',
+                        type=int,
+                        help='Number of worker processes used by --sweep.',
+                        default=1)
+    parser.add_argument('--benchmark',
+                        type=str,
+                        help='Path of a json file to write hot path benchmark results to, instead of starting data '
+                             'collection. Uses synthetic frames, and the config of the project given by --pid if '
+                             'there is one (otherwise the default config).',
+                        default=None)
+    parser.add_argument('--benchmark_grid',
+                        type=str,
+                        help='yaml file mapping benchmark settings (resolution, roi_fraction, behavior_check_window, '
+                             'ooi_latency) to lists of values to try.',
+                        default=None)
+    parser.add_argument('--benchmark_detector',
+                        type=str,
+                        choices=['stand_in', 'cpu'],
+                        help='"stand_in" to use detectors with a fixed latency (see ooi_latency), or "cpu" to run the '
+                             'project models on the CPU with tflite_runtime.',
+                        default='stand_in')
+    parser.add_argument('--benchmark_frames',
+                        type=int,
+                        help='Number of timed frames per benchmark setting.',
+                        default=200)
+    parser.add_argument('--extract_clip',
+                        type=str,
+                        nargs=2,
+                        metavar=('START', 'END'),
+                        help='Cut the full-resolution video between two ISO format times (e.g. 2026-05-01T14:03:00) '
+                             'out of the recorded videos of the project given by --pid, instead of starting data '
+                             'collection.',
+                        default=None)
+    parser.add_argument('--extract_output',
+                        type=str,
+                        help='Path of the mp4 written by --extract_clip. Defaults to a file in a "Clips" folder in the '
+                             'project directory.',
+                        default=None)
+    parser.add_argument('--extract_video_dir',
+                        type=str,
+                        help='Directory of recorded videos and their .index.csv files to cut --extract_clip from, e.g. '
+                             'after downloading them from the cloud. Defaults to the project\'s Videos folder.',
+                        default=None)
+    parser.add_argument('--soak',
+                        type=str,
+                        help='Path of a json file to write a soak test report to, instead of starting data collection. '
+                             'Simulates whole days of operation on a virtual clock, with synthetic frames, stand-in '
+                             'detectors, and local stand-ins for ffmpeg, rclone, and SendGrid.',
+                        default=None)
+    parser.add_argument('--soak_days',
+                        type=float,
+                        help='Number of days simulated by --soak.',
+                        default=3)
+    parser.add_argument('--soak_config',
+                        type=str,
+                        help='yaml file of config values to use in the --soak simulation instead of the defaults.',
+                        default=None)
+    parser.add_argument('--soak_dir',
+                        type=str,
+                        help='Directory for the simulated project, cloud, and tools of --soak. Point this at a small '
+                             'filesystem (e.g. a tmpfs) to test how the program copes with a full disk. Defaults to a '
+                             'temporary directory that is deleted afterwards.',
+                        default=None)
+    parser.add_argument('--soak_bitrate',
+                        type=int,
+                        help='Bits per second written by the simulated camera of --soak. By default it only writes '
+                             'small placeholder videos.',
+                        default=None)
     return parser.parse_known_args()[0] if known else parser.parse_args()
 
 
 if __name__ == "__main__":
     opt = parse_opt()
-    config_path = DEFAULT_DATA_DIR / opt.project_id / 'config.yaml'
-    if config_path.exists():
+    setup_logging(opt.log_dir)
+    config_path = DEFAULT_DATA_DIR / (opt.project_id or '') / 'config.yaml'
+    if opt.benchmark:
+        from modules.benchmark import run_benchmark
+        config_manager = ConfigManager(config_path)
+        if config_manager.config is None:
+            config_manager.config = config_manager.default_config()
+        benchmark_grid = None
+        if opt.benchmark_grid:
+            with open(opt.benchmark_grid, 'r') as f:
+                benchmark_grid = yaml.safe_load(f)
+        run_benchmark(config_manager.config_as_namespace(), opt.benchmark, benchmark_grid, opt.benchmark_detector,
+                      MODEL_DIR, opt.benchmark_frames)
+    elif opt.soak:
+        from modules.soak import run_soak
+        soak_overrides = None
+        if opt.soak_config:
+            with open(opt.soak_config, 'r') as f:
+                soak_overrides = yaml.safe_load(f)
+        run_soak(Runner, opt.soak, opt.soak_days, config_overrides=soak_overrides, sim_dir=opt.soak_dir,
+                 video_bitrate=opt.soak_bitrate)
+    elif opt.multi:
+        multi_runner = MultiRunner([DEFAULT_DATA_DIR / pid / 'config.yaml' for pid in opt.multi], opt.multi_videos)
+        multi_runner.run()
+    elif (opt.replay or opt.sweep or opt.extract_clip) and not config_path.exists():
+        sys.exit(f'{config_path} not found. --replay, --sweep, and --extract_clip need the config of an existing '
+                 f'project, given with --project_id')
+    elif opt.replay:
+        from modules.replay import replay_directory
+        replay_config = ConfigManager(config_path).config_as_namespace()
+        replay_output = pathlib.Path(opt.replay_output) if opt.replay_output else config_path.parent / 'Replay'
+        if opt.detection_cache is None:
+            cache_dir = config_path.parent / 'DetectionCache'
+        else:
+            cache_dir = None if opt.detection_cache.lower() == 'none' else pathlib.Path(opt.detection_cache)
+        replay_directory(opt.replay, replay_config, MODEL_DIR, replay_output, opt.replay_devices,
+                         cache_dir=cache_dir)
+    elif opt.sweep:
+        from modules.threshold_sweep import (load_replay_occupancy, sweep_thresholds, grid_from_config,
+                                             write_sweep_results)
+        sweep_config = ConfigManager(config_path).config_as_namespace()
+        grid_overrides = None
+        if opt.sweep_grid:
+            with open(opt.sweep_grid, 'r') as f:
+                grid_overrides = yaml.safe_load(f)
+        timestamps, occupancies = load_replay_occupancy(opt.sweep)
+        results = sweep_thresholds(timestamps, occupancies, grid_from_config(sweep_config, grid_overrides),
+                                   sweep_config.framegrab_interval, sweep_config.min_notification_interval,
+                                   sweep_config.max_notifications_per_day, opt.sweep_processes)
+        write_sweep_results(results, pathlib.Path(opt.sweep) / 'threshold_sweep.csv')
+    elif opt.extract_clip:
+        from modules.video_index import ClipExtractor
+        extract_config = ConfigManager(config_path).config_as_namespace()
+        clip_start, clip_end = (datetime.fromisoformat(t) for t in opt.extract_clip)
+        video_dir = pathlib.Path(opt.extract_video_dir) if opt.extract_video_dir else config_path.parent / 'Videos'
+        if opt.extract_output:
+            clip_path = pathlib.Path(opt.extract_output)
+        else:
+            clip_name = f'clip_{int(clip_start.timestamp())}_{int(clip_end.timestamp())}.mp4'
+            clip_path = config_path.parent / 'Clips' / clip_name
+        ClipExtractor(video_dir, extract_config.framerate).extract(clip_start.timestamp(), clip_end.timestamp(),
+                                                                  clip_path)
+    elif config_path.exists():
         runner = Runner(config_path)
         runner.run()
     else:
@@ -1,16 +1,21 @@
 """code for defining a relationship between object detection data and one or more behaviors of interest"""
 import logging
-import cv2
-import pandas as pd
+import math
+import numpy as np
 
+from modules.metrics import NULL_METRICS
+from modules.utils import cv2_api
 logger = logging.getLogger(__name__)
 
+MAX_THUMBNAIL_BOXES = 25
+
 
 class BehaviorRecognizer:
 
-    def __init__(self, config):
+    def __init__(self, config, metrics=None):
         logger.debug('Beginning BehaviorRecognizer initialization')
         self.config = config
+        self.metrics = metrics or NULL_METRICS
         self.behavior_check_window = config.behavior_check_window
         logger.debug(f'behavior check window set to {self.behavior_check_window} seconds')
         self.min_individuals_roi = config.behavior_min_individuals_roi
@@ -20,38 +25,237 @@ class BehaviorRecognizer:
         self.min_fraction_for_notification = config.behavior_min_fraction_for_notification
         logger.debug(f'notification will trigger when {self.min_fraction_for_notification * 100}% of recent frames'
                     f'meet the occupancy condition')
-        self.data_buffer = []
+
+        # frames are kept for the longer of the check window and the clip window, so that event clips can include
+        # footage from before the check window. Only the newest check window of frames counts towards the activity
+        # fraction
+        self.clip_window = max(self.behavior_check_window, config.clip_window or 0)
+        logger.debug(f'clip window set to {self.clip_window} seconds')
+        # ring buffer sized for one full clip window of frames, plus some slack for jitter in the framegrab timing
+        self.capacity = int(math.ceil(1.25 * self.clip_window / config.framegrab_interval)) + 2
+        self.timestamps = np.zeros(self.capacity, dtype=np.float64)
+        self.occupancies = np.zeros(self.capacity, dtype=np.int32)
+        # thumbnails are stored unannotated, either jpeg encoded (one byte array per slot) or raw in a fixed arena that
+        # is allocated on the first append, once the thumbnail shape is known. Boxes and occupancy are drawn on only
+        # when a clip is rendered
+        self.thumbnail_format = config.thumbnail_format
+        if self.thumbnail_format not in ('jpeg', 'raw'):
+            raise ValueError(f'invalid thumbnail format {self.thumbnail_format}. Choose "jpeg" or "raw"')
+        self.jpeg_params = [cv2_api().IMWRITE_JPEG_QUALITY, int(config.thumbnail_jpeg_quality)]
+        self.thumbnails = [None] * self.capacity if self.thumbnail_format == 'jpeg' else None
+        self.thumbnail_shape = None
+        # frames restored from a checkpoint have no thumbnail, and are left out of clips
+        self.has_thumbnail = np.zeros(self.capacity, dtype=bool)
+        self.box_counts = np.zeros(self.capacity, dtype=np.int16)
+        self.boxes = np.zeros((self.capacity, MAX_THUMBNAIL_BOXES, 4), dtype=np.int16)
+        self.start, self.size = 0, 0
+        self.check_size = 0  # number of newest frames that fall within the check window
+        self.in_range_count = 0
+        logger.debug(f'data buffer capacity set to {self.capacity} frames')
+        self.metrics.add_collector(self.collect_metrics)
         logger.info('BehaviorRecognizer successfully initialized')
 
-    def append_data(self, timestamp, occupancy, thumbnail):
-        self.data_buffer.append((timestamp, occupancy, thumbnail))
-        while (len(self.data_buffer) >= 2) and (self.calc_buffer_length_seconds() > self.behavior_check_window):
-            self.data_buffer.pop(0)
+    def __len__(self):
+        """number of frames in the check window"""
+        return self.check_size
+
+    def occupancy_in_range(self, occupancy):
+        return self.min_individuals_roi <= occupancy <= self.max_individuals_roi
+
+    def append_data(self, timestamp, occupancy, thumbnail=None, boxes=None):
+        """
+        :param thumbnail: optional unannotated BGR thumbnail of the ROI
+        :param boxes: optional (n, 4) array of boxes in thumbnail coordinates, drawn on when a clip is rendered
+        """
+        if self.size == self.capacity:
+            logger.debug('data buffer full before the check window elapsed. Evicting oldest frame')
+            self.evict_oldest()
+        idx = (self.start + self.size) % self.capacity
+        self.timestamps[idx] = timestamp
+        self.occupancies[idx] = occupancy
+        self.has_thumbnail[idx] = thumbnail is not None
+        if thumbnail is not None:
+            self.store_thumbnail(idx, thumbnail, boxes)
+        self.size += 1
+        self.check_size += 1
+        if self.occupancy_in_range(occupancy):
+            self.in_range_count += 1
+        while (self.check_size >= 2) and (timestamp - self.timestamps[self.check_start()] > self.behavior_check_window):
+            self.leave_check_window()
+        while (self.size >= 2) and (self.calc_buffer_length_seconds() > self.clip_window):
+            self.evict_oldest()
+
+    def store_thumbnail(self, idx, thumbnail, boxes=None):
+        cv2 = cv2_api()
+        if self.thumbnail_shape is None or self.size == 0:
+            # every clip is rendered at the shape of the oldest thumbnail in the window
+            self.thumbnail_shape = thumbnail.shape
+        n = 0 if boxes is None else min(len(boxes), MAX_THUMBNAIL_BOXES)
+        self.box_counts[idx] = n
+        if n:
+            self.boxes[idx, :n] = boxes[:n]
+        if self.thumbnail_format == 'jpeg':
+            self.thumbnails[idx] = cv2.imencode('.jpg', thumbnail, self.jpeg_params)[1]
+            return
+        if (self.thumbnails is None) or (self.thumbnails.shape[1:] != self.thumbnail_shape):
+            self.thumbnails = np.zeros((self.capacity,) + thumbnail.shape, dtype=np.uint8)
+            logger.debug(f'thumbnail buffer allocated with shape {self.thumbnails.shape}')
+        slot = self.thumbnails[idx]
+        if thumbnail.shape == slot.shape:
+            slot[...] = thumbnail
+        else:
+            # the ROI changed size mid-window; keep every thumbnail the same shape so they can be written to one clip
+            cv2.resize(thumbnail, (slot.shape[1], slot.shape[0]), dst=slot)
+            if n:
+                scale = np.array([slot.shape[1] / thumbnail.shape[1], slot.shape[0] / thumbnail.shape[0]] * 2)
+                self.boxes[idx, :n] = self.boxes[idx, :n] * scale
+
+    def set_occupancy_range(self, min_individuals_roi, max_individuals_roi):
+        """change the occupancy condition, recounting the frames already in the check window"""
+        self.min_individuals_roi, self.max_individuals_roi = min_individuals_roi, max_individuals_roi
+        window = self.ordered_indices()[self.size - self.check_size:]
+        self.in_range_count = int(np.count_nonzero((self.occupancies[window] >= min_individuals_roi) &
+                                                   (self.occupancies[window] <= max_individuals_roi)))
+
+    def set_jpeg_quality(self, quality):
+        """change the quality of thumbnails stored from now on"""
+        self.jpeg_params = [cv2_api().IMWRITE_JPEG_QUALITY, int(quality)]
+
+    def refill_from(self, other):
+        """copy the buffered frames of another BehaviorRecognizer that fit this one's clip window"""
+        self.reset()
+        for idx in other.ordered_indices().tolist():
+            thumbnail = decode_thumbnail(other.thumbnails[idx]) if other.has_thumbnail[idx] else None
+            self.append_data(other.timestamps[idx], other.occupancies[idx], thumbnail,
+                             other.boxes[idx, :other.box_counts[idx]])
+
+    def check_start(self):
+        """:return: buffer index of the oldest frame in the check window"""
+        return (self.start + self.size - self.check_size) % self.capacity
+
+    def leave_check_window(self):
+        if self.occupancy_in_range(self.occupancies[self.check_start()]):
+            self.in_range_count -= 1
+        self.check_size -= 1
+
+    def evict_oldest(self):
+        if self.check_size == self.size:
+            self.leave_check_window()
+        self.start = (self.start + 1) % self.capacity
+        self.size -= 1
+
+    def ordered_indices(self):
+        return (self.start + np.arange(self.size)) % self.capacity
 
     def calc_activity_fraction(self):
-        data = pd.DataFrame([x[:2] for x in self.data_buffer], columns=['timestamp', 'occupancy'])
-        data_slice = data.query('@self.min_individuals_roi <= occupancy <= @self.max_individuals_roi')
-        return len(data_slice) / len(data)
+        if self.check_size == 0:
+            return 0.0
+        return self.in_range_count / self.check_size
 
     def check_for_behavior(self):
         activity_fraction = self.calc_activity_fraction()
+        self.metrics.increment('behavior_checks')
+        self.metrics.set_gauge('activity_fraction', activity_fraction)
         if activity_fraction >= self.min_fraction_for_notification:
+            self.metrics.increment('behavior_positive_checks')
             return True
         return False
 
     def thumbnails_to_mp4(self, output_path):
-        fourcc = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
-        fps = 1 // self.config.framegrab_interval
-        height, width, _ = self.data_buffer[0][2].shape
-        video = cv2.VideoWriter(str(output_path), fourcc, fps, (width, height))
-        for _, occupancy, thumbnail in self.data_buffer:
-            cv2.putText(thumbnail, f'{occupancy}', (0, 25),
-                        cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2, cv2.LINE_8)
-            video.write(thumbnail)
-        video.release()
+        render = self.clip_renderer(copy=False)
+        if render is None:
+            raise ValueError('no thumbnails buffered')
+        render(output_path)
+
+    def clip_renderer(self, copy=True):
+        """
+        :param copy: whether to copy the buffered thumbnails and boxes, so the clip can be written after they change
+        :return: function that takes an output path and writes the clip there, or None if no thumbnails are buffered
+        """
+        order = self.ordered_indices()
+        order = order[self.has_thumbnail[order]]
+        if not len(order):
+            return None
+        if copy:
+            if self.thumbnail_format == 'jpeg':
+                thumbnails = [self.thumbnails[idx] for idx in order]
+            else:
+                thumbnails = self.thumbnails[order]
+            occupancies, box_counts, boxes = self.occupancies[order], self.box_counts[order], self.boxes[order]
+            order = range(len(order))
+        else:
+            thumbnails, occupancies, box_counts, boxes = self.thumbnails, self.occupancies, self.box_counts, self.boxes
+        # clips play in real time, but no slower than 1 fps
+        fps = max(1, 1 / self.config.framegrab_interval)
+        frame_size = (self.thumbnail_shape[1], self.thumbnail_shape[0])
+
+        def render(output_path):
+            with self.metrics.timer('thumbnails_to_mp4'):
+                frames = ((decode_thumbnail(thumbnails[idx]), occupancies[idx], boxes[idx, :box_counts[idx]])
+                          for idx in order)
+                write_clip(output_path, frames, fps, frame_size)
+        return render
+
+    def buffer_nbytes(self):
+        """approximate memory used by the buffered data, including thumbnails"""
+        nbytes = self.timestamps.nbytes + self.occupancies.nbytes + self.box_counts.nbytes + self.boxes.nbytes
+        if self.thumbnail_format == 'jpeg':
+            return nbytes + sum(t.nbytes for t in self.thumbnails if t is not None)
+        return nbytes + (0 if self.thumbnails is None else self.thumbnails.nbytes)
+
+    def collect_metrics(self, metrics):
+        metrics.set_gauge('behavior_buffer_frames', self.size)
+        metrics.set_gauge('behavior_buffer_seconds', float(self.calc_buffer_length_seconds()) if self.size else 0.0)
 
     def calc_buffer_length_seconds(self):
-        return self.data_buffer[-1][0] - self.data_buffer[0][0]
+        return self.timestamps[(self.start + self.size - 1) % self.capacity] - self.timestamps[self.start]
 
     def reset(self):
-        self.data_buffer = []
+        self.start, self.size = 0, 0
+        self.check_size = 0
+        self.in_range_count = 0
+        self.thumbnail_shape = None
+
+    def checkpoint_arrays(self):
+        """:return: timestamps and occupancies of the frames in the check window, for a RuntimeCheckpoint"""
+        order = self.ordered_indices()[self.size - self.check_size:]
+        return {'behavior_timestamps': self.timestamps[order], 'behavior_occupancies': self.occupancies[order]}
+
+    def restore(self, timestamps, occupancies):
+        """refill the buffer from checkpoint_arrays. Restored frames count towards the activity fraction"""
+        self.reset()
+        for timestamp, occupancy in zip(timestamps.tolist(), occupancies.tolist()):
+            self.append_data(timestamp, occupancy)
+        logger.debug(f'restored {self.size} frames to the data buffer')
+
+
+def decode_thumbnail(thumbnail):
+    if thumbnail.ndim == 1:
+        cv2 = cv2_api()
+        return cv2.imdecode(thumbnail, cv2.IMREAD_COLOR)
+    return thumbnail
+
+
+def write_clip(output_path, frames, fps, frame_size):
+    """
+    write an mp4 from thumbnails, drawing each one's detection boxes and labelling it with its occupancy
+    :param frames: iterable of (BGR thumbnail, occupancy, (n, 4) array of boxes in thumbnail pixel coordinates)
+    :param fps: framerate of the clip
+    :param frame_size: (width, height) of the clip. Thumbnails of a different size are resized to fit
+    """
+    cv2 = cv2_api()
+    fourcc = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
+    video = cv2.VideoWriter(str(output_path), fourcc, fps, frame_size)
+    for thumbnail, occupancy, boxes in frames:
+        height, width = thumbnail.shape[:2]
+        if (width, height) == frame_size:
+            frame = thumbnail.copy()
+        else:
+            frame = cv2.resize(thumbnail, frame_size)
+            boxes = boxes * np.array([frame_size[0] / width, frame_size[1] / height] * 2)
+        for xmin, ymin, xmax, ymax in boxes.astype(int).tolist():
+            cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), (0, 255, 0), 1)
+        cv2.putText(frame, f'{occupancy}', (0, 25),
+                    cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2, cv2.LINE_8)
+        video.write(frame)
+    video.release()
@@ -0,0 +1,259 @@
+"""code for measuring the per-stage latency of the active mode hot path on ordinary hardware"""
+
+import json
+import itertools
+import logging
+import platform
+import tempfile
+import tracemalloc
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from copy import copy
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+from modules.data_collection import SyntheticDataCollector
+from modules.object_detection import StandInDetector
+from modules.behavior_recognition import BehaviorRecognizer
+from modules.frame_analysis import FrameAnalyzer, init_detectors
+from modules.pipeline import FramePacket
+from modules.utils import cv2_api
+logger = logging.getLogger(__name__)
+
+DEFAULT_GRID = {'resolution': [[1632, 1232], [816, 608]],
+                'roi_fraction': [0.5, 0.8],
+                'behavior_check_window': [60, 300],
+                'ooi_latency': [0.02]}
+# tracemalloc.reset_peak needs Python 3.9. On older versions only the net allocation of each stage is measured
+RESET_PEAK = hasattr(tracemalloc, 'reset_peak')
+
+
+class StageTimer:
+
+    def __init__(self):
+        """collects latency samples for named stages, or their allocations while trace_allocations is set"""
+        self.samples = defaultdict(list)
+        self.allocations = defaultdict(list)
+        self.trace_allocations = False
+
+    @contextmanager
+    def measure(self, stage):
+        if self.trace_allocations:
+            start = tracemalloc.get_traced_memory()[0]
+            if RESET_PEAK:
+                tracemalloc.reset_peak()
+            yield
+            end, peak = tracemalloc.get_traced_memory()
+            self.allocations[stage].append((peak - start if RESET_PEAK else None, end - start))
+        else:
+            t0 = perf_counter()
+            yield
+            self.samples[stage].append(perf_counter() - t0)
+
+    def add(self, stage, seconds):
+        if not self.trace_allocations:
+            self.samples[stage].append(seconds)
+
+    def summary(self):
+        """:return: dict mapping each stage to its sample count and latency percentiles (ms), plus allocations"""
+        stats = {}
+        for stage, samples in self.samples.items():
+            samples_ms = np.array(samples) * 1000
+            p50, p95, p99 = np.percentile(samples_ms, [50, 95, 99])
+            stats[stage] = {'count': len(samples), 'mean_ms': float(samples_ms.mean()), 'p50_ms': float(p50),
+                            'p95_ms': float(p95), 'p99_ms': float(p99), 'max_ms': float(samples_ms.max())}
+        for stage, allocations in self.allocations.items():
+            peaks, nets = zip(*allocations)
+            stats.setdefault(stage, {}).update({'alloc_peak_bytes': int(max(peaks)) if RESET_PEAK else None,
+                                                'alloc_mean_net_bytes': float(np.mean(nets))})
+        return stats
+
+
+class TimedDetector:
+
+    def __init__(self, detector, timer: StageTimer, stage):
+        """wraps a detector so that each detect call, and its preprocess/invoke/postprocess split, is recorded"""
+        self.detector, self.timer, self.stage = detector, timer, stage
+
+    def __getattr__(self, name):
+        return getattr(self.detector, name)
+
+    def detect(self, img, out=None):
+        t0 = perf_counter()
+        dets = self.detector.detect(img, out)
+        self.timer.add(self.stage, perf_counter() - t0)
+        for key, value in dets.timing.items():
+            self.timer.add(f'{self.stage}_{key}', value)
+        return dets
+
+
+def animal_boxes(collector: SyntheticDataCollector):
+    """:return: callable giving the boxes of the collector's moving circles in ROI crop coordinates"""
+    def boxes(img):
+        x0, y0 = collector.roi_box[:2]
+        height, width = img.shape[:2]
+        r = collector.radius
+        return [(x - x0 - r, y - y0 - r, x - x0 + r, y - y0 + r)
+                for x, y in collector.animal_positions().tolist()
+                if 0 <= x - x0 < width and 0 <= y - y0 < height]
+    return boxes
+
+
+def environment_info():
+    try:
+        from tflite_runtime import __version__ as tflite_version
+    except ImportError:
+        tflite_version = None
+    return {'platform': platform.platform(), 'machine': platform.machine(), 'cpu_count': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2_api().__version__,
+            'tflite_runtime': tflite_version}
+
+
+def benchmark_hot_path(config, resolution, roi_fraction, n_frames=200, alloc_frames=20, mp4_repeats=3,
+                       roi_samples=10, ooi_latency=0.02, busy=False, roi_detector=None, ooi_detector=None):
+    """
+    time each stage of the active mode hot path on synthetic frames, with the behavior recognizer's window already full
+    :param config: project config namespace. behavior_check_window and framegrab_interval set the buffer size
+    :param resolution: (width, height) of the synthetic frames
+    :param roi_fraction: ROI size as a fraction of the frame size
+    :param n_frames: number of timed frames
+    :param alloc_frames: number of additional frames run under tracemalloc to measure allocations
+    :param mp4_repeats: number of times thumbnails_to_mp4 is timed
+    :param roi_samples: number of full-frame ROI detections timed
+    :param ooi_latency: latency of the stand-in detectors (s), if no real detectors are given
+    :param busy: whether the stand-in detectors spin the CPU instead of sleeping
+    :param roi_detector: optional real ROI detector, timed on full frames only
+    :param ooi_detector: optional real OOI detector. Stand-ins are used when not given
+    :return: dict of settings and per-stage statistics
+    """
+    collector = SyntheticDataCollector(resolution, roi_fraction)
+    timer = StageTimer()
+    if roi_detector is None:
+        roi_detector = StandInDetector([collector.roi_box], latency=ooi_latency, busy=busy, name='roi_stand_in')
+    if ooi_detector is None:
+        ooi_detector = StandInDetector(animal_boxes(collector), latency=ooi_latency, busy=busy, name='ooi_stand_in')
+    # in steady state the ROI is cached, so the hot path uses a zero-latency locator and the real ROI detector is
+    # timed separately
+    roi_locator = StandInDetector([collector.roi_box], name='roi_locator')
+    frame_analyzer = FrameAnalyzer(config, roi_locator, TimedDetector(ooi_detector, timer, 'ooi_detect'))
+    behavior_recognizer = BehaviorRecognizer(config)
+
+    start_time = datetime.now().timestamp()
+    frame_index = 0
+
+    def run_frame():
+        nonlocal frame_index
+        timestamp = start_time + frame_index * config.framegrab_interval
+        frame_index += 1
+        t0 = perf_counter()
+        with timer.measure('capture_frame'):
+            packet = FramePacket(datetime.fromtimestamp(timestamp), collector.capture_frame())
+        with timer.measure('analyze'):
+            frame_analyzer.analyze(packet)
+        with timer.measure('thumbnail'):
+            thumbnail, boxes = frame_analyzer.make_thumbnail(packet)
+        with timer.measure('append_data'):
+            behavior_recognizer.append_data(timestamp, packet.occupancy, thumbnail, boxes)
+        with timer.measure('calc_activity_fraction'):
+            behavior_recognizer.calc_activity_fraction()
+        collector.release_frame(packet.frame)
+        elapsed = perf_counter() - t0
+        timer.add('frame_total', elapsed)
+        return elapsed
+
+    # fill the recognizer to a full window without timing, so the timed appends include eviction of old frames
+    packet = frame_analyzer.analyze(FramePacket(datetime.fromtimestamp(start_time), collector.capture_frame()))
+    thumbnail, boxes = frame_analyzer.make_thumbnail(packet)
+    collector.release_frame(packet.frame)
+    for _ in range(int(behavior_recognizer.clip_window / config.framegrab_interval) + 1):
+        behavior_recognizer.append_data(start_time + frame_index * config.framegrab_interval, packet.occupancy,
+                                        thumbnail, boxes)
+        frame_index += 1
+    timer.samples.clear()
+
+    for _ in range(roi_samples):
+        img = collector.capture_frame()
+        with timer.measure('roi_detect'):
+            roi_detector.detect(img)
+        collector.release_frame(img)
+
+    loop_time = sum(run_frame() for _ in range(n_frames))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i in range(mp4_repeats):
+            with timer.measure('thumbnails_to_mp4'):
+                behavior_recognizer.thumbnails_to_mp4(Path(tmp_dir) / f'{i}.mp4')
+
+    timer.trace_allocations = True
+    tracemalloc.start()
+    try:
+        for _ in range(alloc_frames):
+            run_frame()
+    finally:
+        tracemalloc.stop()
+        timer.trace_allocations = False
+
+    stages = timer.summary()
+    frame_p99 = stages['frame_total']['p99_ms'] / 1000
+    return {'resolution': list(resolution),
+            'roi_fraction': roi_fraction,
+            'behavior_check_window': config.behavior_check_window,
+            'framegrab_interval': config.framegrab_interval,
+            'ooi_latency': ooi_latency,
+            'n_frames': n_frames,
+            'achieved_fps': n_frames / loop_time,
+            'target_fps': 1 / config.framegrab_interval,
+            'interval_utilization_p99': frame_p99 / config.framegrab_interval,
+            'recognizer_buffer_bytes': int(behavior_recognizer.buffer_nbytes()),
+            'stages': stages}
+
+
+def run_benchmark(config, output_path, grid=None, detector='stand_in', model_dir=None, n_frames=200, busy=False):
+    """
+    benchmark the hot path at every combination of the values in grid and write the results to a json file
+    :param config: project config namespace
+    :param output_path: path of the json file to write
+    :param grid: dict mapping any of the keys in DEFAULT_GRID to a list of values to try. Missing keys use the defaults
+    :param detector: 'stand_in' for fixed latency detectors, or 'cpu' to run the config's models on tflite_runtime
+    :param model_dir: directory containing the model files, required if detector is 'cpu'
+    :param n_frames: number of timed frames per combination
+    :param busy: whether the stand-in detectors spin the CPU instead of sleeping
+    :return: list of per-combination results
+    """
+    grid = dict(DEFAULT_GRID, **(grid or {}))
+    unknown_keys = set(grid) - set(DEFAULT_GRID)
+    if unknown_keys:
+        raise ValueError(f'{sorted(unknown_keys)} cannot be benchmarked. Valid keys are {list(DEFAULT_GRID)}')
+    if detector == 'cpu':
+        roi_detector, ooi_detector = init_detectors(config, Path(model_dir), edgetpu_devices=None, cpu_workers=1)
+        grid['ooi_latency'] = [None]
+    elif detector == 'stand_in':
+        roi_detector, ooi_detector = None, None
+    else:
+        raise ValueError(f'unknown benchmark detector {detector}. Choose "stand_in" or "cpu"')
+    results = []
+    for resolution, roi_fraction, window, latency in itertools.product(grid['resolution'], grid['roi_fraction'],
+                                                                       grid['behavior_check_window'],
+                                                                       grid['ooi_latency']):
+        point_config = copy(config)
+        point_config.behavior_check_window = window
+        logger.info(f'benchmarking resolution {resolution}, roi fraction {roi_fraction}, window {window}s, '
+                    f'detector latency {latency}')
+        result = benchmark_hot_path(point_config, tuple(resolution), roi_fraction, n_frames=n_frames,
+                                    ooi_latency=latency or 0.0, busy=busy, roi_detector=roi_detector,
+                                    ooi_detector=ooi_detector)
+        result['detector'] = detector
+        logger.info(f'achieved {result["achieved_fps"]:.1f} frames/s, p99 frame time '
+                    f'{result["stages"]["frame_total"]["p99_ms"]:.1f} ms')
+        results.append(result)
+    output_path = Path(output_path)
+    output_path.parent.mkdir(exist_ok=True, parents=True)
+    with open(output_path, 'w') as f:
+        json.dump({'created': datetime.now().isoformat(), 'environment': environment_info(), 'results': results},
+                  f, indent=2)
+    logger.info(f'benchmark results written to {output_path}')
+    return results
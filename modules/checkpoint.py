@@ -0,0 +1,72 @@
+"""code for periodically saving the runtime state of active mode, so that a restarted runner can resume it"""
+
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+logger = logging.getLogger(__name__)
+
+
+class RuntimeCheckpoint:
+
+    def __init__(self, path, interval=10, max_age=600, time_func=time.time):
+        """
+        npz file of the occupancy data, notification counts, and ROI, replaced atomically on each save
+        :param path: path of the checkpoint file
+        :param interval: minimum seconds between saves. 0 disables checkpointing
+        :param max_age: checkpoints older than this many seconds are not fresh (see fresh)
+        :param time_func: returns the current time in seconds since the epoch
+        """
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + '.tmp')
+        self.interval, self.max_age = interval, max_age
+        self.time_func = time_func
+        self.last_save = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def due(self):
+        return self.enabled and (self.last_save is None or self.time_func() - self.last_save >= self.interval)
+
+    def save(self, state, arrays=None):
+        """
+        :param state: json-serializable dict of scalar state
+        :param arrays: optional dict of numpy arrays
+        """
+        now = self.time_func()
+        state = dict(state, saved_at=now)
+        with open(self.tmp_path, 'wb') as f:
+            np.savez(f, state=np.array(json.dumps(state)), **(arrays or {}))
+        os.replace(self.tmp_path, self.path)
+        self.last_save = now
+
+    def load(self):
+        """:return: (state, arrays) from the checkpoint, or None if there is no usable checkpoint"""
+        if not (self.enabled and self.path.exists()):
+            return None
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                state = json.loads(str(data['state']))
+                arrays = {key: data[key] for key in data.files if key != 'state'}
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f'ignoring unreadable checkpoint {self.path}: {e}')
+            return None
+        logger.debug(f'loaded checkpoint saved {self.time_func() - state["saved_at"]:.1f} seconds ago')
+        return state, arrays
+
+    def fresh(self, state):
+        """:return: whether a loaded state was saved no more than max_age seconds ago"""
+        return 0 <= self.time_func() - state['saved_at'] <= self.max_age
+
+    def clear(self):
+        """remove the checkpoint, e.g. once the state it holds no longer applies"""
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+        self.last_save = None
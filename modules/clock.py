@@ -0,0 +1,79 @@
+"""code for abstracting wall-clock time and sleeping, so that long runs can be simulated on a virtual clock"""
+
+import logging
+import threading
+import time
+from datetime import datetime
+
+import pause
+logger = logging.getLogger(__name__)
+
+
+class SystemClock:
+
+    def time(self):
+        """:return: current time in seconds since the epoch"""
+        return time.time()
+
+    def now(self):
+        """:return: current local time as a naive datetime"""
+        return datetime.now()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def sleep_until(self, when: datetime):
+        pause.until(when)
+
+
+SYSTEM_CLOCK = SystemClock()
+
+
+class VirtualClock:
+
+    def __init__(self, start: datetime, stop_at: datetime = None, on_stop=None, on_advance=None, min_sleep=0.001):
+        """
+        drop-in replacement for SystemClock on which sleeps return immediately, moving the time forward instead
+        :param start: initial time
+        :param stop_at: optional time at which the simulation ends. Sleeps never go past it
+        :param on_stop: optional function called (once) when the clock reaches stop_at
+        :param on_advance: optional function called with the new time (seconds since the epoch) each time it moves
+        :param min_sleep: shortest time any sleep takes, so that loops sleeping until a deadline always progress
+        """
+        self.current = start.timestamp()
+        self.stop_at = None if stop_at is None else stop_at.timestamp()
+        self.on_stop, self.on_advance = on_stop, on_advance
+        self.min_sleep = min_sleep
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def time(self):
+        with self.lock:
+            return self.current
+
+    def now(self):
+        return datetime.fromtimestamp(self.time())
+
+    def advance(self, seconds):
+        if seconds <= 0:
+            return
+        with self.lock:
+            target = self.current + seconds
+            if self.stop_at is not None:
+                target = min(target, self.stop_at)
+            self.current = max(self.current, target)
+            current = self.current
+            stop = (self.stop_at is not None) and (current >= self.stop_at) and not self.stopped
+            self.stopped = self.stopped or stop
+        if self.on_advance is not None:
+            self.on_advance(current)
+        if stop and self.on_stop is not None:
+            logger.debug('virtual clock reached its stop time')
+            self.on_stop()
+
+    def sleep(self, seconds):
+        self.advance(max(seconds, self.min_sleep))
+
+    def sleep_until(self, when: datetime):
+        self.sleep(when.timestamp() - self.time())
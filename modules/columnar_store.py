@@ -0,0 +1,141 @@
+"""code for append-only tables stored as one raw binary file per column, readable as memory-mapped NumPy arrays"""
+
+import json
+import os
+import numpy as np
+import logging
+from pathlib import Path
+
+from modules.utils import write_json_atomic
+logger = logging.getLogger(__name__)
+
+SCHEMA_FILE = 'schema.json'
+
+
+class ColumnarLog:
+
+    def __init__(self, directory, schema=None, chunk_rows=256, fsync=True):
+        """
+        append-only table with one flat binary file of fixed-size rows per column, written in chunks and read by mmap
+        :param directory: directory holding the column files and schema.json
+        :param schema: dict mapping column name to (dtype, row shape). Must match the stored schema, if there is one
+        :param chunk_rows: number of rows buffered before they are written to disk
+        :param fsync: whether to fsync the column files each time a chunk is written
+        """
+        self.directory = Path(directory)
+        self.chunk_rows = chunk_rows
+        self.fsync = fsync
+        schema_path = self.directory / SCHEMA_FILE
+        if schema_path.exists():
+            with open(schema_path, 'r') as f:
+                stored_schema = json.load(f)
+            if schema is not None and normalize_schema(schema) != stored_schema:
+                raise ValueError(f'schema for {self.directory} does not match the existing table')
+            schema = stored_schema
+        elif schema is None:
+            raise FileNotFoundError(f'no columnar table found at {self.directory}, and no schema was given')
+        else:
+            self.directory.mkdir(exist_ok=True, parents=True)
+            write_json_atomic(schema_path, normalize_schema(schema))
+        self.schema = normalize_schema(schema)
+        self.buffers = {name: np.zeros((chunk_rows, *shape), dtype=dtype)
+                        for name, (dtype, shape) in self.schema.items()}
+        self.buffered_rows = 0
+        self.persisted_rows = None
+        self.files = None
+
+    def column_path(self, name):
+        return self.directory / f'{name}.bin'
+
+    def row_bytes(self, name):
+        dtype, shape = self.schema[name]
+        return np.dtype(dtype).itemsize * int(np.prod(shape, dtype=np.int64))
+
+    def count_persisted_rows(self):
+        counts = []
+        for name in self.schema:
+            path = self.column_path(name)
+            counts.append(path.stat().st_size // self.row_bytes(name) if path.exists() else 0)
+        return min(counts)
+
+    def open_for_append(self):
+        # a crash between column writes can leave columns with different lengths, so trim back to the last full row
+        self.persisted_rows = self.count_persisted_rows()
+        self.files = {}
+        for name in self.schema:
+            f = open(self.column_path(name), 'ab')
+            f.truncate(self.persisted_rows * self.row_bytes(name))
+            self.files[name] = f
+
+    def append(self, **row):
+        """add one row. Every column must be given a value that broadcasts to that column's row shape"""
+        i = self.buffered_rows
+        for name, buffer in self.buffers.items():
+            buffer[i] = row[name]
+        self.buffered_rows += 1
+        if self.buffered_rows == self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered_rows:
+            return
+        if self.files is None:
+            self.open_for_append()
+        for name, f in self.files.items():
+            f.write(self.buffers[name][:self.buffered_rows].tobytes())
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        self.persisted_rows += self.buffered_rows
+        self.buffered_rows = 0
+
+    def close(self):
+        self.flush()
+        if self.files is not None:
+            for f in self.files.values():
+                f.close()
+            self.files = None
+
+    def __len__(self):
+        persisted = self.count_persisted_rows() if self.persisted_rows is None else self.persisted_rows
+        return persisted + self.buffered_rows
+
+    def read(self, mmap=True):
+        """
+        :param mmap: if True, columns are read-only memory maps of the files on disk. Otherwise they are loaded
+        :return: dict mapping column name to an array of every persisted row. Buffered rows are not included
+        """
+        return read_columns(self.directory, mmap)
+
+
+def normalize_schema(schema):
+    return {name: [np.dtype(dtype).str, [int(n) for n in np.atleast_1d(shape)] if shape else []]
+            for name, (dtype, shape) in schema.items()}
+
+
+def read_columns(directory, mmap=True):
+    """
+    read a table written by ColumnarLog
+    :param directory: table directory
+    :param mmap: if True, columns are read-only memory maps of the files on disk. Otherwise they are loaded
+    :return: dict mapping column name to an array with one entry per row
+    """
+    directory = Path(directory)
+    with open(directory / SCHEMA_FILE, 'r') as f:
+        schema = json.load(f)
+    columns = {}
+    for name, (dtype, shape) in schema.items():
+        path = directory / f'{name}.bin'
+        row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape, dtype=np.int64))
+        columns[name] = (path, dtype, tuple(shape), path.stat().st_size // row_bytes if path.exists() else 0)
+    n_rows = min(entry[3] for entry in columns.values())
+    arrays = {}
+    for name, (path, dtype, shape, _) in columns.items():
+        if n_rows == 0:
+            arrays[name] = np.zeros((0, *shape), dtype=dtype)
+        elif mmap:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', shape=(n_rows, *shape))
+        else:
+            arrays[name] = np.fromfile(path, dtype=dtype, count=n_rows * int(np.prod(shape, dtype=np.int64)))
+            arrays[name] = arrays[name].reshape((n_rows, *shape))
+    return arrays
@@ -1,11 +1,98 @@
 """code for reading and writing project parameters"""
 
+import os
+import time
 import yaml
+from numbers import Number
 from types import SimpleNamespace
 import logging
 import pathlib
 logger = logging.getLogger(__name__)
 
+# how a running Runner applies an edit to each parameter (see Runner.apply_config_changes). Hot parameters are applied
+# between two frames by updating the components that use them. Rebuild parameters replace the components that use
+# them (named here), carrying their state over. Any other parameter only takes effect after a restart, since changing it
+# means reopening the camera, reloading the models, or restarting the pipeline, uploader, or logs
+HOT_PARAMETERS = ('min_notification_interval', 'max_notifications_per_day', 'roi_confidence_thresh',
+                  'ooi_confidence_thresh', 'behavior_check_interval', 'behavior_min_individuals_roi',
+                  'behavior_max_individuals_roi', 'behavior_min_fraction_for_notification', 'thumbnail_jpeg_quality',
+                  'roi_update_interval', 'roi_drift_thresh', 'roi_drift_check_interval', 'roi_drift_confirm_checks',
+                  'roi_retry_initial', 'roi_retry_max', 'start_hour', 'end_hour', 'video_split_hours',
+                  'checkpoint_interval', 'checkpoint_max_age', 'startup_budget', 'config_poll_interval',
+                  'storage_check_interval', 'storage_reserve_mb', 'storage_upload_hours', 'storage_degrade_hours',
+                  'storage_evict_hours', 'storage_low_bitrate', 'storage_low_scale', 'resource_check_interval',
+                  'resource_sensor_root', 'resource_temp_high', 'resource_temp_low', 'resource_load_high',
+                  'resource_load_low', 'resource_memory_low', 'resource_memory_high', 'resource_adjust_interval',
+                  'resource_recovery_time', 'resource_thumbnail_scale', 'resource_ooi_stride',
+                  'resource_max_interval_factor', 'test')
+REBUILD_PARAMETERS = {'behavior_check_window': ('behavior_recognizer',),
+                      'clip_window': ('behavior_recognizer',),
+                      'thumbnail_format': ('behavior_recognizer',),
+                      # the behavior buffer is sized in frames, so it must grow when frames come faster
+                      'framegrab_interval': ('scheduler', 'behavior_recognizer'),
+                      'framegrab_policy': ('scheduler',),
+                      'framegrab_adaptive': ('scheduler',),
+                      'framegrab_max_interval': ('scheduler',),
+                      'framegrab_adapt_window': ('scheduler',),
+                      'motion_gate_enabled': ('motion_gate',),
+                      'motion_gate_change_thresh': ('motion_gate',),
+                      'motion_gate_pixel_thresh': ('motion_gate',),
+                      'motion_gate_max_skip': ('motion_gate',)}
+
+# inclusive (min, max) bounds on the values of hot and rebuild parameters, checked before an edit is applied. None
+# means unbounded. The parameters in POSITIVE_PARAMETERS must also be above 0, since they are divided by or waited on
+PARAMETER_RANGES = {'min_notification_interval': (0, None), 'max_notifications_per_day': (0, None),
+                    'roi_confidence_thresh': (0, 1), 'ooi_confidence_thresh': (0, 1),
+                    'behavior_min_individuals_roi': (0, None), 'behavior_max_individuals_roi': (0, None),
+                    'behavior_min_fraction_for_notification': (0, 1), 'thumbnail_jpeg_quality': (0, 100),
+                    'roi_drift_thresh': (-1, 1), 'roi_drift_check_interval': (0, None),
+                    'roi_drift_confirm_checks': (1, None), 'start_hour': (0, 23), 'end_hour': (0, 23),
+                    'checkpoint_interval': (0, None), 'checkpoint_max_age': (0, None), 'startup_budget': (0, None),
+                    'config_poll_interval': (0, None), 'storage_check_interval': (0, None),
+                    'storage_reserve_mb': (0, None), 'storage_upload_hours': (0, None),
+                    'storage_degrade_hours': (0, None), 'storage_evict_hours': (0, None),
+                    'storage_low_scale': (0, 1), 'resource_check_interval': (0, None),
+                    'resource_load_high': (0, None), 'resource_load_low': (0, None), 'resource_memory_low': (0, 1),
+                    'resource_memory_high': (0, 1), 'resource_adjust_interval': (0, None),
+                    'resource_recovery_time': (0, None), 'resource_thumbnail_scale': (1, None),
+                    'resource_ooi_stride': (1, None), 'resource_max_interval_factor': (1, None),
+                    'framegrab_adapt_window': (1, None), 'motion_gate_change_thresh': (0, 1),
+                    'motion_gate_pixel_thresh': (0, 255), 'motion_gate_max_skip': (0, None)}
+POSITIVE_PARAMETERS = ('framegrab_interval', 'framegrab_max_interval', 'behavior_check_window',
+                       'behavior_check_interval', 'clip_window', 'video_split_hours', 'roi_update_interval',
+                       'roi_retry_initial', 'roi_retry_max', 'storage_low_bitrate', 'storage_low_scale')
+
+
+def classify_parameter(key):
+    """:return: 'hot', 'rebuild', or 'restart', depending on how a change to the parameter can be applied"""
+    if key in HOT_PARAMETERS:
+        return 'hot'
+    if key in REBUILD_PARAMETERS:
+        return 'rebuild'
+    return 'restart'
+
+
+def same_kind(value, reference):
+    """whether value has a type that can stand in for reference's, e.g. an int for a float but not a bool or str"""
+    if isinstance(reference, bool) or isinstance(value, bool):
+        return isinstance(value, bool) and isinstance(reference, bool)
+    if isinstance(reference, Number):
+        return isinstance(value, Number)
+    if isinstance(reference, (list, tuple)):
+        return isinstance(value, (list, tuple))
+    return isinstance(value, type(reference))
+
+
+def check_range(key, value):
+    """:raises ValueError: if value is a number outside the range allowed for key (see PARAMETER_RANGES)"""
+    if value is None or isinstance(value, bool) or not isinstance(value, Number):
+        return
+    if key in POSITIVE_PARAMETERS and value <= 0:
+        raise ValueError(f'"{key}" should be above 0, got {value!r}')
+    low, high = PARAMETER_RANGES.get(key, (None, None))
+    if (low is not None and value < low) or (high is not None and value > high):
+        raise ValueError(f'"{key}" should be between {low} and {"any" if high is None else high}, got {value!r}')
+
 class ConfigManager:
 
     def __init__(self, config_path: pathlib.Path):
@@ -24,6 +111,8 @@ class ConfigManager:
             self.load_config()
         else:
             self.config = None
+        self.poll_interval, self.time_func = None, time.time
+        self.next_poll, self.file_signature = 0, None
         logger.info('ConfigManager successfully initialized')
 
     def load_config(self):
@@ -34,6 +123,12 @@ class ConfigManager:
 
     def check_config(self):
         updated = False
+        for key, value in self.default_config().items():
+            if key not in self.config:
+                logger.info(f'config parameter "{key}" missing, probably because the config predates it. '
+                            f'Setting to default value {value}')
+                self.config[key] = value
+                updated = True
         if self.config['h_resolution'] % 32:
             new_h_resolution = self.config['h_resolution'] - (self.config['h_resolution'] % 32)
             logger.warning(f'horizontal resolution must be a multiple of 32. Updated to {new_h_resolution}')
@@ -44,19 +139,101 @@ class ConfigManager:
             logger.warning(f'vertical resolution must be a multiple of 32. Updated to {new_v_resolution}')
             self.config['h_resolution'] = new_v_resolution
             updated = True
+        if self.config['analysis_h_resolution'] and self.config['analysis_h_resolution'] % 32:
+            new_h_resolution = self.config['analysis_h_resolution'] - (self.config['analysis_h_resolution'] % 32)
+            logger.warning(f'horizontal analysis resolution must be a multiple of 32. Updated to {new_h_resolution}')
+            self.config['analysis_h_resolution'] = new_h_resolution
+            updated = True
+        if self.config['analysis_v_resolution'] and self.config['analysis_v_resolution'] % 16:
+            new_v_resolution = self.config['analysis_v_resolution'] - (self.config['analysis_v_resolution'] % 16)
+            logger.warning(f'vertical analysis resolution must be a multiple of 16. Updated to {new_v_resolution}')
+            self.config['analysis_v_resolution'] = new_v_resolution
+            updated = True
         if updated:
             self.write_config()
         else:
             logger.debug('config passed all checks')
 
+    def watch(self, poll_interval=2, time_func=time.time):
+        """
+        start polling the config file's modification time for edits (see poll_changes)
+        :param poll_interval: minimum seconds between checks of the file. 0 disables watching
+        :param time_func: returns the current time in seconds
+        """
+        self.poll_interval, self.time_func = poll_interval, time_func
+        self.next_poll = time_func() + poll_interval
+        self.file_signature = self.read_file_signature()
+        if poll_interval:
+            logger.debug(f'watching {self.config_path} for changes every {poll_interval} seconds')
+
+    def read_file_signature(self):
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def poll_changes(self):
+        """
+        check, at most once per poll interval, for valid edits to the config file. The caller accepts them once applied
+        :return: dict mapping each changed parameter to its new value. Empty if nothing (valid) changed
+        """
+        if not self.poll_interval:
+            return {}
+        now = self.time_func()
+        if now < self.next_poll:
+            return {}
+        self.next_poll = now + self.poll_interval
+        signature = self.read_file_signature()
+        if signature is None or signature == self.file_signature:
+            return {}
+        self.file_signature = signature
+        try:
+            with open(str(self.config_path), 'r') as f:
+                new_config = yaml.safe_load(f)
+            changes = self.validate_changes(new_config)
+        except (OSError, yaml.YAMLError, ValueError) as e:
+            logger.warning(f'ignoring edit to {self.config_path}: {e}')
+            return {}
+        if changes:
+            logger.info(f'config edit detected: {changes}')
+        return changes
+
+    def validate_changes(self, new_config):
+        """
+        :return: dict of the parameters in new_config whose values differ from the current config
+        :raises ValueError: if new_config is not a mapping, or any changed value has the wrong type or is out of range
+        """
+        if not isinstance(new_config, dict):
+            raise ValueError('the file does not contain a mapping of parameters to values')
+        defaults = self.default_config()
+        changes = {}
+        for key, value in new_config.items():
+            if key not in defaults:
+                logger.warning(f'ignoring unknown config parameter "{key}"')
+                continue
+            current = self.config.get(key)
+            if value == current:
+                continue
+            reference = current if current is not None else defaults[key]
+            if value is not None and reference is not None and not same_kind(value, reference):
+                raise ValueError(f'"{key}" should be a {type(reference).__name__}, got {value!r}')
+            check_range(key, value)
+            changes[key] = value
+        return changes
+
+    def accept_changes(self, changes):
+        """record changes that were applied, so that later edits are compared against them"""
+        self.config.update(changes)
+
     def write_config(self):
         self.config_path.parent.mkdir(exist_ok=True, parents=True)
         with open(str(self.config_path), 'w') as f:
             yaml.dump(self.config, f)
         logger.debug(f'config written to {self.config_path}')
 
-    def generate_new_config(self):
-        config = {
+    def default_config(self):
+        return {
             'project_id': self.config_path.parent.name,
             'cloud_data_dir': None,   # cloud path, including the rclone remote, where the project will be stored
             'user_email': None,
@@ -65,26 +242,95 @@ class ConfigManager:
             'sendgrid_from_email': None,
             'min_notification_interval': 600,
             'max_notifications_per_day': 20,
+            'notification_transport': 'sendgrid',   # 'sendgrid', or 'http' to post to notification_http_url
+            'notification_http_url': None,
+            'notification_max_attempts': 5,         # send attempts per notification before it is given up on
             'roi_model': 'roi.tflite',
             'ooi_model': 'ooi.tflite',
             'roi_confidence_thresh': 0.75,
             'ooi_confidence_thresh': 0.25,
+            'roi_cpu_model': None,       # non-Edge TPU version of roi_model, used by any CPU detector workers
+            'ooi_cpu_model': None,       # non-Edge TPU version of ooi_model, used by any CPU detector workers
+            'edgetpu_devices': 'all',    # 'all', a list of Edge TPU device strings (e.g. [':0', ':1']), or None
+            'cpu_detector_workers': 0,   # number of CPU tflite interpreters per model, in addition to Edge TPUs
+            'cpu_detector_threads': 1,   # threads per CPU tflite interpreter
             'behavior_check_window': 60,         # length of the window analyzed (in seconds) at each behavior check
             'behavior_check_interval': 30,       # seconds between behavior checks
             'behavior_min_individuals_roi': 2,   # min number of individuals in ROI during behavior event
             'behavior_max_individuals_roi': 3,   # max number of individuals in ROI during behavior event
             'behavior_min_fraction_for_notification': 0.25,
+            'clip_window': None,                 # seconds of footage in event clips (None = behavior_check_window)
+            'thumbnail_format': 'jpeg',          # 'jpeg' or 'raw' storage of the thumbnails kept for event clips
+            'thumbnail_jpeg_quality': 75,        # jpeg quality (0-100) of stored thumbnails
             'framerate': 30,
+            'camera_num': 0,             # camera to record from, on boards with more than one camera connector
             'h_resolution': 1632,
             'v_resolution': 1232,
+            'analysis_h_resolution': None,   # if set (with analysis_v_resolution), frames are analyzed at this size
+            'analysis_v_resolution': None,
             'framegrab_interval': 0.2,
-            'roi_update_interval': 600,
+            'framegrab_policy': 'skip',        # 'skip' or 'catch_up' when framegrabs fall a full interval behind
+            'framegrab_adaptive': False,       # raise the framegrab interval automatically under sustained overload
+            'framegrab_max_interval': None,    # upper limit on the adaptive interval (default 4x framegrab_interval)
+            'framegrab_adapt_window': 50,      # framegrabs averaged before the adaptive interval can change
+            'roi_update_interval': 600,        # max seconds between ROI detections, even if no drift is detected
+            'roi_drift_thresh': 0.5,           # ROI border correlation below which the ROI may have moved
+            'roi_drift_check_interval': 5,     # frames between ROI border checks (0 to disable)
+            'roi_drift_confirm_checks': 3,     # consecutive failed border checks before the ROI is re-detected
+            'roi_retry_initial': 1,            # seconds before retrying a failed ROI detection, doubling each failure
+            'roi_retry_max': 60,               # max seconds between retries of failed ROI detections
+            'motion_gate_enabled': False,       # skip OOI inference on frames where the ROI has barely changed
+            'motion_gate_change_thresh': 0.02,  # fraction of ROI pixels that must change to trigger a new inference
+            'motion_gate_pixel_thresh': 15,     # min grayscale difference (0-255) for a pixel to count as changed
+            'motion_gate_max_skip': 10,         # max consecutive frames that can reuse the previous occupancy
             'start_hour': 7,
             'end_hour': 19,
             'video_split_hours': 3,
+            'conversion_workers': 1,           # max concurrent background h264 to mp4 conversions
+            'conversion_niceness': 19,         # niceness of conversion processes (0-19), also sets idle io priority
+            'conversion_max_attempts': 3,      # conversion attempts per video before it is left as h264
+            'rclone_binary': 'rclone',         # rclone executable used for uploads
+            'upload_workers': 2,               # files uploaded at the same time
+            'upload_bwlimit_kbps': None,       # total upload bandwidth limit (KiB/s) during passive mode
+            'upload_max_attempts': 3,          # attempts per file before an upload is given up on until the next day
+            'upload_trickle_kbps': None,       # if set, upload converted videos during active mode within this budget
+            'pipeline_enabled': False,          # run capture, inference, and behavior analysis in separate threads
+            'pipeline_queue_size': 2,           # max frames waiting in front of each pipeline stage
+            'pipeline_drop_policy': 'drop_oldest',  # 'drop_oldest' or 'block' when the inference queue is full
+            'detection_log_enabled': True,      # log every frame's ROI, detections, and occupancy to the project dir
+            'detection_log_chunk_rows': 300,    # frames buffered between writes (and fsyncs) of the detection log
+            'metrics_enabled': False,           # collect counters and latency histograms for each stage
+            'metrics_flush_interval': 60,       # seconds between writes of metrics.json (0 to disable)
+            'metrics_http_port': None,          # if set, serve metrics at http://127.0.0.1:<port>/metrics
+            'checkpoint_interval': 10,          # seconds between saves of the runtime state (0 to disable)
+            'checkpoint_max_age': 600,          # occupancy data and ROI older than this (in seconds) are not restored
+            'startup_budget': 5,                # seconds from launch to the first frame before a warning is logged
+            'config_poll_interval': 2,          # seconds between checks of this file for edits (0 to disable)
+            'storage_check_interval': 60,       # seconds between predictions of when the disk fills (0 to disable)
+            'storage_reserve_mb': 1024,         # free disk space (MB) never planned to be used
+            'storage_upload_hours': 12,         # upload during active mode if the disk would fill within this
+            'storage_degrade_hours': 6,         # lower the recording quality if the disk would fill within this
+            'storage_evict_hours': 1,           # delete old non-event videos if the disk would fill within this
+            'storage_low_bitrate': 4000000,     # h264 bitrate (bits/s) while recording quality is lowered
+            'storage_low_scale': 1.0,           # recording resolution scale while quality is lowered (1 to keep it)
+            'resource_check_interval': 10,      # seconds between CPU temperature/load/memory readings (0 to disable)
+            'resource_sensor_root': '/',        # directory holding the sys and proc files read (for stand-ins)
+            'resource_temp_high': 75,           # CPU temperature (C) above which the analysis load is lowered
+            'resource_temp_low': 65,            # CPU temperature (C) below which the analysis load may be restored
+            'resource_load_high': 1.0,          # load average per core above which the analysis load is lowered
+            'resource_load_low': 0.7,           # load average per core below which the analysis load may be restored
+            'resource_memory_low': 0.1,         # fraction of memory available below which the load is lowered
+            'resource_memory_high': 0.2,        # fraction of memory available above which the load may be restored
+            'resource_adjust_interval': 60,     # min seconds between two steps down in analysis load
+            'resource_recovery_time': 300,      # seconds of normal readings before each step back up
+            'resource_thumbnail_scale': 8,      # thumbnail downscale factor under pressure (normally 4)
+            'resource_ooi_stride': 2,           # under pressure, OOI detection runs on every nth frame
+            'resource_max_interval_factor': 3,  # max multiple of framegrab_interval under pressure
             'test': False   # Currently unused
             }
-        self.config = config
+
+    def generate_new_config(self):
+        self.config = self.default_config()
         logger.debug('new config generated')
         self.write_config()
 
@@ -1,26 +1,100 @@
 """code for collecting basic video data and storing it locally on the raspberry pi"""
 
-import picamera
 import numpy as np
 import datetime
-import cv2
 import logging
+import threading
+import time
 logger = logging.getLogger(__name__)
 from time import sleep
 
+from modules.metrics import NULL_METRICS
+from modules.video_index import IndexedOutput
+from modules.utils import cv2_api
+
+RECORDING_BITRATE = 17000000  # picamera's default h264 bitrate, in bits per second
+
+# picamera is only available on the raspberry pi. MockDataCollector works without it
+try:
+    import picamera
+except ImportError:
+    picamera = None
+
+
+class FramePool:
+
+    def __init__(self, shape, size=4):
+        """
+        preallocated frame buffers, checked out by capture_frame and returned once the frame is analyzed
+        :param shape: shape of each buffer, as (height, width, channels)
+        :param size: number of buffers to preallocate. If they are all checked out, the pool grows by one buffer
+        """
+        self.shape = tuple(shape)
+        self.buffers = {}
+        self.free = []
+        self.lock = threading.Lock()
+        for _ in range(size):
+            self.free.append(self.allocate())
+        logger.debug(f'frame pool allocated with {size} buffers of shape {self.shape}')
+
+    def allocate(self):
+        buffer = np.zeros(self.shape, dtype=np.uint8)
+        self.buffers[id(buffer)] = buffer
+        return buffer
+
+    def acquire(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+            buffer = self.allocate()
+        logger.debug(f'frame pool exhausted. Grew pool to {len(self.buffers)} buffers')
+        return buffer
+
+    def release(self, buffer):
+        with self.lock:
+            if id(buffer) not in self.buffers:
+                logger.warning('attempted to release a buffer that does not belong to this frame pool. Ignoring')
+            elif any(buffer is b for b in self.free):
+                logger.warning('attempted to release a frame pool buffer twice. Ignoring')
+            else:
+                self.free.append(buffer)
+
+    def checked_out(self):
+        return len(self.buffers) - len(self.free)
+
 
 class DataCollector:
 
-    def __init__(self, video_dir, picamera_kwargs=None):
+    def __init__(self, video_dir, picamera_kwargs=None, analysis_resolution=None, frame_pool_size=4, metrics=None,
+                 time_func=time.time):
+        """
+        :param analysis_resolution: optional (width, height) the video port resizes frames to for analysis
+        :param frame_pool_size: number of preallocated frame buffers
+        :param metrics: optional Metrics to record capture latency and frame pool usage to
+        :param time_func: returns the current time in seconds since the epoch, used to name and index segments
+        """
         logger.debug('Beginning data collector initialization')
+        self.metrics = metrics or NULL_METRICS
+        self.time_func = time_func
         self.picamera_kwargs = picamera_kwargs
         self.video_dir = video_dir
         self.video_dir.mkdir(exist_ok=True, parents=True)
+        self.h264_path = None
+        self.output = None
+        # h264 encoder options (e.g. bitrate, resize) passed to the camera when recording starts
+        self.recording_options, self.pending_options = {}, None
         self.cam = self.init_camera(picamera_kwargs)
         self.resolution = self.cam.resolution
+        self.analysis_resolution = tuple(analysis_resolution) if analysis_resolution else None
+        capture_resolution = self.analysis_resolution or tuple(self.resolution)
+        logger.debug(f'frames will be captured for analysis at {capture_resolution}')
+        self.frame_pool = FramePool((capture_resolution[1], capture_resolution[0], 3), frame_pool_size)
+        self.metrics.add_collector(self.collect_metrics)
         logger.info('DataCollector successfully initialized')
 
     def init_camera(self, picamera_kwargs):
+        if picamera is None:
+            raise ImportError('picamera must be installed to collect data from a camera')
         if picamera_kwargs:
             cam = picamera.PiCamera(**picamera_kwargs)
         else:
@@ -29,34 +103,79 @@ class DataCollector:
         return cam
 
     def generate_h264_path(self):
-        iso_string = datetime.datetime.now().isoformat(timespec='seconds').replace(':', '_')
+        iso_string = datetime.datetime.fromtimestamp(self.time_func()).isoformat(timespec='seconds').replace(':', '_')
         return self.video_dir / f'{iso_string}.h264'
 
     def start_recording(self):
         if self.cam.closed:
             logger.debug('reinitializing camera from scratch')
             self.cam = self.init_camera(self.picamera_kwargs)
-        self.cam.start_recording(str(self.generate_h264_path()))
+        self.h264_path = self.generate_h264_path()
+        # recordings are written through an IndexedOutput, which keeps a timestamp index of each segment's keyframes
+        self.output = IndexedOutput(self.h264_path, self.cam, self.time_func)
+        if self.pending_options is not None:
+            self.recording_options, self.pending_options = self.pending_options, None
+        self.cam.start_recording(self.output, format='h264', **self.recording_options)
         sleep(2)
         logger.info('recording started')
 
+    def set_recording_options(self, **options):
+        """change the h264 encoder options (e.g. bitrate, resize) from the next split on, or restore the defaults"""
+        if options != (self.recording_options if self.pending_options is None else self.pending_options):
+            self.pending_options = options
+            logger.info(f'recording options will change to {options or "the defaults"} at the next split')
+
     def split_recording(self):
-        self.cam.split_recording(str(self.generate_h264_path()))
+        """:return: path of the segment that was just closed"""
+        closed_path, self.h264_path = self.h264_path, self.generate_h264_path()
+        closed_output, self.output = self.output, IndexedOutput(self.h264_path, self.cam, self.time_func)
+        if self.pending_options is None:
+            self.cam.split_recording(self.output)
+        else:
+            # encoder settings cannot change mid-recording, so the recording restarts with them instead. The camera
+            # stays open and settled, so the gap is a fraction of a second
+            self.recording_options, self.pending_options = self.pending_options, None
+            self.cam.stop_recording()
+            self.cam.start_recording(self.output, format='h264', **self.recording_options)
+            logger.debug(f'recording restarted with options {self.recording_options}')
+        closed_output.close()
+        self.metrics.increment('recording_splits')
         logger.info('recording split')
+        return closed_path
 
     def stop_recording(self):
+        """:return: path of the segment that was just closed"""
         self.cam.stop_recording()
+        self.output.close()
+        self.output = None
+        closed_path, self.h264_path = self.h264_path, None
         logger.info('recording stopped')
+        return closed_path
 
     def capture_frame(self):
-        image = np.zeros((self.resolution[1], self.resolution[0], 3), dtype=np.uint8)
-        self.cam.capture(image, format='rgb', use_video_port=True)
+        """capture a frame into a pooled buffer. The caller must hand the buffer back with release_frame"""
+        image = self.frame_pool.acquire()
+        try:
+            with self.metrics.timer('capture_frame'):
+                self.cam.capture(image, format='rgb', use_video_port=True, resize=self.analysis_resolution)
+        except Exception:
+            self.frame_pool.release(image)
+            raise
         return image
 
+    def release_frame(self, image):
+        self.frame_pool.release(image)
+
+    def collect_metrics(self, metrics):
+        metrics.set_gauge('frame_pool_size', len(self.frame_pool.buffers))
+        metrics.set_gauge('frame_pool_checked_out', self.frame_pool.checked_out())
+
     def shutdown(self):
+        """:return: path of the segment closed by the shutdown, or None if the camera was not recording"""
         logger.debug('shutting down DataCollector')
+        closed_path = None
         try:
-            self.stop_recording()
+            closed_path = self.stop_recording()
             sleep(1)
         except picamera.PiCameraNotRecording:
             logger.debug('Could not stop recording because camera was not recording. Skipping.')
@@ -65,33 +184,51 @@ class DataCollector:
         if not self.cam.closed:
             logger.warning('camera object may not have closed correctly. Expected self.cam.closed==True, got False')
         logger.info('DataCollector shutdown complete')
+        return closed_path
 
 
 class MockDataCollector:
 
-    def __init__(self, source_video, framegrab_interval):
+    def __init__(self, source_video, framegrab_interval, analysis_resolution=None, frame_pool_size=4):
         logger.debug('Beginning MockDataCollector initialization')
         self.source_video = source_video
+        cv2 = cv2_api()
         self.cap = cv2.VideoCapture(str(self.source_video))
         self.resolution = (int(self.cap.get(3)), int(self.cap.get(4)))
         self.framerate = int(self.cap.get(cv2.CAP_PROP_FPS))
-        self.framestep = int(self.framerate * framegrab_interval)
+        self.framestep = max(1, int(self.framerate * framegrab_interval))
         self.current_frame = 0
+        self.analysis_resolution = tuple(analysis_resolution) if analysis_resolution else None
+        capture_resolution = self.analysis_resolution or self.resolution
+        self.decode_buffer = np.zeros((self.resolution[1], self.resolution[0], 3), dtype=np.uint8)
+        self.frame_pool = FramePool((capture_resolution[1], capture_resolution[0], 3), frame_pool_size)
         logger.info('MockDataCollector successfully initialized')
 
     def capture_frame(self):
-        ret, img = self.cap.read()
-        self.current_frame += 1
-        if not ret:
-            self.cap.release()
-            return False
-        while self.current_frame % self.framestep:
-            ret, img = self.cap.read()
+        # frames between framegrabs are only grabbed, not decoded
+        while True:
+            ret = self.cap.grab()
             self.current_frame += 1
             if not ret:
                 self.cap.release()
                 return False
-        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            if not self.current_frame % self.framestep:
+                break
+        ret, _ = self.cap.retrieve(self.decode_buffer)
+        if not ret:
+            self.cap.release()
+            return False
+        image = self.frame_pool.acquire()
+        cv2 = cv2_api()
+        if self.analysis_resolution:
+            cv2.cvtColor(self.decode_buffer, cv2.COLOR_BGR2RGB, dst=self.decode_buffer)
+            cv2.resize(self.decode_buffer, self.analysis_resolution, dst=image, interpolation=cv2.INTER_AREA)
+        else:
+            cv2.cvtColor(self.decode_buffer, cv2.COLOR_BGR2RGB, dst=image)
+        return image
+
+    def release_frame(self, image):
+        self.frame_pool.release(image)
 
     def shutdown(self):
         self.cap.release()
@@ -109,4 +246,76 @@ class MockDataCollector:
         pass
 
     def split_recording(self):
-        pass
\ No newline at end of file
+        pass
+
+    def set_recording_options(self, **options):
+        pass
+
+
+class SyntheticDataCollector:
+
+    def __init__(self, resolution=(1632, 1232), roi_fraction=0.5, n_animals=3, frame_pool_size=4, seed=0):
+        """
+        stand-in for DataCollector that draws a green ROI rectangle and a few moving circles instead of reading a camera
+        :param resolution: (width, height) of the generated frames
+        :param roi_fraction: width and height of the ROI as a fraction of the frame's
+        :param n_animals: number of moving circles
+        :param frame_pool_size: number of preallocated frame buffers
+        :param seed: random seed for the circles' paths
+        """
+        logger.debug('Beginning SyntheticDataCollector initialization')
+        self.resolution = tuple(resolution)
+        width, height = self.resolution
+        roi_w, roi_h = int(width * roi_fraction), int(height * roi_fraction)
+        self.roi_box = ((width - roi_w) // 2, (height - roi_h) // 2, (width + roi_w) // 2, (height + roi_h) // 2)
+        self.background = np.full((height, width, 3), 90, dtype=np.uint8)
+        cv2 = cv2_api()
+        cv2.rectangle(self.background, self.roi_box[:2], self.roi_box[2:], (0, 255, 0), max(2, width // 200))
+        rng = np.random.default_rng(seed)
+        self.phases = rng.uniform(0, 2 * np.pi, (n_animals, 2))
+        self.speeds = rng.uniform(0.02, 0.1, (n_animals, 2))
+        self.radius = max(4, width // 60)
+        self.current_frame = 0
+        self.frame_pool = FramePool((height, width, 3), frame_pool_size)
+        self.video_dir = None
+        logger.info('SyntheticDataCollector successfully initialized')
+
+    def animal_positions(self):
+        width, height = self.resolution
+        t = self.current_frame
+        xs = (0.5 + 0.45 * np.sin(self.phases[:, 0] + self.speeds[:, 0] * t)) * width
+        ys = (0.5 + 0.45 * np.sin(self.phases[:, 1] + self.speeds[:, 1] * t)) * height
+        return np.stack([xs, ys], axis=1).astype(int)
+
+    def capture_frame(self):
+        image = self.frame_pool.acquire()
+        image[...] = self.background
+        cv2 = cv2_api()
+        for x, y in self.animal_positions().tolist():
+            cv2.circle(image, (x, y), self.radius, (200, 120, 40), -1)
+        self.current_frame += 1
+        return image
+
+    def release_frame(self, image):
+        self.frame_pool.release(image)
+
+    def shutdown(self):
+        pass
+
+    def start_recording(self):
+        pass
+
+    def stop_recording(self):
+        pass
+
+    def init_camera(self):
+        pass
+
+    def generate_h264_path(self):
+        pass
+
+    def split_recording(self):
+        pass
+
+    def set_recording_options(self, **options):
+        pass
@@ -0,0 +1,121 @@
+"""code for persisting detector outputs so that recorded videos can be re-analyzed without re-running inference"""
+
+import numpy as np
+import logging
+from pathlib import Path
+
+from modules.columnar_store import ColumnarLog
+from modules.object_detection import Detections
+logger = logging.getLogger(__name__)
+
+
+class CacheTable:
+
+    def __init__(self, directory, max_detections=25, chunk_rows=256):
+        """
+        detections from one model, at one confidence threshold, for one video
+        :param directory: table directory
+        :param max_detections: maximum number of detections stored per frame
+        :param chunk_rows: number of entries buffered before they are written to disk
+        """
+        self.max_detections = max_detections
+        schema = {'frame_index': ('int64', ()),
+                  'input_box': ('int32', (4,)),   # region of the frame passed to the detector (xmin, ymin, xmax, ymax)
+                  'count': ('int16', ()),
+                  'boxes': ('int32', (max_detections, 4)),
+                  'scores': ('float32', (max_detections,)),
+                  'class_ids': ('int32', (max_detections,))}
+        self.log = ColumnarLog(directory, schema, chunk_rows=chunk_rows)
+        self.columns = self.log.read()
+        self.index = {int(frame_index): row for row, frame_index in enumerate(self.columns['frame_index'])}
+        self.row_boxes = np.zeros((max_detections, 4), dtype=np.int32)
+        self.row_scores = np.zeros(max_detections, dtype=np.float32)
+        self.row_class_ids = np.zeros(max_detections, dtype=np.int32)
+
+    def lookup(self, frame_index, input_box):
+        row = self.index.get(frame_index)
+        if row is None or not np.array_equal(self.columns['input_box'][row], input_box):
+            return None
+        count = int(self.columns['count'][row])
+        dets = Detections(max(count, 1))
+        dets.boxes[:count] = self.columns['boxes'][row, :count]
+        dets.scores[:count] = self.columns['scores'][row, :count]
+        dets.class_ids[:count] = self.columns['class_ids'][row, :count]
+        dets.count = count
+        return dets
+
+    def store(self, frame_index, input_box, dets: Detections):
+        count = min(len(dets), self.max_detections)
+        self.row_boxes[:count] = dets.boxes[:count]
+        self.row_boxes[count:] = 0
+        self.row_scores[:count] = dets.scores[:count]
+        self.row_scores[count:] = 0
+        self.row_class_ids[:count] = dets.class_ids[:count]
+        self.row_class_ids[count:] = 0
+        self.log.append(frame_index=frame_index, input_box=input_box, count=count, boxes=self.row_boxes,
+                        scores=self.row_scores, class_ids=self.row_class_ids)
+
+    def close(self):
+        self.log.close()
+
+
+class DetectionCache:
+
+    def __init__(self, cache_dir, max_detections=25, chunk_rows=256):
+        """
+        on-disk store of detector outputs, with one columnar table per (video, model hash, confidence threshold)
+        :param cache_dir: root directory of the cache
+        :param max_detections: maximum number of detections stored per frame
+        :param chunk_rows: number of entries buffered before they are written to disk
+        """
+        logger.debug('Beginning DetectionCache initialization')
+        self.cache_dir = Path(cache_dir)
+        self.max_detections = max_detections
+        self.chunk_rows = chunk_rows
+        self.video_dir = None
+        self.tables = {}
+        self.hit_count, self.miss_count = 0, 0
+        logger.info(f'DetectionCache successfully initialized at {self.cache_dir}')
+
+    @staticmethod
+    def video_key(video_path):
+        video_path = Path(video_path)
+        return f'{video_path.stem}_{video_path.stat().st_size}'
+
+    def open_video(self, video_path):
+        """start caching entries for video_path. Closes the tables of any previously opened video"""
+        self.close()
+        self.video_dir = self.cache_dir / self.video_key(video_path)
+        logger.debug(f'detection cache opened for {Path(video_path).name}')
+
+    def table(self, detector):
+        key = (detector.model_hash, round(float(detector.confidence_thresh), 4))
+        if key not in self.tables:
+            directory = self.video_dir / f'{key[0][:16]}_{key[1]:.4f}'
+            self.tables[key] = CacheTable(directory, self.max_detections, self.chunk_rows)
+        return self.tables[key]
+
+    def detect(self, detector, img, frame_index, input_box):
+        """
+        return cached detections for this frame if present, otherwise run the detector and cache its output
+        :param detector: DetectorPool (or DetectorBase) exposing model_hash and confidence_thresh
+        :param img: image to run detection on if there is no cached entry
+        :param frame_index: index of the frame within the open video
+        :param input_box: (xmin, ymin, xmax, ymax) region of the frame that img was cropped from
+        """
+        table = self.table(detector)
+        dets = table.lookup(frame_index, input_box)
+        if dets is not None:
+            self.hit_count += 1
+            return dets
+        self.miss_count += 1
+        dets = detector.detect(img)
+        table.store(frame_index, input_box, dets)
+        return dets
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+        self.tables = {}
+        if self.hit_count or self.miss_count:
+            logger.debug(f'detection cache hits: {self.hit_count}, misses: {self.miss_count}')
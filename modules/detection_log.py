@@ -0,0 +1,86 @@
+"""code for logging the per-frame detections of active mode to disk, one columnar table per day"""
+
+import logging
+from datetime import date
+from pathlib import Path
+
+import numpy as np
+
+from modules.columnar_store import ColumnarLog, read_columns
+from modules.pipeline import FramePacket
+logger = logging.getLogger(__name__)
+
+
+class DetectionLog:
+
+    def __init__(self, log_dir, max_detections=25, chunk_rows=300, fsync=True):
+        """
+        append-only record of each analyzed frame's timestamp, ROI, OOI detections, and occupancy, one table per day
+        :param log_dir: directory holding one table per day
+        :param max_detections: maximum number of detections stored per frame
+        :param chunk_rows: number of frames buffered before they are written to disk (and fsynced)
+        :param fsync: whether to fsync the table files each time a chunk is written
+        """
+        logger.debug('Beginning DetectionLog initialization')
+        self.log_dir = Path(log_dir)
+        self.max_detections = max_detections
+        self.chunk_rows = chunk_rows
+        self.fsync = fsync
+        # frames without an ROI are logged with an roi_box of -1s, and frames without detections with occupancy -1
+        self.schema = {'timestamp': ('float64', ()),
+                       'roi_box': ('int32', (4,)),
+                       'occupancy': ('int16', ()),
+                       'inferred': ('bool', ()),
+                       'boxes': ('int32', (max_detections, 4)),  # in full frame pixel coordinates
+                       'scores': ('float32', (max_detections,))}
+        self.log = None
+        self.day = None
+        self.row_boxes = np.zeros((max_detections, 4), dtype=np.int32)
+        self.row_scores = np.zeros(max_detections, dtype=np.float32)
+        logger.info(f'DetectionLog successfully initialized at {self.log_dir}')
+
+    def open_day(self, day: date):
+        self.close()
+        self.day = day
+        self.log = ColumnarLog(self.log_dir / day.isoformat(), self.schema, chunk_rows=self.chunk_rows,
+                               fsync=self.fsync)
+        logger.debug(f'detection log opened for {day.isoformat()}')
+
+    def append(self, packet: FramePacket):
+        if packet.timestamp.date() != self.day:
+            self.open_day(packet.timestamp.date())
+        roi_box = packet.roi_box if packet.roi_box is not None else (-1, -1, -1, -1)
+        count = 0
+        if packet.dets is not None:
+            count = min(len(packet.dets), self.max_detections)
+            # detections are relative to the ROI crop, so shift them back into full frame coordinates
+            self.row_boxes[:count] = packet.dets.boxes[:count]
+            self.row_boxes[:count, 0::2] += roi_box[0]
+            self.row_boxes[:count, 1::2] += roi_box[1]
+            self.row_scores[:count] = packet.dets.scores[:count]
+        self.row_boxes[count:] = 0
+        self.row_scores[count:] = 0
+        self.log.append(timestamp=packet.timestamp.timestamp(), roi_box=roi_box,
+                        occupancy=-1 if packet.dets is None else packet.occupancy, inferred=packet.inferred,
+                        boxes=self.row_boxes, scores=self.row_scores)
+
+    def flush(self):
+        if self.log is not None:
+            self.log.flush()
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+            self.day = None
+
+
+def read_detection_log(log_dir, day, mmap=True):
+    """
+    :param log_dir: directory passed to DetectionLog
+    :param day: date, or ISO format date string, of the table to read
+    :param mmap: whether to return read-only memory maps of the column files rather than reading them
+    :return: dict mapping column name to an array with one row per frame, each holding occupancy valid detections
+    """
+    day = day.isoformat() if isinstance(day, date) else day
+    return read_columns(Path(log_dir) / day, mmap)
@@ -1,16 +1,25 @@
 """code for managing real-time email notifications"""
 import time
 import datetime as dt
+import itertools
+import json
+import threading
+import urllib.request
+from pathlib import Path
 
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import (
-    Mail, Attachment, FileContent, FileName,
-    FileType, Disposition, Content)
 import logging
 import base64
 import os
+
+from modules.metrics import NULL_METRICS
+from modules.utils import write_json_atomic
 logger = logging.getLogger(__name__)
 
+
+class NotificationError(Exception):
+    pass
+
+
 class Notification:
 
     def __init__(self, subject, message, attachment_path=None):
@@ -18,6 +27,8 @@ class Notification:
         self.time = dt.datetime.now().isoformat()
 
     def as_mail(self, from_email, to_email):
+        # sendgrid is slow to import and only needed to actually send, so it is imported here rather than at startup
+        from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition, Content
         mail = Mail(
             from_email=from_email,
             to_emails=to_email,
@@ -26,89 +37,317 @@ class Notification:
         )
         if self.attachment_path is not None:
             self.attachment_path = str(self.attachment_path)
-            with open(self.attachment_path, 'rb') as f:
-                data = f.read()
-            encoded = base64.b64encode(data).decode()
             attachment = Attachment()
-            attachment.file_content = FileContent(encoded)
+            attachment.file_content = FileContent(self.encode_attachment())
             attachment.file_type = FileType(f'application/{self.attachment_path.split(".")[-1]}')
             attachment.file_name = FileName(os.path.basename(self.attachment_path))
             attachment.disposition = Disposition('attachment')
             mail.attachment = attachment
         return mail
 
+    def as_payload(self, from_email, to_email):
+        """the notification as a json-serializable dict, with any attachment base64 encoded"""
+        payload = {'from_email': from_email, 'to_email': to_email, 'subject': self.subject, 'message': self.message,
+                   'time': self.time}
+        if self.attachment_path is not None:
+            payload['attachment_name'] = os.path.basename(str(self.attachment_path))
+            payload['attachment_content'] = self.encode_attachment()
+        return payload
+
+    def encode_attachment(self):
+        with open(str(self.attachment_path), 'rb') as f:
+            data = f.read()
+        return base64.b64encode(data).decode()
+
+    def to_dict(self):
+        return {'subject': self.subject, 'message': self.message,
+                'attachment_path': None if self.attachment_path is None else str(self.attachment_path),
+                'time': self.time}
+
+    @classmethod
+    def from_dict(cls, d):
+        notification = cls(d['subject'], d['message'], d['attachment_path'])
+        notification.time = d['time']
+        return notification
+
+
+class SendGridTransport:
+
+    def __init__(self, api_key):
+        from sendgrid import SendGridAPIClient
+        self.api_client = SendGridAPIClient(api_key)
+
+    def send(self, notification: Notification, from_email, to_email):
+        response = self.api_client.send(notification.as_mail(from_email, to_email))
+        if str(response.status_code) != '202':
+            raise NotificationError(f'Expected response status code 202 from sendgrid api, got '
+                                    f'{response.status_code}')
+
+
+class HttpTransport:
+
+    def __init__(self, url, timeout=30):
+        """posts each notification as json (see Notification.as_payload) to url, e.g. a local relay or test server"""
+        self.url, self.timeout = url, timeout
+
+    def send(self, notification: Notification, from_email, to_email):
+        payload = json.dumps(notification.as_payload(from_email, to_email)).encode()
+        request = urllib.request.Request(self.url, data=payload, headers={'Content-Type': 'application/json'},
+                                         method='POST')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if not 200 <= response.status < 300:
+                raise NotificationError(f'Expected a 2xx response from {self.url}, got {response.status}')
+
+
+class NotificationDispatcher:
+
+    def __init__(self, queue_dir, transport, from_email, max_attempts=5, backoff_initial=30, backoff_max=1800,
+                 time_func=time.time, metrics=None):
+        """
+        sends notifications from a background thread, from a queue of json files that survives restarts
+        :param queue_dir: directory the queue is persisted to. Notifications given up on go to its "failed" subdirectory
+        :param transport: object with a send(notification, from_email, to_email) method that raises on failure
+        :param from_email: sender address
+        :param max_attempts: number of send attempts before a notification is given up on
+        :param backoff_initial: seconds before the first retry, doubling after each later failure
+        :param backoff_max: max seconds between retries
+        :param time_func: returns the current time in seconds since the epoch
+        :param metrics: optional Metrics to record send counts and queue length to
+        """
+        logger.debug('Beginning NotificationDispatcher initialization')
+        self.queue_dir = Path(queue_dir)
+        self.failed_dir = self.queue_dir / 'failed'
+        self.queue_dir.mkdir(exist_ok=True, parents=True)
+        self.transport = transport
+        self.from_email = from_email
+        self.max_attempts = max_attempts
+        self.backoff_initial, self.backoff_max = backoff_initial, backoff_max
+        self.time_func = time_func
+        self.metrics = metrics or NULL_METRICS
+        self.condition = threading.Condition()
+        self.entries = {}
+        self.renderers = {}
+        self.sequence = itertools.count()
+        self.stopping = False
+        for path in sorted(self.queue_dir.glob('*.json')):
+            try:
+                with open(path, 'r') as f:
+                    self.entries[path.stem] = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f'could not read queued notification {path.name} ({e}). Skipping')
+        if self.entries:
+            logger.info(f'{len(self.entries)} queued notification(s) recovered from {self.queue_dir}')
+        self.metrics.add_collector(lambda m: m.set_gauge('notification_queue_length', len(self.entries)))
+        self.thread = threading.Thread(target=self.run, name='notification_dispatcher', daemon=True)
+        self.thread.start()
+        logger.info('NotificationDispatcher successfully initialized')
+
+    def enqueue(self, notification: Notification, to_email, render_clip=None):
+        """
+        queue a notification for sending
+        :param render_clip: optional function writing the attachment, called on the dispatcher thread before sending
+        """
+        key = f'{int(self.time_func() * 1000):014d}_{next(self.sequence):04d}'
+        entry = {'notification': notification.to_dict(), 'to_email': to_email, 'attempts': 0, 'next_attempt': 0.0,
+                 'clip_pending': render_clip is not None}
+        with self.condition:
+            self.save(key, entry)
+            self.entries[key] = entry
+            if render_clip is not None:
+                self.renderers[key] = render_clip
+            self.condition.notify()
+
+    def save(self, key, entry):
+        write_json_atomic(self.queue_dir / f'{key}.json', entry)
+
+    def next_due(self):
+        """:return: (key, seconds until it is due) of the earliest queued notification, or (None, None)"""
+        if not self.entries:
+            return None, None
+        key = min(self.entries, key=lambda k: (self.entries[k]['next_attempt'], k))
+        return key, self.entries[key]['next_attempt'] - self.time_func()
+
+    def run(self):
+        while True:
+            with self.condition:
+                key, delay = self.next_due()
+                while not self.stopping and (key is None or delay > 0):
+                    self.condition.wait(timeout=delay)
+                    key, delay = self.next_due()
+                if self.stopping and (key is None or delay > 0):
+                    return
+                entry = self.entries[key]
+                render_clip = self.renderers.pop(key, None)
+            self.attempt(key, entry, render_clip)
+
+    def attempt(self, key, entry, render_clip):
+        notification = Notification.from_dict(entry['notification'])
+        if entry['clip_pending']:
+            if render_clip is None:
+                # the process restarted before the clip was written
+                notification.message += '\n(clip unavailable)'
+                notification.attachment_path = None
+            else:
+                try:
+                    render_clip(notification.attachment_path)
+                except Exception as e:
+                    logger.warning(f'failed to render notification clip: {e}')
+                    notification.message += '\n(clip unavailable)'
+                    notification.attachment_path = None
+            entry['notification'], entry['clip_pending'] = notification.to_dict(), False
+        try:
+            with self.metrics.timer('notification_send'):
+                self.transport.send(notification, self.from_email, entry['to_email'])
+        except Exception as e:
+            entry['attempts'] += 1
+            self.metrics.increment('notification_failures')
+            if entry['attempts'] >= self.max_attempts:
+                logger.warning(f'giving up on notification "{notification.subject}" after {entry["attempts"]} '
+                               f'attempts: {e}')
+                self.metrics.increment('notifications_dropped')
+                self.failed_dir.mkdir(exist_ok=True)
+                with self.condition:
+                    self.save(key, entry)
+                    os.replace(self.queue_dir / f'{key}.json', self.failed_dir / f'{key}.json')
+                    del self.entries[key]
+                    self.condition.notify_all()
+                return
+            delay = min(self.backoff_initial * 2 ** (entry['attempts'] - 1), self.backoff_max)
+            logger.warning(f'unexpected error during notification: {e}. Retrying in {delay} seconds')
+            entry['next_attempt'] = self.time_func() + delay
+            with self.condition:
+                self.save(key, entry)
+            return
+        logger.debug('notification appears to have sent successfully')
+        self.metrics.increment('notifications_sent')
+        with self.condition:
+            os.remove(self.queue_dir / f'{key}.json')
+            del self.entries[key]
+            self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        wait until every notification that is due has been sent or rescheduled
+        :return: True if nothing due was left in the queue before the timeout
+        """
+        deadline = None if timeout is None else self.time_func() + timeout
+        with self.condition:
+            while True:
+                key, delay = self.next_due()
+                if key is None or delay > 0:
+                    return True
+                remaining = None if deadline is None else deadline - self.time_func()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(timeout=0.1 if remaining is None else min(remaining, 0.1))
+
+    def close(self, timeout=None):
+        """send whatever is due (waiting up to timeout seconds), then stop. Anything left stays queued on disk"""
+        self.flush(timeout)
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+
 
 class Notifier:
 
-    def __init__(self, user_email, from_email, api_key, admin_email, min_notification_interval=600, max_notifications_per_day=20):
+    def __init__(self, user_email, from_email, api_key, admin_email, min_notification_interval=600,
+                 max_notifications_per_day=20, metrics=None, transport=None, queue_dir=None, max_attempts=5,
+                 time_func=time.time):
+        """
+        :param transport: SendGridTransport or HttpTransport to send with. Defaults to a SendGridTransport using api_key
+        :param queue_dir: optional directory of a NotificationDispatcher to send from. Otherwise sends are synchronous
+        :param max_attempts: number of send attempts per notification when queue_dir is given
+        :param time_func: returns the current time in seconds since the epoch
+        """
         logger.debug('Beginning Notifier initialization')
+        self.metrics = metrics or NULL_METRICS
+        self.time_func = time_func
         self.user_email, self.from_email, self.admin_email, self.api_key = user_email, from_email, admin_email, api_key
-        self.disabled_flag = (self.user_email is None) or (self.api_key is None)
+        self.disabled_flag = (self.user_email is None) or (self.api_key is None and transport is None)
         self.min_notification_interval = min_notification_interval
         self.last_notification_timestamp = 0
         self.max_notifications_per_day = max_notifications_per_day
         self.notification_count = 0
+        self.dispatcher = None
         if self.disabled_flag:
             logger.info('Notifier initialized in light mode. To enable email notifications, provide values for '
                         'both the "api_key" and "user_email" parameters in the project config file.')
         else:
-            self.api_client = SendGridAPIClient(api_key)
+            self.transport = transport or SendGridTransport(api_key)
+            if queue_dir is not None:
+                self.dispatcher = NotificationDispatcher(queue_dir, self.transport, from_email,
+                                                         max_attempts=max_attempts, time_func=time_func,
+                                                         metrics=self.metrics)
             logger.debug('Notifier successfully initialized')
 
-    def notify(self, notification: Notification, override_checks=False):
+    def notify(self, notification: Notification, override_checks=False, render_clip=None):
+        """
+        :param render_clip: optional function writing the attachment, called on the dispatcher thread if there is one
+        """
         if self.disabled_flag:
             logger.debug('ignoring notification call because notifier is in light mode')
             return
         if override_checks or self.check_conditions():
-            self.send_user_email(notification)
+            self.send(notification, self.user_email, render_clip)
 
-    def send_user_email(self, notification: Notification):
-        mail = notification.as_mail(self.from_email, self.user_email)
+    def send(self, notification: Notification, to_email, render_clip=None):
+        # the rate limits count notifications when they are handed off, since queued sends complete later
+        self.notification_count += 1
+        self.last_notification_timestamp = self.time_func()
+        notification.time = dt.datetime.fromtimestamp(self.last_notification_timestamp).isoformat()
+        if self.dispatcher is not None:
+            self.dispatcher.enqueue(notification, to_email, render_clip)
+            return
+        if render_clip is not None:
+            render_clip(notification.attachment_path)
         try:
-            response = self.api_client.send(mail)
+            with self.metrics.timer('notification_send'):
+                self.transport.send(notification, self.from_email, to_email)
         except Exception as e:
             logger.warning(f'unexpected error during notification: {e}')
+            self.metrics.increment('notification_failures')
             return
-        if str(response.status_code) == '202':
-            logger.debug('notification appears to have sent successfully')
-            self.notification_count += 1
-            self.last_notification_timestamp = time.time()
-        else:
-            logger.warning(f'Expected response status code 202 from sendgrid api, got {response.status_code}. '
-                           f'Email notification likely failed')
+        logger.debug('notification appears to have sent successfully')
+        self.metrics.increment('notifications_sent')
+
+    def send_user_email(self, notification: Notification):
+        if self.disabled_flag:
+            logger.debug('ignoring notification call because notifier is in light mode')
+            return
+        self.send(notification, self.user_email)
 
     def send_admin_email(self, notification: Notification):
-        if self.admin_email is not None:
-            mail = notification.as_mail(self.from_email, self.admin_email)
-            try:
-                response = self.api_client.send(mail)
-            except Exception as e:
-                logger.warning(f'unexpected error during notification: {e}')
-                return
-            if str(response.status_code) == '202':
-                logger.debug('notification appears to have sent successfully')
-                self.notification_count += 1
-                self.last_notification_timestamp = time.time()
-            else:
-                logger.warning(f'Expected response status code 202 from sendgrid api, got {response.status_code}. '
-                               f'Email notification likely failed')
+        if self.disabled_flag:
+            logger.debug('ignoring notification call because notifier is in light mode')
+        elif self.admin_email is not None:
+            self.send(notification, self.admin_email)
         else:
             logger.debug('admin email not found. skipping.')
 
-
     def check_conditions(self):
         logger.debug('checking notification conditions')
-        if (time.time() - self.last_notification_timestamp) < self.min_notification_interval:
+        if (self.time_func() - self.last_notification_timestamp) < self.min_notification_interval:
             logger.debug('min notification interval has not elapsed, rejecting notification request')
+            self.metrics.increment('notifications_suppressed')
             return False
         if self.notification_count >= self.max_notifications_per_day:
             logger.debug('max notifications per day reached, rejecting notification request')
+            self.metrics.increment('notifications_suppressed')
             return False
         logger.debug('all conditions passed')
         return True
 
+    def flush(self, timeout=None):
+        """wait (up to timeout seconds) for queued notifications that are due to be sent"""
+        if self.dispatcher is not None:
+            self.dispatcher.flush(timeout)
+
+    def close(self, timeout=None):
+        if self.dispatcher is not None:
+            self.dispatcher.close(timeout)
+
     def reset(self):
         self.notification_count = 0
         self.last_notification_timestamp = 0
-
-
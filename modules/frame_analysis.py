@@ -0,0 +1,167 @@
+"""code for turning a captured frame into an ROI crop, OOI detections, and an occupancy value"""
+
+import numpy as np
+import logging
+
+from modules.object_detection import DetectorPool
+from modules.motion_gate import MotionGate
+from modules.roi_tracker import RoiTracker
+from modules.pipeline import FramePacket
+from modules.utils import cv2_api
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SCALE = 4   # thumbnails are 1/THUMBNAIL_SCALE the size of the ROI
+
+
+def init_detectors(config, model_dir, edgetpu_devices='config', cpu_workers=None, metrics=None):
+    """
+    build the ROI and OOI detector pools described by a project config
+    :param config: project config namespace
+    :param model_dir: directory containing the model files
+    :param edgetpu_devices: overrides config.edgetpu_devices unless left as 'config'
+    :param cpu_workers: overrides config.cpu_detector_workers unless None
+    :param metrics: optional Metrics to record detector latencies to, as roi_* and ooi_* histograms
+    :return: (roi_detector, ooi_detector)
+    """
+    if edgetpu_devices == 'config':
+        edgetpu_devices = config.edgetpu_devices
+    if cpu_workers is None:
+        cpu_workers = config.cpu_detector_workers
+    detectors = []
+    for name, model, cpu_model, confidence_thresh in [
+            ('roi', config.roi_model, config.roi_cpu_model, config.roi_confidence_thresh),
+            ('ooi', config.ooi_model, config.ooi_cpu_model, config.ooi_confidence_thresh)]:
+        detectors.append(DetectorPool(model_dir / model, confidence_thresh,
+                                      edgetpu_devices=edgetpu_devices,
+                                      cpu_workers=cpu_workers,
+                                      cpu_threads=config.cpu_detector_threads,
+                                      cpu_model_path=(model_dir / cpu_model) if cpu_model else None,
+                                      metrics=metrics,
+                                      name=name))
+    return tuple(detectors)
+
+
+class FrameAnalyzer:
+
+    def __init__(self, config, roi_detector, ooi_detector, detection_cache=None):
+        """
+        per-frame analysis shared by live data collection and offline replay. Keeps track of the ROI between frames
+        :param config: project config namespace
+        :param roi_detector: DetectorPool (or DetectorBase) for the ROI model
+        :param ooi_detector: DetectorPool (or DetectorBase) for the OOI model
+        :param detection_cache: optional DetectionCache, used for packets that carry a frame_index
+        """
+        logger.debug('Beginning FrameAnalyzer initialization')
+        self.config = config
+        self.roi_detector, self.ooi_detector = roi_detector, ooi_detector
+        self.detection_cache = detection_cache
+        # lowered by the ResourceGovernor when the CPU is under pressure: OOI detection runs on every ooi_stride-th
+        # frame (the rest reuse the latest detections), and thumbnails are 1/thumbnail_scale the size of the ROI
+        self.ooi_stride, self.thumbnail_scale = 1, THUMBNAIL_SCALE
+        self.motion_gate = self.build_motion_gate(config)
+        self.roi_tracker = RoiTracker(max_age=config.roi_update_interval,
+                                      drift_thresh=config.roi_drift_thresh,
+                                      check_interval=config.roi_drift_check_interval,
+                                      confirm_checks=config.roi_drift_confirm_checks,
+                                      retry_initial=config.roi_retry_initial,
+                                      retry_max=config.roi_retry_max)
+        self.reset()
+        logger.info('FrameAnalyzer successfully initialized')
+
+    @staticmethod
+    def build_motion_gate(config):
+        """:return: the MotionGate described by config, or None if the motion gate is disabled"""
+        if not config.motion_gate_enabled:
+            return None
+        return MotionGate(config.motion_gate_change_thresh, config.motion_gate_max_skip,
+                          config.motion_gate_pixel_thresh)
+
+    def set_motion_gate(self, motion_gate):
+        """swap in a new MotionGate (or None), e.g. after a config reload. Safe to call while frames are analyzed"""
+        self.motion_gate = motion_gate
+
+    def configure_roi_tracker(self, config):
+        self.roi_tracker.configure(config.roi_update_interval, config.roi_drift_thresh, config.roi_drift_check_interval,
+                                   config.roi_drift_confirm_checks, config.roi_retry_initial, config.roi_retry_max)
+
+    def reset(self):
+        self.roi_tracker.reset()
+        self.roi_box = None
+        self.roi_slice = None
+        self.last_dets = None
+        self.inferred = False
+        self.frames_since_inference = 0
+        self.restored_roi = None
+        if self.motion_gate is not None:
+            self.motion_gate.reset()
+
+    def restore_roi(self, box, detected_at):
+        """
+        reuse an ROI found before a restart, taking its border reference from the next analyzed frame
+        :param detected_at: datetime the ROI was detected, from which its max age still counts
+        """
+        self.restored_roi = (tuple(int(v) for v in box), detected_at)
+
+    def set_roi(self, box, img, timestamp):
+        self.roi_box = box
+        xmin, ymin, xmax, ymax = self.roi_box
+        self.roi_slice = np.s_[ymin:ymax, xmin:xmax]
+        # detections made in the previous ROI are never reused in the new one
+        self.last_dets = None
+        self.roi_tracker.set_roi(self.roi_box, img, timestamp)
+        motion_gate = self.motion_gate
+        if motion_gate is not None:
+            motion_gate.reset()
+
+    def analyze(self, packet: FramePacket):
+        """update the ROI if needed and fill in packet.dets (None until an ROI is found) and packet.occupancy"""
+        # the motion gate can be swapped from another thread by a config reload, so it is only read once per frame
+        motion_gate = self.motion_gate
+        if self.restored_roi is not None:
+            box, detected_at = self.restored_roi
+            self.set_roi(box, packet.img, detected_at)
+            self.restored_roi = None
+        if self.roi_tracker.needs_detection(packet.timestamp):
+            height, width = packet.img.shape[:2]
+            roi_dets = self.detect(self.roi_detector, packet, (0, 0, width, height))
+            if roi_dets:
+                self.set_roi(tuple(int(v) for v in roi_dets.boxes[0]), packet.img, packet.timestamp)
+            else:
+                self.roi_tracker.report_failure(packet.timestamp)
+        elif self.roi_slice:
+            self.roi_tracker.validate(packet.img)
+        self.inferred = False
+        if self.roi_slice:
+            packet.img = packet.img[self.roi_slice]
+            due = self.last_dets is None or self.frames_since_inference + 1 >= self.ooi_stride
+            if due and ((motion_gate is None) or motion_gate.should_infer(packet.img)):
+                self.last_dets = self.detect(self.ooi_detector, packet, self.roi_box)
+                self.inferred = True
+                self.frames_since_inference = 0
+            else:
+                self.frames_since_inference += 1
+            packet.dets = self.last_dets
+            packet.occupancy = len(packet.dets)
+            packet.roi_box, packet.inferred = self.roi_box, self.inferred
+        return packet
+
+    def detect(self, detector, packet: FramePacket, input_box):
+        if self.detection_cache is None or packet.frame_index is None:
+            return detector.detect(packet.img)
+        return self.detection_cache.detect(detector, packet.img, packet.frame_index, input_box)
+
+    def make_thumbnail(self, packet: FramePacket):
+        """
+        :return: (thumbnail, boxes): a downscaled BGR copy of the ROI and its OOI detections in thumbnail coordinates
+        """
+        cv2 = cv2_api()
+        img, scale = packet.img, self.thumbnail_scale
+        thumbnail = cv2.resize(img, (img.shape[1] // scale, img.shape[0] // scale), interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(thumbnail, cv2.COLOR_RGB2BGR, dst=thumbnail)
+        return thumbnail, packet.dets.valid_boxes() // scale
+
+    def log_stats(self):
+        logger.debug(f'mean ROI detector timing (s): {self.roi_detector.mean_timing()}')
+        logger.debug(f'mean OOI detector timing (s): {self.ooi_detector.mean_timing()}')
+        if self.motion_gate is not None:
+            logger.info(f'motion gate skipped {self.motion_gate.skip_fraction() * 100:.1f}% of OOI inferences')
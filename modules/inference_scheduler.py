@@ -0,0 +1,161 @@
+"""code for sharing one set of detectors between several video sources, with per-source fairness"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class Source:
+
+    def __init__(self, name, process, on_drop=None, rate=5.0, maxsize=2):
+        """
+        state of one source registered with an InferenceScheduler
+        :param name: unique name of the source, e.g. its project id
+        :param process: function called with each submitted item on a worker thread, one item of the source at a time
+        :param on_drop: optional function called with each item discarded because the source's queue was full
+        :param rate: target processing rate of the source, in items per second
+        :param maxsize: maximum number of items waiting for the source. When full, the oldest item is dropped
+        """
+        self.name = name
+        self.process, self.on_drop = process, on_drop
+        self.rate = rate
+        self.queue = deque()
+        self.maxsize = maxsize
+        self.busy = False
+        self.error = None
+        # virtual finish time of the source's last processed item, in seconds of service at its target rate
+        self.vtime = 0.0
+        self.submitted_count, self.processed_count, self.drop_count = 0, 0, 0
+        self.wait_sum, self.max_wait = 0.0, 0.0
+
+    def stats(self):
+        return {'submitted': self.submitted_count,
+                'processed': self.processed_count,
+                'dropped': self.drop_count,
+                'current_depth': len(self.queue),
+                'mean_wait': (self.wait_sum / self.processed_count) if self.processed_count else 0.0,
+                'max_wait': self.max_wait}
+
+
+class InferenceScheduler:
+
+    def __init__(self, workers=1, time_func=time.monotonic):
+        """
+        multiplexes the frames of several sources onto shared detectors by weighted fair queuing on their target rates
+        :param workers: number of worker threads. Usually the number of detectors in the shared DetectorPool
+        :param time_func: monotonic clock used to measure queue wait times
+        """
+        logger.debug('Beginning InferenceScheduler initialization')
+        self.time_func = time_func
+        self.sources = {}
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.threads = [threading.Thread(target=self.work, name=f'inference_scheduler_{i}', daemon=True)
+                        for i in range(max(1, workers))]
+        for thread in self.threads:
+            thread.start()
+        logger.info(f'InferenceScheduler successfully initialized with {len(self.threads)} worker(s)')
+
+    def add_source(self, name, process, on_drop=None, rate=5.0, maxsize=2):
+        """register a source. See Source for the parameters"""
+        with self.condition:
+            if name in self.sources:
+                raise ValueError(f'a source named {name} is already registered')
+            source = Source(name, process, on_drop, rate, maxsize)
+            # start level with the least-served active source, so that a new source does not monopolize the workers
+            active = [s.vtime for s in self.sources.values()]
+            source.vtime = min(active) if active else 0.0
+            self.sources[name] = source
+        logger.debug(f'source {name} added to the inference scheduler at {rate:.2f} frames/s')
+
+    def remove_source(self, name, drain=True):
+        """
+        unregister a source once the item it is processing (if any) is finished
+        :param drain: if True, items still waiting are processed first. Otherwise they are passed to on_drop
+        :return: stats of the removed source
+        """
+        with self.condition:
+            source = self.sources[name]
+            if not drain:
+                self.drop_waiting(source)
+            self.condition.wait_for(lambda: not source.busy and not (source.queue and source.error is None))
+            self.drop_waiting(source)
+            del self.sources[name]
+        logger.debug(f'source {name} removed from the inference scheduler: {source.stats()}')
+        return source.stats()
+
+    def drop_waiting(self, source: Source):
+        while source.queue:
+            item, _ = source.queue.popleft()
+            source.drop_count += 1
+            if source.on_drop is not None:
+                source.on_drop(item)
+
+    def submit(self, name, item):
+        """
+        queue an item for processing. If the source's queue is full, its oldest waiting item is dropped
+        :raises: the exception raised by the source's process function, if it failed on an earlier item
+        """
+        with self.condition:
+            source = self.sources[name]
+            if source.error is not None:
+                raise source.error
+            if not source.queue and not source.busy:
+                # a source that was idle rejoins level with the least-served active source, rather than with the
+                # credit it built up while idle
+                active = [s.vtime for s in self.sources.values() if s is not source and (s.queue or s.busy)]
+                if active:
+                    source.vtime = max(source.vtime, min(active))
+            if len(source.queue) >= source.maxsize:
+                dropped, _ = source.queue.popleft()
+                source.drop_count += 1
+                if source.on_drop is not None:
+                    source.on_drop(dropped)
+            source.queue.append((item, self.time_func()))
+            source.submitted_count += 1
+            self.condition.notify()
+
+    def next_source(self):
+        """:return: the waiting source with the lowest virtual time that is not already being processed, or None"""
+        ready = [s for s in self.sources.values() if s.queue and not s.busy and s.error is None]
+        return min(ready, key=lambda s: s.vtime) if ready else None
+
+    def work(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopped or self.next_source() is not None)
+                if self.stopped:
+                    return
+                source = self.next_source()
+                item, submit_time = source.queue.popleft()
+                source.busy = True
+                source.vtime += 1.0 / source.rate
+            wait = self.time_func() - submit_time
+            try:
+                source.process(item)
+                error = None
+            except Exception as e:
+                logger.exception(f'unhandled exception processing a frame from source {source.name}: {e}')
+                error = e
+            with self.condition:
+                source.busy = False
+                source.error = error
+                source.processed_count += 1
+                source.wait_sum += wait
+                source.max_wait = max(source.max_wait, wait)
+                self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {name: source.stats() for name, source in self.sources.items()}
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        logger.debug('inference scheduler stopped')
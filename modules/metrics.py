@@ -0,0 +1,227 @@
+"""code for collecting runtime metrics and exporting them to a file or a local http endpoint"""
+
+import bisect
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+from modules.utils import write_json_atomic
+logger = logging.getLogger(__name__)
+
+# upper bounds (in seconds) of the latency histogram buckets. The last bucket catches everything slower
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60, 300,
+                   float('inf'))
+
+
+class Histogram:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = list(buckets)
+        self.counts = [0] * len(self.bounds)
+        self.count, self.sum, self.max = 0, 0.0, 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """upper bound of the bucket holding the q-th quantile, capped at the largest observed value"""
+        if not self.count:
+            return 0.0
+        target, cumulative = q * self.count, 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': (self.sum / self.count) if self.count else 0.0,
+                'max': self.max, 'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99),
+                'buckets': {str(bound): count for bound, count in zip(self.bounds, self.counts) if count}}
+
+
+def process_memory():
+    """:return: (current, peak) resident memory of this process in bytes. current is None off Linux"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        current = None
+    return current, peak
+
+
+class Metrics:
+
+    enabled = True
+
+    def __init__(self):
+        """thread-safe store of counters, gauges, and latency histograms, plus collectors run at each snapshot"""
+        logger.debug('Beginning Metrics initialization')
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+        self.start_time = time.time()
+        self.stop_event = threading.Event()
+        self.flush_thread = None
+        self.server = None
+        logger.info('Metrics successfully initialized')
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - t0)
+
+    def add_collector(self, func):
+        """register func(metrics), called before each snapshot. Returns func so it can be removed later"""
+        self.collectors.append(func)
+        return func
+
+    def remove_collector(self, func):
+        if func in self.collectors:
+            self.collectors.remove(func)
+
+    def snapshot(self):
+        for func in list(self.collectors):
+            try:
+                func(self)
+            except Exception as e:
+                logger.debug(f'metrics collector {func} failed: {e}')
+        current_memory, peak_memory = process_memory()
+        with self.lock:
+            return {'time': time.time(),
+                    'uptime': time.time() - self.start_time,
+                    'counters': dict(self.counters),
+                    'gauges': dict(self.gauges, memory_rss_bytes=current_memory, memory_peak_rss_bytes=peak_memory),
+                    'histograms': {name: h.snapshot() for name, h in self.histograms.items()}}
+
+    def write(self, path):
+        write_json_atomic(path, self.snapshot())
+
+    def start_file_flush(self, path, interval=60):
+        """write a snapshot to path every interval seconds, from a background thread"""
+        def flush_loop():
+            while not self.stop_event.wait(interval):
+                try:
+                    self.write(path)
+                except OSError as e:
+                    logger.warning(f'failed to write metrics to {path}: {e}')
+        self.flush_thread = threading.Thread(target=flush_loop, name='metrics_flush', daemon=True)
+        self.flush_thread.start()
+        logger.debug(f'metrics will be written to {path} every {interval} seconds')
+
+    def start_http_server(self, port, host='127.0.0.1'):
+        """serve snapshots as json at http://host:port/metrics. Binds to localhost by default"""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.rstrip('/') != '/metrics':
+                    self.send_error(404)
+                    return
+                body = json.dumps(metrics.snapshot()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f'metrics request: {format % args}')
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, name='metrics_http', daemon=True).start()
+        logger.info(f'serving metrics at http://{host}:{self.server.server_address[1]}/metrics')
+
+    def close(self, path=None):
+        """stop the background threads, writing a final snapshot to path if given"""
+        self.stop_event.set()
+        if self.flush_thread is not None:
+            self.flush_thread.join()
+            self.flush_thread = None
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if path is not None:
+            self.write(path)
+
+
+class NullMetrics:
+
+    enabled = False
+
+    def __init__(self):
+        """drop-in replacement for Metrics that records nothing, used when metrics are disabled"""
+        self.null_timer = nullcontext()
+
+    def increment(self, name, value=1):
+        pass
+
+    def set_gauge(self, name, value):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def timer(self, name):
+        return self.null_timer
+
+    def add_collector(self, func):
+        return func
+
+    def remove_collector(self, func):
+        pass
+
+    def snapshot(self):
+        return {}
+
+    def close(self, path=None):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def init_metrics(config, project_dir):
+    """
+    build the metrics store described by a project config, starting the file flush and http endpoint if configured
+    :return: Metrics, or NULL_METRICS if metrics are disabled
+    """
+    if not config.metrics_enabled:
+        return NULL_METRICS
+    metrics = Metrics()
+    if config.metrics_flush_interval:
+        metrics.start_file_flush(project_dir / 'metrics.json', config.metrics_flush_interval)
+    if config.metrics_http_port:
+        metrics.start_http_server(config.metrics_http_port)
+    return metrics
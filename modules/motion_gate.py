@@ -0,0 +1,73 @@
+"""code for cheaply deciding whether the ROI has changed enough since the last inference to be worth re-analyzing"""
+
+import numpy as np
+import logging
+
+from modules.utils import cv2_api
+logger = logging.getLogger(__name__)
+
+
+class MotionGate:
+
+    def __init__(self, change_thresh=0.02, max_skip=10, pixel_thresh=15, width=64):
+        """
+        compares a small grayscale copy of each ROI crop to the one from the last frame that was actually analyzed
+        :param change_thresh: fraction of (downsampled) pixels that must have changed to trigger a new inference
+        :param max_skip: maximum number of consecutive frames that can be skipped before an inference is forced
+        :param pixel_thresh: minimum grayscale difference (0-255) for a pixel to count as changed
+        :param width: width (in pixels) the ROI crop is downsampled to before comparison
+        """
+        logger.debug('Beginning MotionGate initialization')
+        self.change_thresh = change_thresh
+        self.max_skip = max_skip
+        self.pixel_thresh = pixel_thresh
+        self.width = width
+        logger.debug(f'inference will be skipped when less than {change_thresh * 100}% of the ROI changes, '
+                     f'for at most {max_skip} consecutive frames')
+        self.input_shape = None
+        self.small_rgb, self.small_gray, self.reference, self.diff = None, None, None, None
+        self.frames_since_inference = 0
+        self.total_count = 0
+        self.skipped_count = 0
+        logger.info('MotionGate successfully initialized')
+
+    def allocate(self, img_shape):
+        height = max(1, round(self.width * img_shape[0] / img_shape[1]))
+        self.small_rgb = np.zeros((height, self.width, 3), dtype=np.uint8)
+        self.small_gray = np.zeros((height, self.width), dtype=np.uint8)
+        self.reference = np.zeros((height, self.width), dtype=np.uint8)
+        self.diff = np.zeros((height, self.width), dtype=np.uint8)
+        self.reset()
+
+    def should_infer(self, img):
+        """
+        decide whether img differs enough from the last analyzed frame to need a new inference
+        :param img: RGB ROI crop
+        :return: True if the detector should be run on img, False if the previous result can be reused
+        """
+        cv2 = cv2_api()
+        self.total_count += 1
+        if self.input_shape != img.shape:
+            self.allocate(img.shape)
+            self.input_shape = img.shape
+        cv2.resize(img, (self.width, self.small_rgb.shape[0]), dst=self.small_rgb, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self.small_rgb, cv2.COLOR_RGB2GRAY, dst=self.small_gray)
+        if self.frames_since_inference < self.max_skip:
+            cv2.absdiff(self.small_gray, self.reference, dst=self.diff)
+            cv2.threshold(self.diff, self.pixel_thresh, 255, cv2.THRESH_BINARY, dst=self.diff)
+            if cv2.countNonZero(self.diff) < self.change_thresh * self.diff.size:
+                self.frames_since_inference += 1
+                self.skipped_count += 1
+                return False
+        self.reference[...] = self.small_gray
+        self.frames_since_inference = 0
+        return True
+
+    def reset(self):
+        """force an inference on the next frame, e.g. because the ROI has moved"""
+        self.frames_since_inference = self.max_skip
+
+    def skip_fraction(self):
+        if not self.total_count:
+            return 0.0
+        return self.skipped_count / self.total_count
@@ -1,32 +1,361 @@
 """code for running light-weight object detection to locate animals and regions of interest (roi's)"""
 
-import cv2
-from pycoral.adapters import common
-from pycoral.adapters import detect
-from pycoral.utils.edgetpu import make_interpreter, run_inference
+import hashlib
+import numpy as np
+import queue
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import logging
-from time import perf_counter
+from functools import lru_cache
+from time import perf_counter, sleep
+
+from modules.metrics import NULL_METRICS
+from modules.utils import cv2_api
 logger = logging.getLogger(__name__)
 
+
+# pycoral is only needed for Edge TPU inference, and tflite_runtime only for CPU inference. Either can be absent, and
+# both are slow to import, so they are imported on first use rather than at startup
+@lru_cache(maxsize=None)
+def edgetpu_api():
+    """:return: pycoral's (make_interpreter, list_edge_tpus), or (None, None) if pycoral is not installed"""
+    try:
+        from pycoral.utils.edgetpu import make_interpreter, list_edge_tpus
+    except ImportError:
+        return None, None
+    return make_interpreter, list_edge_tpus
+
+
+@lru_cache(maxsize=None)
+def cpu_interpreter_class():
+    """:return: tflite_runtime's Interpreter, or None if tflite_runtime is not installed"""
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        return None
+    return Interpreter
+
+
+def hash_model(model_path):
+    """sha1 of a model file, used to tell apart results produced by different models"""
+    sha1 = hashlib.sha1()
+    with open(model_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class Detections:
+
+    def __init__(self, capacity):
+        """
+        detections as parallel arrays sorted by descending score, of which only the first len(self) rows are valid
+        :param capacity: maximum number of detections the model can return
+        """
+        self.boxes = np.zeros((capacity, 4), dtype=np.int32)  # xmin, ymin, xmax, ymax in image pixel coordinates
+        self.scores = np.zeros(capacity, dtype=np.float32)
+        self.class_ids = np.zeros(capacity, dtype=np.int32)
+        self.count = 0
+        self.timing = {'preprocess': 0.0, 'invoke': 0.0, 'postprocess': 0.0}
+
+    def __len__(self):
+        return self.count
+
+    def valid_boxes(self):
+        return self.boxes[:self.count]
+
+    def copy(self):
+        new = Detections(max(self.count, 1))
+        new.boxes[:self.count] = self.boxes[:self.count]
+        new.scores[:self.count] = self.scores[:self.count]
+        new.class_ids[:self.count] = self.class_ids[:self.count]
+        new.count = self.count
+        new.timing = dict(self.timing)
+        return new
+
+
 class DetectorBase:
 
-    def __init__(self, model_path, confidence_thresh=0.25):
+    def __init__(self, model_path, confidence_thresh=0.25, device=None, num_threads=1, metrics=None, name=None):
+        """
+        :param model_path: path to a tflite detection model. Must be compiled for the Edge TPU unless device='cpu'
+        :param confidence_thresh: minimum score for a detection to be returned
+        :param device: None for the first Edge TPU, a device string such as 'usb:0', or 'cpu' to run on tflite_runtime
+        :param num_threads: number of CPU threads the interpreter may use. Only used if device='cpu'
+        :param metrics: optional Metrics to record per-stage latencies to
+        :param name: prefix of the recorded latency histograms. Defaults to the model file name
+        """
         logger.debug(f'Beginning DetectorBase initialization for {model_path.name}')
+        self.metrics = metrics or NULL_METRICS
+        self.metric_names = {key: f'{name or model_path.stem}_{key}' for key in ('preprocess', 'invoke', 'postprocess')}
         self.confidence_thresh = confidence_thresh
         logger.debug(f'confidence threshold set to {confidence_thresh}')
-        self.interpreter = make_interpreter(str(model_path))
+        self.device = device
+        self.model_hash = hash_model(model_path)
+        self.interpreter = self.init_interpreter(model_path, device, num_threads)
         self.interpreter.allocate_tensors()
-        logger.debug(f'interpreter initialized and tensors allocated')
-        self.input_size = common.input_size(self.interpreter)
+        logger.debug(f'interpreter initialized on device "{device or "default"}" and tensors allocated')
+        input_details = self.interpreter.get_input_details()[0]
+        _, height, width, _ = input_details['shape']
+        self.input_size = (int(width), int(height))
+        self.input_index = input_details['index']
+        # quantized models take uint8 input, which lets cv2.resize write straight into the input tensor
+        self.direct_input = input_details['dtype'] == np.uint8
+        self.output_indices = self.map_output_tensors()
+        self.result = Detections(self.interpreter.tensor(self.output_indices['scores'])()[0].shape[0])
+        self.inference_count = 0
+        self.last_invoke_time = 0.0
+        self.total_timing = {'preprocess': 0.0, 'invoke': 0.0, 'postprocess': 0.0}
         logger.info(f'DetectorBase successfully initialized for {model_path.name}')
 
-    def detect(self, img):
-        scale = (self.input_size[1] / img.shape[1], self.input_size[0] / img.shape[0])
-        img = cv2.resize(img, self.input_size)
-        run_inference(self.interpreter, img.tobytes())
-        dets = detect.get_objects(self.interpreter, self.confidence_thresh, scale)
-        return sorted(dets, reverse=True, key=lambda x: x.score)
+    def set_confidence_thresh(self, confidence_thresh):
+        self.confidence_thresh = confidence_thresh
+
+    @staticmethod
+    def init_interpreter(model_path, device=None, num_threads=1):
+        if device == 'cpu':
+            cpu_interpreter = cpu_interpreter_class()
+            if cpu_interpreter is None:
+                raise ImportError('tflite_runtime must be installed to run detection on the CPU')
+            return cpu_interpreter(model_path=str(model_path), num_threads=num_threads)
+        make_interpreter, _ = edgetpu_api()
+        if make_interpreter is None:
+            raise ImportError('pycoral must be installed to run detection on an Edge TPU')
+        if device is None:
+            return make_interpreter(str(model_path))
+        return make_interpreter(str(model_path), device=device)
+
+    def map_output_tensors(self):
+        """find the tensor indices of the detection outputs, the same way pycoral's detect.get_objects does"""
+        signature_list = self.interpreter._get_full_signature_list()
+        if signature_list:
+            if len(signature_list) > 1:
+                raise ValueError('Only models with a single signature are supported')
+            outputs = signature_list[next(iter(signature_list))]['outputs']
+            return {'count': outputs['output_0'], 'scores': outputs['output_1'],
+                    'class_ids': outputs['output_2'], 'boxes': outputs['output_3']}
+        indices = [details['index'] for details in self.interpreter.get_output_details()]
+        if self.interpreter.tensor(indices[3])().size == 1:
+            return {'boxes': indices[0], 'class_ids': indices[1], 'scores': indices[2], 'count': indices[3]}
+        return {'scores': indices[0], 'boxes': indices[1], 'count': indices[2], 'class_ids': indices[3]}
+
+    def detect(self, img, out: Detections = None):
+        """
+        run detection on an RGB image of any size
+        :param img: RGB image as a uint8 array
+        :param out: optional Detections object to fill. If None, the detector's own result object is reused
+        :return: Detections with boxes scaled to img's pixel coordinates
+        """
+        result = self.result if out is None else out
+        t0 = perf_counter()
+        self.set_input(img)
+        t1 = perf_counter()
+        self.interpreter.invoke()
+        t2 = perf_counter()
+        self.get_detections(img.shape[1], img.shape[0], result)
+        t3 = perf_counter()
+        result.timing['preprocess'], result.timing['invoke'], result.timing['postprocess'] = t1 - t0, t2 - t1, t3 - t2
+        for key, value in result.timing.items():
+            self.total_timing[key] += value
+            self.metrics.observe(self.metric_names[key], value)
+        self.inference_count += 1
+        self.last_invoke_time = t2 - t1
+        return result
+
+    def set_input(self, img):
+        # the tensor view must not outlive this call, since tflite refuses to invoke while references are held
+        input_tensor = self.interpreter.tensor(self.input_index)()[0]
+        cv2 = cv2_api()
+        if self.direct_input:
+            cv2.resize(img, self.input_size, dst=input_tensor)
+        else:
+            input_tensor[...] = cv2.resize(img, self.input_size)
+
+    def get_detections(self, img_width, img_height, result: Detections):
+        count = int(self.interpreter.tensor(self.output_indices['count'])()[0])
+        scores = self.interpreter.tensor(self.output_indices['scores'])()[0][:count]
+        keep = np.flatnonzero(scores >= self.confidence_thresh)
+        order = keep[np.argsort(-scores[keep], kind='stable')]
+        n = min(len(order), len(result.scores))
+        order = order[:n]
+        # model boxes are normalized (ymin, xmin, ymax, xmax)
+        boxes = self.interpreter.tensor(self.output_indices['boxes'])()[0][order]
+        np.clip(boxes, 0.0, 1.0, out=boxes)
+        result.boxes[:n, 0] = boxes[:, 1] * img_width
+        result.boxes[:n, 1] = boxes[:, 0] * img_height
+        result.boxes[:n, 2] = boxes[:, 3] * img_width
+        result.boxes[:n, 3] = boxes[:, 2] * img_height
+        result.scores[:n] = scores[order]
+        result.class_ids[:n] = self.interpreter.tensor(self.output_indices['class_ids'])()[0][order]
+        result.count = n
+        return result
 
+    def mean_timing(self):
+        if not self.inference_count:
+            return dict(self.total_timing)
+        return {key: value / self.inference_count for key, value in self.total_timing.items()}
 
 
+class DetectorPool:
+
+    def __init__(self, model_path, confidence_thresh=0.25, edgetpu_devices='all', cpu_workers=0, cpu_threads=1,
+                 cpu_model_path=None, metrics=None, name=None):
+        """
+        DetectorBase instances for one model on Edge TPUs and CPU interpreters, each call going to the fastest free one
+        :param model_path: path to the Edge TPU compiled model
+        :param confidence_thresh: minimum score for a detection to be returned
+        :param edgetpu_devices: 'all' for every attached Edge TPU, a list of device strings, or None for none
+        :param cpu_workers: number of CPU interpreters to add. One is added anyway if no Edge TPU is found
+        :param cpu_threads: number of threads each CPU interpreter may use
+        :param cpu_model_path: path to a model that can run on the CPU. Defaults to model_path
+        :param metrics: optional Metrics, passed on to each DetectorBase
+        :param name: prefix of the recorded metrics. Defaults to the model file name
+        """
+        logger.debug(f'Beginning DetectorPool initialization for {model_path.name}')
+        if edgetpu_devices == 'all':
+            edgetpu_devices = self.find_edgetpu_devices()
+        edgetpu_devices = list(edgetpu_devices or [])
+        if not edgetpu_devices and not cpu_workers:
+            logger.warning(f'no Edge TPU available for {model_path.name}. Falling back to a single CPU interpreter')
+            cpu_workers = 1
+        cpu_model_path = cpu_model_path or model_path
+        self.detectors = [DetectorBase(model_path, confidence_thresh, device=device, metrics=metrics, name=name)
+                          for device in edgetpu_devices]
+        self.detectors += [DetectorBase(cpu_model_path, confidence_thresh, device='cpu', num_threads=cpu_threads,
+                                        metrics=metrics, name=name)
+                           for _ in range(cpu_workers)]
+        self.input_size = self.detectors[0].input_size
+        self.confidence_thresh = confidence_thresh
+        self.model_hash = self.detectors[0].model_hash
+        # free detectors are handed out fastest-first, based on a running estimate of their invoke time
+        self.invoke_estimates = [0.0] * len(self.detectors)
+        self.free = queue.PriorityQueue()
+        self.tiebreak = itertools.count()
+        for i in range(len(self.detectors)):
+            self.free.put((0.0, next(self.tiebreak), i))
+        self.executor = ThreadPoolExecutor(max_workers=len(self.detectors),
+                                           thread_name_prefix=f'detector_pool_{model_path.stem}')
+        self.lock = threading.Lock()
+        logger.info(f'DetectorPool successfully initialized for {model_path.name} with {len(edgetpu_devices)} '
+                    f'Edge TPU(s) and {cpu_workers} CPU interpreter(s)')
+
+    def set_confidence_thresh(self, confidence_thresh):
+        """change the minimum score of returned detections, e.g. after a config reload. Applies from the next detect"""
+        self.confidence_thresh = confidence_thresh
+        for detector in self.detectors:
+            detector.set_confidence_thresh(confidence_thresh)
+
+    @staticmethod
+    def find_edgetpu_devices():
+        _, list_edge_tpus = edgetpu_api()
+        if list_edge_tpus is None:
+            return []
+        return [f':{i}' for i in range(len(list_edge_tpus()))]
+
+    def __len__(self):
+        return len(self.detectors)
+
+    @contextmanager
+    def checkout(self):
+        _, _, i = self.free.get()
+        try:
+            yield self.detectors[i]
+        finally:
+            invoke_time = self.detectors[i].last_invoke_time
+            with self.lock:
+                self.invoke_estimates[i] = 0.8 * self.invoke_estimates[i] + 0.2 * invoke_time
+                estimate = self.invoke_estimates[i]
+            self.free.put((estimate, next(self.tiebreak), i))
+
+    def new_result(self):
+        return Detections(len(self.detectors[0].result.scores))
+
+    def detect(self, img, out: Detections = None):
+        """
+        run detection on the next free detector. Unlike DetectorBase, the returned Detections belongs to the caller
+        :param img: RGB image as a uint8 array
+        :param out: optional Detections object (see new_result) to fill instead of allocating a new one
+        """
+        with self.checkout() as detector:
+            if out is not None:
+                return detector.detect(img, out=out)
+            return detector.detect(img).copy()
+
+    def submit(self, img):
+        """queue an image for detection, returning a Future that resolves to its Detections"""
+        return self.executor.submit(self.detect, img)
+
+    def detect_batch(self, imgs):
+        """run detection on several images concurrently, returning their Detections in the same order"""
+        return [future.result() for future in [self.submit(img) for img in imgs]]
+
+    def mean_timing(self):
+        count = sum(detector.inference_count for detector in self.detectors)
+        totals = {key: sum(detector.total_timing[key] for detector in self.detectors)
+                  for key in self.detectors[0].total_timing}
+        if not count:
+            return totals
+        return {key: value / count for key, value in totals.items()}
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class StandInDetector:
+
+    def __init__(self, boxes=None, latency=0.0, busy=False, capacity=25, name='stand_in', sleep_func=sleep):
+        """
+        stand-in for DetectorBase/DetectorPool that returns fixed or computed detections after a set delay
+        :param boxes: list of (xmin, ymin, xmax, ymax) boxes to return, or a callable returning them for an image
+        :param latency: seconds each detect call takes, standing in for the invoke time
+        :param busy: if True, spin the CPU for the latency instead of sleeping, to mimic CPU inference
+        :param capacity: maximum number of detections returned
+        :param name: used to build a model_hash, so stand-ins can be told apart by a DetectionCache
+        :param sleep_func: sleeps for the given number of seconds, e.g. a VirtualClock's sleep in simulations
+        """
+        self.boxes = boxes if boxes is not None else []
+        self.sleep_func = sleep_func
+        self.latency = latency
+        self.busy = busy
+        self.capacity = capacity
+        self.confidence_thresh = 0.5
+        self.model_hash = hashlib.sha1(name.encode()).hexdigest()
+        self.input_size = (320, 320)
+        self.inference_count = 0
+        self.total_timing = {'preprocess': 0.0, 'invoke': 0.0, 'postprocess': 0.0}
+
+    def new_result(self):
+        return Detections(self.capacity)
+
+    def set_confidence_thresh(self, confidence_thresh):
+        self.confidence_thresh = confidence_thresh
+
+    def detect(self, img, out: Detections = None):
+        result = self.new_result() if out is None else out
+        t0 = perf_counter()
+        if self.busy:
+            while perf_counter() - t0 < self.latency:
+                pass
+        elif self.latency:
+            self.sleep_func(self.latency)
+        t1 = perf_counter()
+        boxes = self.boxes(img) if callable(self.boxes) else self.boxes
+        n = min(len(boxes), self.capacity)
+        if n:
+            result.boxes[:n] = boxes[:n]
+        result.scores[:n] = 0.9
+        result.class_ids[:n] = 0
+        result.count = n
+        t2 = perf_counter()
+        result.timing['preprocess'], result.timing['invoke'], result.timing['postprocess'] = 0.0, t1 - t0, t2 - t1
+        self.total_timing['invoke'] += t1 - t0
+        self.total_timing['postprocess'] += t2 - t1
+        self.inference_count += 1
+        return result
 
+    def mean_timing(self):
+        if not self.inference_count:
+            return dict(self.total_timing)
+        return {key: value / self.inference_count for key, value in self.total_timing.items()}
@@ -0,0 +1,153 @@
+"""code for running the active-mode frame analysis as a series of threaded stages connected by bounded queues"""
+
+import queue
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+DROP_POLICIES = ('drop_oldest', 'block')
+
+
+class _StopSignal:
+    pass
+
+
+STOP = _StopSignal()
+
+
+class FramePacket:
+    """container for a single frame and the data derived from it as it moves through the pipeline"""
+    __slots__ = ('timestamp', 'frame', 'img', 'dets', 'occupancy', 'frame_index', 'roi_box', 'inferred')
+
+    def __init__(self, timestamp, frame, frame_index=None):
+        # frame is the full captured buffer, img is the (possibly cropped) view currently being analyzed
+        self.timestamp, self.frame, self.img = timestamp, frame, frame
+        self.frame_index = frame_index
+        self.dets, self.occupancy = None, None
+        # the ROI the frame was cropped to, and whether OOI inference ran on it (rather than reusing earlier dets)
+        self.roi_box, self.inferred = None, False
+
+
+class StageQueue:
+
+    def __init__(self, name, maxsize=2, drop_policy='drop_oldest', on_drop=None):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f'drop_policy must be one of {DROP_POLICIES}, got {drop_policy}')
+        self.name = name
+        self.maxsize = maxsize
+        self.drop_policy = drop_policy
+        self.on_drop = on_drop
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.put_count = 0
+        self.drop_count = 0
+        self.max_depth = 0
+        self.depth_sum = 0
+
+    def put(self, item):
+        if item is STOP or self.drop_policy == 'block':
+            self.queue.put(item)
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        dropped = self.queue.get_nowait()
+                    except queue.Empty:
+                        continue
+                    self.drop_count += 1
+                    if self.on_drop is not None:
+                        self.on_drop(dropped)
+        depth = self.queue.qsize()
+        self.put_count += 1
+        self.depth_sum += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def get(self):
+        return self.queue.get()
+
+    def stats(self):
+        return {'puts': self.put_count,
+                'drops': self.drop_count,
+                'current_depth': self.queue.qsize(),
+                'max_depth': self.max_depth,
+                'mean_depth': (self.depth_sum / self.put_count) if self.put_count else 0.0}
+
+
+class PipelineStage(threading.Thread):
+
+    def __init__(self, name, func, in_queue: StageQueue, out_queue: StageQueue = None):
+        super().__init__(name=name, daemon=True)
+        self.func = func
+        self.in_queue, self.out_queue = in_queue, out_queue
+        self.processed_count = 0
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.in_queue.get()
+            if item is STOP:
+                break
+            if self.error is not None:
+                # keep draining so upstream stages never block on a dead consumer
+                continue
+            try:
+                result = self.func(item)
+            except Exception as e:
+                logger.exception(f'unhandled exception in pipeline stage {self.name}: {e}')
+                self.error = e
+                continue
+            self.processed_count += 1
+            if (self.out_queue is not None) and (result is not None):
+                self.out_queue.put(result)
+        if self.out_queue is not None:
+            self.out_queue.put(STOP)
+
+
+class Pipeline:
+
+    def __init__(self, stages, maxsize=2, drop_policy='drop_oldest', on_drop=None):
+        """
+        chain of worker threads, each fed by a bounded queue
+        :param stages: list of (name, func) tuples. A func returning None consumes the item
+        :param maxsize: maximum number of items waiting in front of each stage
+        :param drop_policy: 'drop_oldest' or 'block', for the first queue only. The queues between stages always block
+        :param on_drop: optional callback that receives each dropped item
+        """
+        logger.debug('Beginning Pipeline initialization')
+        self.queues = [StageQueue(name, maxsize, drop_policy if i == 0 else 'block', on_drop)
+                       for i, (name, _) in enumerate(stages)]
+        self.stages = []
+        for i, (name, func) in enumerate(stages):
+            out_queue = self.queues[i + 1] if i + 1 < len(self.queues) else None
+            self.stages.append(PipelineStage(name, func, self.queues[i], out_queue))
+        logger.debug(f'pipeline stages: {[name for name, _ in stages]}, queue size {maxsize}, '
+                     f'drop policy "{drop_policy}"')
+        logger.info('Pipeline successfully initialized')
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        logger.debug('pipeline started')
+
+    def submit(self, item):
+        self.raise_stage_errors()
+        self.queues[0].put(item)
+
+    def raise_stage_errors(self):
+        for stage in self.stages:
+            if stage.error is not None:
+                raise RuntimeError(f'pipeline stage {stage.name} failed') from stage.error
+
+    def stop(self, timeout=30):
+        self.queues[0].put(STOP)
+        for stage in self.stages:
+            stage.join(timeout)
+            if stage.is_alive():
+                logger.warning(f'pipeline stage {stage.name} did not exit within {timeout} seconds')
+        logger.debug(f'pipeline stopped. Queue stats: {self.stats()}')
+
+    def stats(self):
+        return {stage.name: dict(processed=stage.processed_count, **q.stats())
+                for stage, q in zip(self.stages, self.queues)}
@@ -0,0 +1,172 @@
+"""code for re-analyzing recorded videos offline, as fast as the available hardware allows"""
+
+import csv
+import os
+import logging
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from modules.data_collection import MockDataCollector
+from modules.behavior_recognition import BehaviorRecognizer
+from modules.frame_analysis import FrameAnalyzer, init_detectors
+from modules.object_detection import DetectorPool
+from modules.pipeline import FramePacket
+from modules.detection_cache import DetectionCache
+logger = logging.getLogger(__name__)
+
+FRAME_COLUMNS = ['frame_index', 'timestamp', 'roi_xmin', 'roi_ymin', 'roi_xmax', 'roi_ymax', 'occupancy',
+                 'ooi_inferred']
+DETECTION_COLUMNS = ['frame_index', 'xmin', 'ymin', 'xmax', 'ymax', 'score', 'class_id']
+CHECK_COLUMNS = ['timestamp', 'buffer_length', 'activity_fraction', 'behavior']
+
+
+def video_start_time(video_path):
+    """recover the recording start time from a file name generated by DataCollector.generate_h264_path"""
+    try:
+        return datetime.fromisoformat(Path(video_path).stem.replace('_', ':'))
+    except ValueError:
+        logger.debug(f'could not parse a start time from {Path(video_path).name}. Using the unix epoch instead')
+        return datetime.fromtimestamp(0)
+
+
+class VideoReplayer:
+
+    def __init__(self, config, roi_detector, ooi_detector, analysis_resolution=None, detection_cache=None):
+        """
+        runs the active mode analysis on recorded videos, timed by frame index rather than by the wall clock
+        :param config: project config namespace
+        :param roi_detector: DetectorPool (or DetectorBase) for the ROI model
+        :param ooi_detector: DetectorPool (or DetectorBase) for the OOI model
+        :param analysis_resolution: optional (width, height) to resize frames to before analysis
+        :param detection_cache: optional DetectionCache. Inference only runs for frames missing from the cache
+        """
+        logger.debug('Beginning VideoReplayer initialization')
+        self.config = config
+        self.detection_cache = detection_cache
+        self.frame_analyzer = FrameAnalyzer(config, roi_detector, ooi_detector, detection_cache)
+        self.behavior_recognizer = BehaviorRecognizer(config)
+        self.analysis_resolution = analysis_resolution
+        logger.info('VideoReplayer successfully initialized')
+
+    def replay(self, video_path, output_dir):
+        """
+        analyze one video and write its frame, detection, and behavior check tables to output_dir as csv files
+        :return: number of frames analyzed
+        """
+        video_path, output_dir = Path(video_path), Path(output_dir)
+        output_dir.mkdir(exist_ok=True, parents=True)
+        logger.info(f'replaying {video_path.name}')
+        collector = MockDataCollector(video_path, self.config.framegrab_interval, self.analysis_resolution)
+        self.frame_analyzer.reset()
+        self.behavior_recognizer.reset()
+        if self.detection_cache is not None:
+            self.detection_cache.open_video(video_path)
+        start_time = video_start_time(video_path)
+        next_behavior_check = start_time + timedelta(seconds=self.config.behavior_check_window)
+        behavior_check_interval = timedelta(seconds=self.config.behavior_check_interval)
+        expected_data_buffer_length = self.config.behavior_check_window / self.config.framegrab_interval
+        frame_count = 0
+        with open(output_dir / f'{video_path.stem}_frames.csv', 'w', newline='') as frame_file, \
+                open(output_dir / f'{video_path.stem}_detections.csv', 'w', newline='') as det_file, \
+                open(output_dir / f'{video_path.stem}_checks.csv', 'w', newline='') as check_file:
+            frame_writer, det_writer, check_writer = csv.writer(frame_file), csv.writer(det_file), \
+                csv.writer(check_file)
+            frame_writer.writerow(FRAME_COLUMNS)
+            det_writer.writerow(DETECTION_COLUMNS)
+            check_writer.writerow(CHECK_COLUMNS)
+            while True:
+                img = collector.capture_frame()
+                if img is False:
+                    break
+                frame_index = collector.current_frame - 1
+                timestamp = start_time + timedelta(seconds=frame_index / collector.framerate)
+                packet = self.frame_analyzer.analyze(FramePacket(timestamp, img, frame_index))
+                roi_box = self.frame_analyzer.roi_box or ('', '', '', '')
+                frame_writer.writerow([frame_index, timestamp.timestamp(), *roi_box,
+                                       '' if packet.dets is None else packet.occupancy,
+                                       int(self.frame_analyzer.inferred)])
+                if packet.dets is not None:
+                    self.behavior_recognizer.append_data(timestamp.timestamp(), packet.occupancy)
+                    if self.frame_analyzer.inferred:
+                        for i in range(len(packet.dets)):
+                            det_writer.writerow([frame_index, *packet.dets.boxes[i].tolist(),
+                                                 float(packet.dets.scores[i]), int(packet.dets.class_ids[i])])
+                if timestamp >= next_behavior_check:
+                    buffer_length = len(self.behavior_recognizer)
+                    if buffer_length < expected_data_buffer_length // 2:
+                        behavior = ''
+                    else:
+                        behavior = int(self.behavior_recognizer.check_for_behavior())
+                    check_writer.writerow([timestamp.timestamp(), buffer_length,
+                                           self.behavior_recognizer.calc_activity_fraction(), behavior])
+                    next_behavior_check = timestamp + behavior_check_interval
+                collector.release_frame(img)
+                frame_count += 1
+        collector.shutdown()
+        if self.detection_cache is not None:
+            self.detection_cache.close()
+        logger.info(f'finished replaying {video_path.name}: {frame_count} frames analyzed')
+        return frame_count
+
+
+# each replay worker process builds its own detectors once, bound to a single device, and reuses them for every video
+_worker_replayer = None
+
+
+def _init_worker(config, model_dir, device_queue, analysis_resolution, cache_dir):
+    global _worker_replayer
+    device = device_queue.get()
+    if device == 'cpu':
+        roi_detector, ooi_detector = init_detectors(config, model_dir, edgetpu_devices=None, cpu_workers=1)
+    else:
+        roi_detector, ooi_detector = init_detectors(config, model_dir, edgetpu_devices=[device], cpu_workers=0)
+    detection_cache = DetectionCache(cache_dir) if cache_dir else None
+    _worker_replayer = VideoReplayer(config, roi_detector, ooi_detector, analysis_resolution, detection_cache)
+
+
+def _replay_in_worker(video_path, output_dir):
+    return _worker_replayer.replay(video_path, output_dir)
+
+
+def replay_directory(video_dir, config, model_dir, output_dir, devices=None, analysis_resolution=None,
+                     cache_dir=None):
+    """
+    replay every mp4 in video_dir in parallel, with one worker process per device
+    :param video_dir: directory containing the recorded mp4s
+    :param config: project config namespace
+    :param model_dir: directory containing the model files
+    :param output_dir: directory the per-video csv tables are written to
+    :param devices: Edge TPU device strings or 'cpu', one worker each. Defaults to every Edge TPU, or one per core
+    :param analysis_resolution: optional (width, height) to resize frames to. Defaults to the config's, if any
+    :param cache_dir: optional DetectionCache directory detector outputs are read from and written to
+    :return: dict mapping each video path to the number of frames analyzed, or None if it failed
+    """
+    video_paths = sorted(Path(video_dir).glob('*.mp4'))
+    if not video_paths:
+        logger.warning(f'no mp4 files found in {video_dir}')
+        return {}
+    if not devices:
+        devices = DetectorPool.find_edgetpu_devices() or ['cpu'] * (os.cpu_count() or 1)
+    devices = devices[:len(video_paths)]
+    if analysis_resolution is None and config.analysis_h_resolution and config.analysis_v_resolution:
+        analysis_resolution = (config.analysis_h_resolution, config.analysis_v_resolution)
+    logger.info(f'replaying {len(video_paths)} videos on {len(devices)} worker(s): {devices}')
+    results = {}
+    with multiprocessing.Manager() as manager:
+        device_queue = manager.Queue()
+        for device in devices:
+            device_queue.put(device)
+        with ProcessPoolExecutor(max_workers=len(devices), initializer=_init_worker,
+                                 initargs=(config, Path(model_dir), device_queue, analysis_resolution,
+                                           cache_dir)) as executor:
+            futures = {video_path: executor.submit(_replay_in_worker, video_path, output_dir)
+                       for video_path in video_paths}
+            for video_path, future in futures.items():
+                try:
+                    results[video_path] = future.result()
+                except Exception as e:
+                    logger.exception(f'replay of {video_path.name} failed: {e}')
+                    results[video_path] = None
+    return results
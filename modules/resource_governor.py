@@ -0,0 +1,232 @@
+"""code for adapting the analysis load to the CPU's temperature, clock speed, load, and free memory"""
+
+import logging
+import os
+import time
+from pathlib import Path
+
+from modules.metrics import NULL_METRICS
+from modules.frame_analysis import THUMBNAIL_SCALE
+logger = logging.getLogger(__name__)
+
+# files read by SystemSensors, relative to its root
+SENSOR_FILES = {'temperature': 'sys/class/thermal/thermal_zone0/temp',
+                'frequency': 'sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq',
+                'max_frequency': 'sys/devices/system/cpu/cpu0/cpufreq/cpuinfo_max_freq',
+                'loadavg': 'proc/loadavg',
+                'meminfo': 'proc/meminfo'}
+RESOURCE_LOG_HEADER = 'time,step,framegrab_interval,ooi_stride,thumbnail_scale,temperature,frequency,load,memory'
+
+
+class SystemSensors:
+
+    def __init__(self, root='/', cpu_count=None):
+        """
+        reads the CPU temperature, clock speed, load, and available memory from the sys and proc filesystems
+        :param root: directory holding the sys and proc trees, e.g. one written by write_sensor_files
+        :param cpu_count: number of CPU cores the load average is divided by. Defaults to the cores on this machine
+        """
+        self.root = Path(root)
+        self.cpu_count = cpu_count or os.cpu_count() or 1
+
+    def read_file(self, name):
+        try:
+            with open(self.root / SENSOR_FILES[name], 'r') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def read_number(self, name):
+        text = self.read_file(name)
+        try:
+            return float(text.split()[0]) if text else None
+        except ValueError:
+            return None
+
+    def read(self):
+        """
+        :return: dict of the temperature (C), frequency (fraction of the max), load (per core), and memory (fraction
+            available). Unavailable readings are None
+        """
+        temperature = self.read_number('temperature')
+        frequency, max_frequency = self.read_number('frequency'), self.read_number('max_frequency')
+        load = self.read_number('loadavg')
+        memory = None
+        meminfo = self.read_file('meminfo')
+        if meminfo:
+            fields = dict(line.split(':', 1) for line in meminfo.splitlines() if ':' in line)
+            try:
+                memory = int(fields['MemAvailable'].split()[0]) / int(fields['MemTotal'].split()[0])
+            except (KeyError, ValueError, ZeroDivisionError):
+                memory = None
+        return {'temperature': None if temperature is None else temperature / 1000,
+                'frequency': frequency / max_frequency if frequency and max_frequency else None,
+                'load': None if load is None else load / self.cpu_count,
+                'memory': memory}
+
+
+def write_sensor_files(root, temperature=50.0, frequency=1500000, max_frequency=1500000, load=0.5,
+                       memory=0.5):
+    """
+    write stand-ins for the files read by SystemSensors under root. Call again to change the readings
+    :param temperature: CPU temperature in degrees C
+    :param frequency: current CPU clock speed in kHz
+    :param max_frequency: maximum CPU clock speed in kHz
+    :param load: 1 minute load average (over all cores)
+    :param memory: fraction of memory available
+    """
+    root = Path(root)
+    total_kb = 4000000
+    contents = {'temperature': f'{int(temperature * 1000)}\n',
+                'frequency': f'{int(frequency)}\n',
+                'max_frequency': f'{int(max_frequency)}\n',
+                'loadavg': f'{load:.2f} {load:.2f} {load:.2f} 1/100 1000\n',
+                'meminfo': f'MemTotal: {total_kb} kB\nMemFree: {int(total_kb * memory)} kB\n'
+                           f'MemAvailable: {int(total_kb * memory)} kB\n'}
+    for name, text in contents.items():
+        path = root / SENSOR_FILES[name]
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        tmp_path.write_text(text)
+        os.replace(tmp_path, path)
+
+
+class ResourceGovernor:
+
+    def __init__(self, config, sensors=None, log_path=None, time_func=time.time, metrics=None):
+        """
+        steps the analysis load down a ladder of settings (see build_ladder) under CPU pressure, and back up after
+        :param config: project config namespace. See the resource_* parameters
+        :param sensors: optional SystemSensors or stand-in. Defaults to reading config.resource_sensor_root
+        :param log_path: optional csv file each change of settings is appended to, with the readings that caused it
+        :param time_func: returns the current time in seconds since the epoch
+        :param metrics: optional Metrics to record the readings and current settings to
+        """
+        logger.debug('Beginning ResourceGovernor initialization')
+        self.sensors = sensors
+        self.log_path = None if log_path is None else Path(log_path)
+        self.time_func = time_func
+        self.metrics = metrics or NULL_METRICS
+        self.step = 0
+        self.next_check = 0
+        self.last_change = None
+        self.calm_since = None
+        self.readings = {}
+        self.configure(config)
+        logger.info('ResourceGovernor successfully initialized')
+
+    def configure(self, config):
+        self.config = config
+        if self.sensors is None or isinstance(self.sensors, SystemSensors):
+            if self.sensors is None or self.sensors.root != Path(config.resource_sensor_root):
+                self.sensors = SystemSensors(config.resource_sensor_root)
+        self.check_interval = config.resource_check_interval
+        self.ladder = self.build_ladder(config)
+        if self.step >= len(self.ladder):
+            self.step = len(self.ladder) - 1
+
+    @property
+    def enabled(self):
+        return self.check_interval > 0
+
+    @staticmethod
+    def build_ladder(config):
+        """:return: list of framegrab_factor, ooi_stride, and thumbnail_scale dicts, from normal to the lowest load"""
+        ladder = [{'framegrab_factor': 1, 'ooi_stride': 1, 'thumbnail_scale': THUMBNAIL_SCALE}]
+        if config.resource_thumbnail_scale > THUMBNAIL_SCALE:
+            ladder.append(dict(ladder[-1], thumbnail_scale=config.resource_thumbnail_scale))
+        if config.resource_ooi_stride > 1:
+            ladder.append(dict(ladder[-1], ooi_stride=config.resource_ooi_stride))
+        for factor in range(2, config.resource_max_interval_factor + 1):
+            ladder.append(dict(ladder[-1], framegrab_factor=factor))
+        return ladder
+
+    @property
+    def settings(self):
+        return self.ladder[self.step]
+
+    def under_pressure(self, readings):
+        """:return: list of the reasons the readings count as pressure"""
+        config = self.config
+        temperature, frequency, load, memory = (readings[key] for key in ('temperature', 'frequency', 'load',
+                                                                           'memory'))
+        reasons = []
+        if temperature is not None and temperature >= config.resource_temp_high:
+            reasons.append(f'temperature {temperature:.1f}C')
+        if frequency is not None and frequency < 0.9 and load is not None and load >= config.resource_load_low:
+            reasons.append(f'throttled to {frequency * 100:.0f}% clock speed')
+        if load is not None and load >= config.resource_load_high:
+            reasons.append(f'load {load:.2f} per core')
+        if memory is not None and memory < config.resource_memory_low:
+            reasons.append(f'{memory * 100:.0f}% memory available')
+        return reasons
+
+    def calm(self, readings):
+        """:return: whether every reading is back in its normal range, with a margin below the pressure thresholds"""
+        config = self.config
+        temperature, frequency, load, memory = (readings[key] for key in ('temperature', 'frequency', 'load',
+                                                                           'memory'))
+        return ((temperature is None or temperature <= config.resource_temp_low)
+                and (load is None or load <= config.resource_load_low)
+                and (memory is None or memory >= config.resource_memory_high))
+
+    def check(self):
+        """
+        take a reading, at most once per check interval, and step the analysis load down under pressure or up when calm
+        :return: the new settings (see build_ladder) if they changed, otherwise None
+        """
+        now = self.time_func()
+        if not self.enabled or now < self.next_check:
+            return None
+        self.next_check = now + self.check_interval
+        self.readings = self.sensors.read()
+        for key, value in self.readings.items():
+            if value is not None:
+                self.metrics.set_gauge(f'resource_{key}', value)
+        reasons = self.under_pressure(self.readings)
+        previous = self.step
+        if reasons:
+            self.calm_since = None
+            settled = self.last_change is None or now - self.last_change >= self.config.resource_adjust_interval
+            if settled and self.step < len(self.ladder) - 1:
+                self.step += 1
+                logger.warning(f'lowering the analysis load ({", ".join(reasons)}): {self.describe()}')
+        elif self.calm(self.readings) and self.step > 0:
+            if self.calm_since is None:
+                self.calm_since = now
+            elif now - self.calm_since >= self.config.resource_recovery_time:
+                self.step -= 1
+                self.calm_since = now
+                logger.info(f'raising the analysis load, as the CPU has recovered: {self.describe()}')
+        else:
+            self.calm_since = None
+        self.metrics.set_gauge('resource_step', self.step)
+        if self.step == previous:
+            return None
+        self.last_change = now
+        self.metrics.increment('resource_adjustments')
+        self.log_settings(now)
+        return self.settings
+
+    def describe(self):
+        settings = self.settings
+        return (f'framegrab interval {settings["framegrab_factor"] * self.config.framegrab_interval:.2f}s, OOI '
+                f'detection on every {settings["ooi_stride"]} frame(s), thumbnails at 1/{settings["thumbnail_scale"]} '
+                f'scale')
+
+    def log_settings(self, now):
+        if self.log_path is None:
+            return
+        settings, readings = self.settings, self.readings
+        values = [f'{now:.3f}', self.step, f'{settings["framegrab_factor"] * self.config.framegrab_interval:.3f}',
+                  settings['ooi_stride'], settings['thumbnail_scale']]
+        values += ['' if readings.get(key) is None else f'{readings[key]:.3f}'
+                   for key in ('temperature', 'frequency', 'load', 'memory')]
+        try:
+            new_file = not self.log_path.exists()
+            with open(self.log_path, 'a') as f:
+                if new_file:
+                    f.write(RESOURCE_LOG_HEADER + '\n')
+                f.write(','.join(str(value) for value in values) + '\n')
+        except OSError as e:
+            logger.warning(f'failed to write to {self.log_path}: {e}')
@@ -0,0 +1,138 @@
+"""code for deciding when the region of interest needs to be re-detected"""
+
+import numpy as np
+from datetime import timedelta
+import logging
+
+from modules.utils import cv2_api
+logger = logging.getLogger(__name__)
+
+
+class RoiTracker:
+
+    def __init__(self, max_age=600, drift_thresh=0.5, check_interval=5, confirm_checks=3, retry_initial=1,
+                 retry_max=60, border=12, width=160):
+        """
+        tracks the current ROI and checks for drift by correlating the edges around its boundary with a reference
+        :param max_age: seconds after which the ROI is re-detected even if no drift was seen
+        :param drift_thresh: correlation (between -1 and 1) below which a border check counts as failed
+        :param check_interval: number of frames between border checks. 0 disables drift detection
+        :param confirm_checks: number of consecutive failed checks needed to declare drift
+        :param retry_initial: seconds to wait before retrying a failed ROI detection. Doubles with each failure
+        :param retry_max: maximum seconds between retries after failed ROI detections
+        :param border: half-width (in pixels, at full resolution) of the strip around the ROI boundary
+        :param width: width (in pixels) the strip region is downsampled to before comparison
+        """
+        logger.debug('Beginning RoiTracker initialization')
+        self.configure(max_age, drift_thresh, check_interval, confirm_checks, retry_initial, retry_max)
+        self.border = border
+        self.width = width
+        self.reset()
+        logger.info('RoiTracker successfully initialized')
+
+    def configure(self, max_age, drift_thresh, check_interval, confirm_checks, retry_initial, retry_max):
+        """set the tracking parameters (see __init__). Can be called at any time, e.g. after a config reload"""
+        self.max_age = timedelta(seconds=max_age)
+        self.drift_thresh = drift_thresh
+        self.check_interval = check_interval
+        self.confirm_checks = confirm_checks
+        self.retry_initial, self.retry_max = retry_initial, retry_max
+        logger.debug(f'ROI will be re-detected every {self.max_age} or when border correlation stays below '
+                     f'{drift_thresh} for {confirm_checks} checks')
+
+    def reset(self):
+        self.box = None
+        self.detected_at = None
+        self.next_attempt = None
+        self.failure_count = 0
+        self.drifted = False
+        self.failed_checks = 0
+        self.frames_since_check = 0
+        self.region, self.small_size, self.sides = None, None, None
+        self.references = []
+
+    def needs_detection(self, current_datetime):
+        if self.next_attempt is not None and current_datetime < self.next_attempt:
+            return False
+        if self.box is None or self.drifted:
+            return True
+        return current_datetime - self.detected_at >= self.max_age
+
+    def set_roi(self, box, img, current_datetime):
+        """
+        record a newly detected ROI and take a reference snapshot of its border
+        :param box: (xmin, ymin, xmax, ymax) in img pixel coordinates
+        :param img: the full RGB frame the ROI was detected in
+        """
+        self.box = tuple(int(v) for v in box)
+        self.detected_at = current_datetime
+        self.next_attempt = None
+        self.failure_count = 0
+        self.drifted = False
+        self.failed_checks = 0
+        self.frames_since_check = 0
+        xmin, ymin, xmax, ymax = self.box
+        height, width = img.shape[:2]
+        x0, y0 = max(0, xmin - self.border), max(0, ymin - self.border)
+        x1, y1 = min(width, xmax + self.border), min(height, ymax + self.border)
+        self.region = np.s_[y0:y1, x0:x1]
+        scale = min(1.0, self.width / max(1, x1 - x0))
+        self.small_size = (max(1, round((x1 - x0) * scale)), max(1, round((y1 - y0) * scale)))
+        # one strip per side of the ROI boundary, in downsampled coordinates. Sides are compared separately because
+        # a shift along one axis leaves the two sides parallel to it almost unchanged
+        b = max(1, round(self.border * scale))
+        ix0, iy0 = round((xmin - x0) * scale), round((ymin - y0) * scale)
+        ix1, iy1 = round((xmax - x0) * scale), round((ymax - y0) * scale)
+        self.sides = [np.s_[max(0, iy0 - b):iy0 + b, ix0:ix1], np.s_[max(0, iy1 - b):iy1 + b, ix0:ix1],
+                      np.s_[iy0:iy1, max(0, ix0 - b):ix0 + b], np.s_[iy0:iy1, max(0, ix1 - b):ix1 + b]]
+        self.references = []
+        for side in self.border_signature(img):
+            side = side - side.mean()
+            energy = float((side * side).sum())
+            # sides without any edges carry no information about drift and are skipped
+            self.references.append((side, energy) if energy else None)
+        if not any(self.references):
+            logger.debug('no edges found along the ROI border. Drift detection disabled until the next ROI update')
+        logger.debug(f'ROI set to {self.box}')
+
+    def report_failure(self, current_datetime):
+        self.failure_count += 1
+        delay = min(self.retry_initial * 2 ** (self.failure_count - 1), self.retry_max)
+        self.next_attempt = current_datetime + timedelta(seconds=delay)
+        logger.debug(f'ROI detection failed {self.failure_count} time(s) in a row. Retrying in {delay} seconds')
+
+    def border_signature(self, img):
+        cv2 = cv2_api()
+        patch = cv2.resize(img[self.region], self.small_size, interpolation=cv2.INTER_AREA)
+        edges = cv2.Canny(cv2.cvtColor(patch, cv2.COLOR_RGB2GRAY), 50, 150)
+        edges = cv2.GaussianBlur(edges, (5, 5), 0).astype(np.float32)
+        return [edges[side] for side in self.sides]
+
+    def validate(self, img):
+        """
+        compare the ROI border in img to the reference snapshot, every check_interval frames
+        :param img: the full RGB frame
+        :return: False if the ROI has been found to drift, True otherwise
+        """
+        if self.box is None or self.drifted or not self.check_interval or not any(self.references):
+            return not self.drifted
+        self.frames_since_check += 1
+        if self.frames_since_check < self.check_interval:
+            return True
+        self.frames_since_check = 0
+        correlation = 1.0
+        for side, reference in zip(self.border_signature(img), self.references):
+            if reference is None:
+                continue
+            reference, energy = reference
+            side = side - side.mean()
+            denominator = np.sqrt((side * side).sum() * energy)
+            correlation = min(correlation, float((side * reference).sum() / denominator) if denominator else 0.0)
+        if correlation < self.drift_thresh:
+            self.failed_checks += 1
+            if self.failed_checks >= self.confirm_checks:
+                logger.info(f'ROI drift detected (border correlation {correlation:.2f}). Scheduling re-detection')
+                self.drifted = True
+        else:
+            self.failed_checks = 0
+        return not self.drifted
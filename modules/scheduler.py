@@ -0,0 +1,133 @@
+"""code for timing framegrabs on a fixed grid of deadlines"""
+
+import logging
+import time
+from collections import deque
+
+from modules.metrics import NULL_METRICS
+logger = logging.getLogger(__name__)
+
+POLICIES = ('skip', 'catch_up')
+
+
+class FrameScheduler:
+
+    def __init__(self, interval, policy='skip', adaptive=False, max_interval=None, adapt_window=50,
+                 overload_thresh=0.9, recovery_thresh=0.6, max_backlog=10, time_func=time.time,
+                 sleep_func=time.sleep, metrics=None):
+        """
+        hands out framegrab times on an absolute grid (origin + n * interval), so an overrun does not delay later ones
+        :param interval: base framegrab interval, in seconds
+        :param policy: on missed ticks, 'skip' to the latest one or 'catch_up' by returning each, back to back
+        :param adaptive: whether to raise the interval by whole base intervals under load, and lower it again after
+        :param max_interval: upper limit on the adaptive interval, in seconds. Defaults to 4 times the base interval
+        :param adapt_window: number of ticks averaged before the interval can change
+        :param overload_thresh: mean processing time, as a fraction of the interval, above which it is raised
+        :param recovery_thresh: the same, as a fraction of the next shorter interval, below which it is lowered
+        :param max_backlog: number of missed ticks beyond which 'catch_up' skips ahead anyway
+        :param time_func: returns the current time in seconds since the epoch
+        :param sleep_func: sleeps for the given number of seconds
+        :param metrics: optional Metrics to record lateness and skipped ticks to
+        """
+        logger.debug('Beginning FrameScheduler initialization')
+        if policy not in POLICIES:
+            raise ValueError(f'invalid framegrab policy {policy}. Choose one of {POLICIES}')
+        self.base_interval = interval
+        self.policy = policy
+        self.adaptive = adaptive
+        self.max_step = max(1, int(round((max_interval or 4 * interval) / interval)))
+        self.adapt_window = adapt_window
+        self.overload_thresh, self.recovery_thresh = overload_thresh, recovery_thresh
+        self.max_backlog = max_backlog
+        self.time_func, self.sleep_func = time_func, sleep_func
+        self.metrics = metrics or NULL_METRICS
+        self.work_times = deque(maxlen=adapt_window)
+        self.min_step = 1
+        self.start()
+        logger.info('FrameScheduler successfully initialized')
+
+    @property
+    def interval(self):
+        return self.step * self.base_interval
+
+    def start(self, origin=None):
+        """anchor the grid at origin (default: now). The first tick is origin itself, which is not returned by wait"""
+        self.origin = self.time_func() if origin is None else origin
+        self.tick_index = 0
+        self.step = self.min_step
+        self.last_return = self.origin
+        self.work_times.clear()
+        self.tick_count, self.skipped_count, self.late_count = 0, 0, 0
+        self.lateness_sum, self.max_lateness = 0.0, 0.0
+        self.interval_changes = 0
+
+    def tick_time(self, tick_index):
+        return self.origin + tick_index * self.base_interval
+
+    def wait(self):
+        """
+        sleep until the next tick is due
+        :return: the scheduled time of the tick (seconds since the epoch) on the grid, not the time wait returned
+        """
+        now = self.time_func()
+        if self.adaptive:
+            self.adapt(now - self.last_return)
+        self.tick_index += self.step
+        deadline = self.tick_time(self.tick_index)
+        if deadline > now:
+            self.sleep_func(deadline - now)
+            now = self.time_func()
+        missed = int((now - deadline) // self.interval)
+        if missed > 0 and (self.policy == 'skip' or missed > self.max_backlog):
+            self.tick_index += missed * self.step
+            self.skipped_count += missed
+            self.metrics.increment('frames_skipped', missed)
+            deadline = self.tick_time(self.tick_index)
+        self.record_lateness(max(now - deadline, 0.0))
+        self.last_return = now
+        return deadline
+
+    def record_lateness(self, lateness):
+        self.tick_count += 1
+        self.lateness_sum += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        if lateness >= 0.1 * self.interval:
+            self.late_count += 1
+        self.metrics.observe('framegrab_lateness', lateness)
+
+    def adapt(self, work_time):
+        """raise or lower the interval based on the mean time spent between ticks over the last adapt_window ticks"""
+        self.work_times.append(work_time)
+        if len(self.work_times) < self.adapt_window:
+            return
+        mean_work = sum(self.work_times) / len(self.work_times)
+        if mean_work > self.overload_thresh * self.interval and self.step < self.max_step:
+            self.step += 1
+            logger.info(f'frames taking {mean_work:.3f}s on average. Framegrab interval raised to {self.interval:.3f}s')
+        elif self.step > self.min_step and mean_work < self.recovery_thresh * (self.step - 1) * self.base_interval:
+            self.step -= 1
+            logger.info(f'frames taking {mean_work:.3f}s on average. Framegrab interval lowered to '
+                        f'{self.interval:.3f}s')
+        else:
+            return
+        self.interval_changes += 1
+        self.work_times.clear()
+        self.metrics.set_gauge('framegrab_interval', self.interval)
+
+    def set_min_step(self, min_step):
+        """keep the interval at (or, if adaptive, above) min_step base intervals from the next tick on"""
+        self.min_step = max(1, int(min_step))
+        self.max_step = max(self.max_step, self.min_step)
+        if self.step < self.min_step or not self.adaptive:
+            self.step = self.min_step
+        self.work_times.clear()
+        self.metrics.set_gauge('framegrab_interval', self.interval)
+
+    def stats(self):
+        return {'ticks': self.tick_count,
+                'skipped': self.skipped_count,
+                'late': self.late_count,
+                'mean_lateness': (self.lateness_sum / self.tick_count) if self.tick_count else 0.0,
+                'max_lateness': self.max_lateness,
+                'interval': self.interval,
+                'interval_changes': self.interval_changes}
@@ -0,0 +1,306 @@
+"""code for soak-testing full days of active and passive mode on a virtual clock, without a camera or accelerator"""
+
+import gc
+import json
+import logging
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from modules.benchmark import animal_boxes, environment_info
+from modules.clock import VirtualClock
+from modules.config_manager import ConfigManager
+from modules.data_collection import SyntheticDataCollector, RECORDING_BITRATE
+from modules.metrics import process_memory
+from modules.object_detection import StandInDetector
+from modules.resource_governor import write_sensor_files
+logger = logging.getLogger(__name__)
+
+# stand-ins for the external tools used by the Uploader. ffmpeg "converts" by copying the h264 and appending a few
+# bytes (conversion only counts as successful if the mp4 is larger), and rclone treats the remote as a local directory
+STAND_IN_FFMPEG = '''#!{python}
+import shutil, sys
+args = sys.argv[1:]
+source, destination = args[args.index('-i') + 1], args[-1]
+shutil.copyfile(source, destination)
+with open(destination, 'ab') as f:
+    f.write(b'stand-in mp4 container')
+'''
+
+STAND_IN_RCLONE = '''#!{python}
+import os, shutil, sys
+command, source, destination = sys.argv[1:4]
+os.makedirs(os.path.dirname(destination), exist_ok=True)
+(shutil.move if command == 'moveto' else shutil.copyfile)(source, destination)
+'''
+
+
+def write_stand_in_tools(bin_dir):
+    """write stand-in ffmpeg and rclone executables to bin_dir. :return: bin_dir"""
+    bin_dir = Path(bin_dir)
+    bin_dir.mkdir(exist_ok=True, parents=True)
+    for name, script in (('ffmpeg', STAND_IN_FFMPEG), ('rclone', STAND_IN_RCLONE)):
+        path = bin_dir / name
+        path.write_text(script.format(python=sys.executable))
+        path.chmod(path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return bin_dir
+
+
+class NotificationSink:
+
+    def __init__(self):
+        """local http server that accepts notifications from an HttpTransport, standing in for SendGrid"""
+        self.received = []
+        sink = self
+
+        class SinkHandler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                sink.received.append({'subject': payload['subject'], 'to_email': payload['to_email'],
+                                      'attachment_bytes': len(payload.get('attachment_content') or '')})
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), SinkHandler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/notify'
+        threading.Thread(target=self.server.serve_forever, name='notification_sink', daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SimulatedCamera(SyntheticDataCollector):
+
+    def __init__(self, video_dir, clock, resolution=(816, 608), roi_fraction=0.5, segment_bytes=65536,
+                 frame_pool_size=4, bitrate=None):
+        """
+        SyntheticDataCollector that also "records" placeholder h264 segments, named from the clock's time
+        :param video_dir: directory to write the placeholder segments to
+        :param clock: clock used to name segments
+        :param segment_bytes: size of each placeholder segment
+        :param bitrate: if set, segments instead grow at this many bits per virtual second, scaled like the camera's
+        """
+        super().__init__(resolution, roi_fraction, frame_pool_size=frame_pool_size)
+        self.video_dir = Path(video_dir)
+        self.video_dir.mkdir(exist_ok=True, parents=True)
+        self.clock = clock
+        self.segment_bytes = segment_bytes
+        self.bitrate = bitrate
+        self.recording_options, self.pending_options = {}, None
+        self.h264_path = None
+        self.last_write = None
+        self.segment_count = 0
+
+    def generate_h264_path(self):
+        iso_string = self.clock.now().isoformat(timespec='seconds').replace(':', '_')
+        return self.video_dir / f'{iso_string}.h264'
+
+    def open_segment(self):
+        if self.pending_options is not None:
+            self.recording_options, self.pending_options = self.pending_options, None
+        self.h264_path = self.generate_h264_path()
+        with open(self.h264_path, 'wb') as f:
+            f.write(os.urandom(self.segment_bytes if self.bitrate is None else 1024))
+        self.last_write = self.clock.time()
+        self.segment_count += 1
+
+    def set_recording_options(self, **options):
+        self.pending_options = options
+
+    def capture_frame(self):
+        if self.bitrate is not None and self.h264_path is not None:
+            now = self.clock.time()
+            scale = self.recording_options.get('bitrate', RECORDING_BITRATE) / RECORDING_BITRATE
+            with open(self.h264_path, 'ab') as f:
+                f.write(bytes(int(self.bitrate * scale / 8 * (now - self.last_write))))
+            self.last_write = now
+        return super().capture_frame()
+
+    def start_recording(self):
+        self.open_segment()
+
+    def split_recording(self):
+        closed_path = self.h264_path
+        self.open_segment()
+        return closed_path
+
+    def stop_recording(self):
+        closed_path, self.h264_path = self.h264_path, None
+        return closed_path
+
+    def shutdown(self):
+        return self.stop_recording()
+
+
+def open_file_count():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+class SoakMonitor:
+
+    def __init__(self, runner, camera, clock, sink, cloud_dir, interval=3600):
+        """samples throughput and resource usage every interval seconds of virtual time"""
+        self.runner, self.camera, self.clock, self.sink, self.cloud_dir = runner, camera, clock, sink, Path(cloud_dir)
+        self.interval = interval
+        self.samples = []
+        self.real_start = time.perf_counter()
+        self.virtual_start = clock.time()
+        self.next_sample = self.virtual_start
+
+    def on_advance(self, now):
+        if now >= self.next_sample:
+            self.next_sample = now + self.interval
+            self.sample(now)
+
+    def sample(self, now):
+        current_memory, peak_memory = process_memory()
+        project_dir = self.runner.project_dir
+        self.samples.append({
+            'virtual_time': datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+            'virtual_elapsed_s': now - self.virtual_start,
+            'real_elapsed_s': time.perf_counter() - self.real_start,
+            'frames': self.camera.current_frame,
+            'rss_bytes': current_memory,
+            'peak_rss_bytes': peak_memory,
+            'python_objects': len(gc.get_objects()),
+            'open_files': open_file_count(),
+            'threads': threading.active_count(),
+            'frames_checked_out': self.camera.frame_pool.checked_out(),
+            'frame_pool_size': len(self.camera.frame_pool.buffers),
+            'behavior_buffer_bytes': self.runner.behavior_recognizer.buffer_nbytes(),
+            'local_videos': sum(1 for p in (project_dir / 'Videos').glob('*') if p.is_file()),
+            'disk_free_bytes': shutil.disk_usage(project_dir).free,
+            'queued_notifications': len(list((project_dir / 'NotificationQueue').glob('*.json'))),
+            'notifications_received': len(self.sink.received),
+            'cloud_files': sum(1 for p in self.cloud_dir.rglob('*') if p.is_file()),
+        })
+
+    def summary(self):
+        first, last = self.samples[0], self.samples[-1]
+        days = (last['virtual_elapsed_s'] - first['virtual_elapsed_s']) / 86400
+        real_elapsed = last['real_elapsed_s'] - first['real_elapsed_s']
+        # growth is measured from the end of the first simulated day, once caches and buffers have warmed up, so the
+        # memory growth rate is only reported for runs longer than a day
+        warm = next((s for s in self.samples if s['virtual_elapsed_s'] >= 86400), first)
+        warm_days = (last['virtual_elapsed_s'] - warm['virtual_elapsed_s']) / 86400
+        rss_growth = None
+        if warm is not first and warm_days > 0 and warm['rss_bytes'] is not None and last['rss_bytes'] is not None:
+            rss_growth = (last['rss_bytes'] - warm['rss_bytes']) / warm_days
+        leaks = {key: last[key] - warm[key] for key in ('open_files', 'threads', 'python_objects')
+                 if last[key] is not None and warm[key] is not None}
+        leaks['frames_checked_out'] = last['frames_checked_out']
+        leaks['frame_pool_growth'] = last['frame_pool_size'] - first['frame_pool_size']
+        leaks['queued_notifications'] = last['queued_notifications']
+        leaks['unconverted_videos'] = len(list((self.runner.project_dir / 'Videos').glob('*.h264')))
+        return {'simulated_days': days,
+                'real_seconds': real_elapsed,
+                'speedup': (days * 86400 / real_elapsed) if real_elapsed else None,
+                'frames': last['frames'],
+                'frames_per_real_second': (last['frames'] / real_elapsed) if real_elapsed else None,
+                'segments_recorded': self.camera.segment_count,
+                'notifications_received': last['notifications_received'],
+                'cloud_files': last['cloud_files'],
+                'min_disk_free_bytes': min(s['disk_free_bytes'] for s in self.samples),
+                'rss_growth_bytes_per_day': rss_growth,
+                'peak_rss_bytes': last['peak_rss_bytes'],
+                'growth_since_first_day': leaks}
+
+
+def run_soak(runner_class, output_path, days=3, start=None, config_overrides=None, resolution=(816, 608),
+             ooi_latency=0.02, sim_dir=None, sample_interval=3600, video_bitrate=None):
+    """
+    run a Runner through whole days on a VirtualClock with stand-in hardware and services, and write a json report
+    :param runner_class: the Runner class from main.py
+    :param output_path: path of the json report
+    :param days: number of days to simulate
+    :param start: virtual start time. Defaults to 06:00 today, so the first day begins in passive mode
+    :param config_overrides: dict of config values to use instead of the defaults
+    :param resolution: (width, height) of the synthetic frames
+    :param ooi_latency: virtual seconds each OOI detection takes
+    :param sim_dir: directory for the simulated project, cloud, tools, and CPU sensor files. Temporary if None
+    :param sample_interval: virtual seconds between resource samples
+    :param video_bitrate: if set, bits per second simulated segments grow at, e.g. to fill a small sim_dir
+    :return: the report
+    """
+    start = start or datetime.now().replace(hour=6, minute=0, second=0, microsecond=0)
+    stop_at = start + timedelta(days=days)
+    cleanup_dir = sim_dir is None
+    sim_dir = Path(tempfile.mkdtemp(prefix='soak_') if sim_dir is None else sim_dir)
+    bin_dir = write_stand_in_tools(sim_dir / 'bin')
+    cloud_dir = sim_dir / 'cloud'
+    sensor_dir = sim_dir / 'sensors'
+    if not sensor_dir.exists():
+        write_sensor_files(sensor_dir)
+    sink = NotificationSink()
+    config_path = sim_dir / 'projects' / 'soak' / 'config.yaml'
+    config_manager = ConfigManager(config_path)
+    config_manager.generate_new_config()
+    config_manager.config.update({'h_resolution': resolution[0], 'v_resolution': resolution[1],
+                                  'user_email': 'soak@localhost', 'notification_transport': 'http',
+                                  'notification_http_url': sink.url, 'cloud_data_dir': str(cloud_dir),
+                                  'rclone_binary': str(bin_dir / 'rclone'), 'conversion_niceness': 0,
+                                  'metrics_enabled': True, 'metrics_flush_interval': 0,
+                                  'resource_sensor_root': str(sensor_dir),
+                                  # analyze frames in the capture thread, so that virtual time only moves in one place
+                                  'pipeline_enabled': False})
+    config_manager.config.update(config_overrides or {})
+    config_manager.write_config()
+    # reload, so that the camera uses the resolution as corrected by the config checks, like the Runner will
+    config_manager.load_config()
+    resolution = (config_manager.config['h_resolution'], config_manager.config['v_resolution'])
+
+    clock = VirtualClock(start, stop_at)
+    camera = SimulatedCamera(config_path.parent / 'Videos', clock, resolution,
+                             frame_pool_size=2 * config_manager.config['pipeline_queue_size'] + 3,
+                             bitrate=video_bitrate)
+    roi_detector = StandInDetector([camera.roi_box], name='roi_stand_in')
+    ooi_detector = StandInDetector(animal_boxes(camera), latency=ooi_latency, name='ooi_stand_in',
+                                   sleep_func=clock.sleep)
+    original_path = os.environ.get('PATH', '')
+    os.environ['PATH'] = f'{bin_dir}{os.pathsep}{original_path}'
+    try:
+        runner = runner_class(config_path, detectors=(roi_detector, ooi_detector), collector=camera, clock=clock)
+        monitor = SoakMonitor(runner, camera, clock, sink, cloud_dir, sample_interval)
+        clock.on_stop, clock.on_advance = runner.stop_event.set, monitor.on_advance
+        logger.info(f'simulating {days} day(s) from {start.isoformat()}')
+        monitor.sample(clock.time())
+        runner.run_loop()
+        runner.collector.shutdown()
+        runner.uploader.convert_and_upload()
+        runner.notifier.close(timeout=30)
+        monitor.sample(clock.time())
+        report = {'created': datetime.now().isoformat(),
+                  'environment': environment_info(),
+                  'start': start.isoformat(),
+                  'config_overrides': config_overrides or {},
+                  'summary': monitor.summary(),
+                  'metrics': runner.metrics.snapshot(),
+                  'samples': monitor.samples}
+        runner.close_metrics()
+    finally:
+        os.environ['PATH'] = original_path
+        sink.close()
+    output_path = Path(output_path)
+    output_path.parent.mkdir(exist_ok=True, parents=True)
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    logger.info(f'soak test finished: {report["summary"]}')
+    logger.info(f'soak report written to {output_path}')
+    if cleanup_dir:
+        shutil.rmtree(sim_dir, ignore_errors=True)
+    return report
@@ -0,0 +1,218 @@
+"""code for keeping recorded video from filling the disk, by predicting when it will fill and acting ahead of time"""
+
+import json
+import logging
+import math
+import shutil
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+from modules.metrics import NULL_METRICS
+from modules.utils import write_json_atomic
+logger = logging.getLogger(__name__)
+
+# escalating responses to a filling disk. Each level also takes the actions of the levels before it
+STORAGE_LEVELS = ('ok', 'upload', 'degrade', 'evict')
+
+
+def segment_start(path):
+    """:return: start time (seconds since the epoch) parsed from a segment's file name, or None if it is not one"""
+    try:
+        return datetime.fromisoformat(Path(path).name.split('.')[0].replace('_', ':')).timestamp()
+    except ValueError:
+        return None
+
+
+class StorageGovernor:
+
+    def __init__(self, video_dir, state_path, reserve_mb=1024, upload_hours=12, degrade_hours=6,
+                 evict_hours=1, check_interval=60, is_uploaded=None, is_busy=None, time_func=time.time,
+                 disk_usage=shutil.disk_usage, metrics=None):
+        """
+        predicts how long the free disk space will last at the measured write rate, and escalates (see STORAGE_LEVELS)
+        :param video_dir: directory holding the recorded segments
+        :param state_path: json file the event intervals are kept in, so that they survive restarts
+        :param reserve_mb: free space (in MB) that is never planned to be used
+        :param upload_hours: hours of recording below which the level is at least 'upload'
+        :param degrade_hours: hours of recording below which the level is at least 'degrade', until twice this is free
+        :param evict_hours: hours of recording below which segments are evicted, until twice this is covered
+        :param check_interval: minimum seconds between checks. 0 disables the governor
+        :param is_uploaded: optional function returning whether a file has been uploaded
+        :param is_busy: optional function returning whether a file is in use (e.g. being converted)
+        :param time_func: returns the current time in seconds since the epoch
+        :param disk_usage: returns the (total, used, free) bytes of the filesystem holding a path
+        :param metrics: optional Metrics to record the free space, predictions, and evictions to
+        """
+        logger.debug('Beginning StorageGovernor initialization')
+        self.video_dir = Path(video_dir)
+        self.state_path = Path(state_path)
+        self.configure(reserve_mb, upload_hours, degrade_hours, evict_hours, check_interval)
+        self.is_uploaded = is_uploaded or (lambda path: False)
+        self.is_busy = is_busy or (lambda path: False)
+        self.time_func = time_func
+        self.disk_usage = disk_usage
+        self.metrics = metrics or NULL_METRICS
+        self.next_check = 0
+        self.level = 'ok'
+        self.hours_left = math.inf
+        # whether the last eviction ran out of segments it was allowed to delete
+        self.short = False
+        # quality requested for new segments, and the quality and start time of the segment being recorded
+        self.quality = 'normal'
+        self.open_path, self.open_quality, self.open_time = None, None, None
+        # (bytes, seconds) of the most recent closed segments recorded at each quality
+        self.segments = {'normal': deque(maxlen=8), 'low': deque(maxlen=8)}
+        self.events = self.load_events()
+        logger.info('StorageGovernor successfully initialized')
+
+    def configure(self, reserve_mb, upload_hours, degrade_hours, evict_hours, check_interval):
+        self.reserve = reserve_mb * 1e6
+        self.upload_hours, self.degrade_hours, self.evict_hours = upload_hours, degrade_hours, evict_hours
+        self.check_interval = check_interval
+
+    @property
+    def enabled(self):
+        return self.check_interval > 0
+
+    def load_events(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                return [tuple(event) for event in json.load(f)['events']]
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f'could not read {self.state_path} ({e}). Event segments recorded earlier are unprotected')
+            return []
+
+    def mark_event(self, start, end):
+        """protect every segment overlapping start to end (seconds since the epoch) from eviction"""
+        starts = [s for s in (segment_start(p) for p in self.video_dir.iterdir()) if s is not None]
+        oldest = min(starts, default=start)
+        # events that ended before the oldest remaining segment protect nothing any more
+        self.events = [event for event in self.events if event[1] >= oldest]
+        if self.events and start <= self.events[-1][1]:
+            # consecutive behavior checks of the same event extend it
+            start = min(start, self.events[-1][0])
+            self.events[-1] = (start, max(end, self.events[-1][1]))
+        else:
+            self.events.append((start, end))
+        try:
+            write_json_atomic(self.state_path, {'events': self.events})
+        except OSError as e:
+            logger.warning(f'failed to save event intervals: {e}')
+
+    def segment_opened(self, path):
+        """record that the collector started writing a new segment, at the currently requested quality"""
+        self.open_path, self.open_quality, self.open_time = Path(path) if path else None, self.quality, self.time_func()
+
+    def segment_closed(self, path):
+        """measure a segment the collector just closed. :return: path"""
+        if path is not None and self.open_path == Path(path) and Path(path).exists():
+            seconds = self.time_func() - self.open_time
+            if seconds > 0:
+                self.segments[self.open_quality].append((Path(path).stat().st_size, seconds))
+        self.open_path = None
+        return path
+
+    def write_rate(self, quality):
+        """:return: bytes per hour written at a quality over the recent segments, or None until a minute is measured"""
+        measured = list(self.segments[quality])
+        if self.open_path is not None and self.open_quality == quality and self.open_path.exists():
+            measured.append((self.open_path.stat().st_size, self.time_func() - self.open_time))
+        total_bytes = sum(size for size, _ in measured)
+        total_seconds = sum(seconds for _, seconds in measured)
+        # a segment only a few seconds old says little about the rate
+        if total_seconds < 60 or not total_bytes:
+            # until measured, the lower quality is conservatively assumed to be no smaller
+            return self.write_rate('normal') if quality == 'low' else None
+        return total_bytes * 3600 / total_seconds
+
+    def check(self):
+        """
+        predict how long the free space will last and respond, at most once per check interval
+        :return: the new level (see STORAGE_LEVELS), or None if no check was due
+        """
+        now = self.time_func()
+        if not self.enabled or now < self.next_check:
+            return None
+        rate = self.write_rate(self.open_quality or self.quality)
+        if rate is None:
+            return None
+        self.next_check = now + self.check_interval
+        free = self.disk_usage(self.video_dir).free
+        self.hours_left = (free - self.reserve) / rate
+        if self.hours_left < self.evict_hours:
+            level = 'evict'
+        elif self.hours_left < self.degrade_hours:
+            level = 'degrade'
+        elif self.hours_left < self.upload_hours:
+            level = 'upload'
+        else:
+            level = 'ok'
+        if level in ('degrade', 'evict'):
+            self.quality = 'low'
+        elif self.quality == 'low':
+            # the normal quality's rate is unknown until a minute of it has been recorded. Until then, keep low quality
+            normal_rate = self.write_rate('normal')
+            if normal_rate is not None and (free - self.reserve) / normal_rate >= 2 * self.degrade_hours:
+                self.quality = 'normal'
+        if level != self.level:
+            log = logger.warning if STORAGE_LEVELS.index(level) > STORAGE_LEVELS.index(self.level) else logger.info
+            log(f'storage level changed from {self.level} to {level}: {free / 1e6:.0f} MB free, enough for '
+                f'{self.hours_left:.1f} hours of recording at {rate / 1e6:.1f} MB/hour')
+            self.level = level
+        if level == 'evict':
+            self.evict(self.reserve + 2 * self.evict_hours * rate)
+            free = self.disk_usage(self.video_dir).free
+        self.metrics.set_gauge('disk_free_bytes', free)
+        self.metrics.set_gauge('storage_write_rate_bytes_per_hour', rate)
+        self.metrics.set_gauge('storage_hours_left', self.hours_left)
+        return level
+
+    def eviction_candidates(self):
+        """:return: lists of the files of each segment that may be evicted, uploaded segments first, then the oldest"""
+        segments = {}
+        for path in self.video_dir.iterdir():
+            start = segment_start(path)
+            if start is not None and path.is_file():
+                segments.setdefault(start, []).append(path)
+        starts = sorted(segments)
+        candidates = []
+        for start, end in zip(starts, starts[1:] + [math.inf]):
+            paths = segments[start]
+            if self.open_path in paths or any(self.is_busy(p) for p in paths):
+                continue
+            if any(event_start < end and event_end >= start for event_start, event_end in self.events):
+                continue
+            uploaded = any(self.is_uploaded(p) for p in paths if not p.name.endswith('.csv'))
+            candidates.append((not uploaded, start, paths))
+        return [paths for _, _, paths in sorted(candidates, key=lambda c: c[:2])]
+
+    def evict(self, target_free):
+        """
+        delete segments (see eviction_candidates) until target_free bytes are free or nothing more may be deleted
+        :return: number of segments deleted
+        """
+        evicted = 0
+        for paths in self.eviction_candidates():
+            if self.disk_usage(self.video_dir).free >= target_free:
+                break
+            size = 0
+            for path in paths:
+                try:
+                    size += path.stat().st_size
+                    path.unlink()
+                except FileNotFoundError:
+                    # uploaded in the meantime
+                    continue
+            evicted += 1
+            self.metrics.increment('videos_evicted')
+            self.metrics.increment('evicted_bytes', size)
+            logger.warning(f'deleted {", ".join(p.name for p in paths)} ({size / 1e6:.1f} MB) to free disk space')
+        short = self.disk_usage(self.video_dir).free < target_free
+        if short and not self.short:
+            logger.warning('disk space is still short, but every remaining segment is in use or holds an event')
+        self.short = short
+        return evicted
@@ -0,0 +1,176 @@
+"""code for evaluating many BehaviorRecognizer parameter combinations at once over recorded occupancy data"""
+
+import csv
+import itertools
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+logger = logging.getLogger(__name__)
+
+GRID_KEYS = ['behavior_check_window', 'behavior_check_interval', 'behavior_min_individuals_roi',
+             'behavior_max_individuals_roi', 'behavior_min_fraction_for_notification']
+RESULT_COLUMNS = GRID_KEYS + ['n_checks', 'n_positive_checks', 'n_notifications', 'notification_timestamps']
+
+
+def load_replay_occupancy(replay_dir):
+    """
+    collect the per-frame occupancy written by replay (the *_frames.csv tables) into a single time series
+    :return: (timestamps, occupancies) as NumPy arrays sorted by timestamp. Frames without an ROI are left out
+    """
+    timestamps, occupancies = [], []
+    for path in sorted(Path(replay_dir).glob('*_frames.csv')):
+        with open(path, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                if row['occupancy'] != '':
+                    timestamps.append(float(row['timestamp']))
+                    occupancies.append(int(row['occupancy']))
+    timestamps, occupancies = np.array(timestamps, dtype=np.float64), np.array(occupancies, dtype=np.int32)
+    order = np.argsort(timestamps, kind='stable')
+    return timestamps[order], occupancies[order]
+
+
+def split_days(timestamps):
+    """:return: list of (start, stop) index pairs, one per local calendar day, as the recognizer resets daily"""
+    if not len(timestamps):
+        return []
+    first_day = datetime.fromtimestamp(timestamps[0]).date()
+    last_day = datetime.fromtimestamp(timestamps[-1]).date()
+    n_days = (last_day - first_day).days + 1
+    midnights = [datetime.combine(first_day + timedelta(days=i + 1), datetime.min.time()).timestamp()
+                 for i in range(n_days)]
+    bounds = np.concatenate([[0], np.searchsorted(timestamps, midnights, side='left')])
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def check_indices(timestamps, window, interval):
+    """:return: indices of the frames active mode would run behavior checks on, for one day of data"""
+    indices = []
+    due = timestamps[0] + window
+    while True:
+        i = int(np.searchsorted(timestamps, due, side='left'))
+        if i >= len(timestamps):
+            break
+        indices.append(i)
+        due = timestamps[i] + interval
+    return np.array(indices, dtype=np.int64)
+
+
+def select_notifications(positive_times, min_notification_interval, max_notifications_per_day):
+    """apply Notifier.check_conditions to the (sorted) times of one day's positive checks"""
+    selected = []
+    next_allowed = -np.inf
+    i = 0
+    while i < len(positive_times) and len(selected) < max_notifications_per_day:
+        i += int(np.searchsorted(positive_times[i:], next_allowed, side='left'))
+        if i >= len(positive_times):
+            break
+        selected.append(positive_times[i])
+        next_allowed = positive_times[i] + min_notification_interval
+        i += 1
+    return selected
+
+
+def sweep_window(timestamps, occupancies, day_bounds, window, interval, occupancy_ranges, min_fractions,
+                 framegrab_interval, min_notification_interval, max_notifications_per_day):
+    """evaluate every occupancy range and min fraction for a single (window, interval) pair"""
+    occupancy_ranges = np.asarray(occupancy_ranges, dtype=np.int32)
+    min_fractions = np.asarray(min_fractions, dtype=np.float64)
+    n_ranges, n_fractions = len(occupancy_ranges), len(min_fractions)
+    minimum_viable_length = (window / framegrab_interval) // 2
+    n_checks = np.zeros((n_ranges, n_fractions), dtype=np.int64)
+    n_positive = np.zeros((n_ranges, n_fractions), dtype=np.int64)
+    notifications = [[[] for _ in range(n_fractions)] for _ in range(n_ranges)]
+    for start, stop in day_bounds:
+        ts = timestamps[start:stop]
+        checks = check_indices(ts, window, interval)
+        if not len(checks):
+            continue
+        # the buffer at each check holds every frame no more than one window older than the frame at the check
+        first = np.searchsorted(ts, ts[checks] - window, side='left')
+        lengths = checks + 1 - first
+        viable = lengths >= minimum_viable_length
+        checks, first, lengths = checks[viable], first[viable], lengths[viable]
+        if not len(checks):
+            continue
+        # running count of frames whose occupancy falls inside each range, one row per range
+        occ = occupancies[start:stop]
+        in_range = (occ[None, :] >= occupancy_ranges[:, :1]) & (occ[None, :] <= occupancy_ranges[:, 1:])
+        cumulative = np.zeros((n_ranges, len(ts) + 1), dtype=np.int64)
+        np.cumsum(in_range, axis=1, out=cumulative[:, 1:])
+        fractions = (cumulative[:, checks + 1] - cumulative[:, first]) / lengths
+        # (range, fraction, check) positive check indicator
+        positive = fractions[:, None, :] >= min_fractions[None, :, None]
+        n_checks += len(checks)
+        n_positive += positive.sum(axis=2)
+        check_times = ts[checks]
+        for r, f in itertools.product(range(n_ranges), range(n_fractions)):
+            notifications[r][f].extend(select_notifications(check_times[positive[r, f]], min_notification_interval,
+                                                            max_notifications_per_day))
+    results = []
+    for r, f in itertools.product(range(n_ranges), range(n_fractions)):
+        results.append({'behavior_check_window': window,
+                        'behavior_check_interval': interval,
+                        'behavior_min_individuals_roi': int(occupancy_ranges[r, 0]),
+                        'behavior_max_individuals_roi': int(occupancy_ranges[r, 1]),
+                        'behavior_min_fraction_for_notification': float(min_fractions[f]),
+                        'n_checks': int(n_checks[r, f]),
+                        'n_positive_checks': int(n_positive[r, f]),
+                        'n_notifications': len(notifications[r][f]),
+                        'notification_timestamps': notifications[r][f]})
+    return results
+
+
+def sweep_thresholds(timestamps, occupancies, grid, framegrab_interval, min_notification_interval=600,
+                     max_notifications_per_day=20, processes=1):
+    """
+    evaluate every combination of behavior parameters in grid, replaying active mode's checks and notification limits
+    :param timestamps: sorted frame timestamps (seconds since the epoch)
+    :param occupancies: ROI occupancy of each frame
+    :param grid: dict mapping each of GRID_KEYS to a list of values to try
+    :param framegrab_interval: framegrab interval the data was recorded with, used for the short-buffer check
+    :param min_notification_interval: see Notifier
+    :param max_notifications_per_day: see Notifier
+    :param processes: number of worker processes. Work is split by (window, interval) pair
+    :return: list of dicts, one per parameter combination, with the keys in RESULT_COLUMNS
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    occupancies = np.asarray(occupancies, dtype=np.int32)
+    day_bounds = split_days(timestamps)
+    occupancy_ranges = [(lo, hi) for lo, hi in itertools.product(grid['behavior_min_individuals_roi'],
+                                                                 grid['behavior_max_individuals_roi']) if lo <= hi]
+    window_pairs = list(itertools.product(grid['behavior_check_window'], grid['behavior_check_interval']))
+    n_combinations = len(window_pairs) * len(occupancy_ranges) * len(grid['behavior_min_fraction_for_notification'])
+    logger.info(f'sweeping {n_combinations} parameter combinations over {len(timestamps)} frames from '
+                f'{len(day_bounds)} day(s)')
+    args = [(timestamps, occupancies, day_bounds, window, interval, occupancy_ranges,
+             grid['behavior_min_fraction_for_notification'], framegrab_interval, min_notification_interval,
+             max_notifications_per_day) for window, interval in window_pairs]
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            chunks = list(executor.map(sweep_window, *zip(*args)))
+    else:
+        chunks = [sweep_window(*a) for a in args]
+    return [row for chunk in chunks for row in chunk]
+
+
+def write_sweep_results(results, output_path):
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS)
+        writer.writeheader()
+        for row in results:
+            writer.writerow(dict(row, notification_timestamps=';'.join(f'{t:.3f}' for t in
+                                                                       row['notification_timestamps'])))
+    logger.info(f'sweep results written to {output_path}')
+
+
+def grid_from_config(config, grid_overrides=None):
+    """build a sweep grid holding the config's current values, with any keys in grid_overrides replaced"""
+    grid = {key: [getattr(config, key)] for key in GRID_KEYS}
+    for key, values in (grid_overrides or {}).items():
+        if key not in GRID_KEYS:
+            raise ValueError(f'{key} cannot be swept. Sweepable parameters are {GRID_KEYS}')
+        grid[key] = list(values) if isinstance(values, (list, tuple)) else [values]
+    return grid
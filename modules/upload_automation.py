@@ -1,14 +1,421 @@
 """code for automating data uploads via rclone"""
 import subprocess as sp
 import os
+import json
+import shutil
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path, PurePosixPath
 import logging
+
+from modules.metrics import NULL_METRICS
+from modules.utils import write_json_atomic
 logger = logging.getLogger(__name__)
 
+MANIFEST_STATUSES = ('pending', 'converting', 'converted', 'failed')
+
+
+class ConversionManifest:
+
+    def __init__(self, path):
+        """
+        conversion status of each h264 file, rewritten atomically. Entries left 'converting' by a crash count as pending
+        :param path: path of the manifest json file
+        """
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if self.path.exists():
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f'could not read conversion manifest {self.path} ({e}). Starting a new one')
+        for entry in self.entries.values():
+            if entry['status'] == 'converting':
+                entry['status'] = 'pending'
+
+    def get(self, name):
+        with self.lock:
+            return dict(self.entries.get(name, {'status': None, 'attempts': 0}))
+
+    def mark(self, name, status):
+        with self.lock:
+            entry = self.entries.setdefault(name, {'status': None, 'attempts': 0})
+            entry['status'] = status
+            if status == 'converting':
+                entry['attempts'] += 1
+            self.save()
+
+    def names(self, status):
+        with self.lock:
+            return [name for name, entry in self.entries.items() if entry['status'] == status]
+
+    def prune(self, video_dir):
+        """drop entries for files that no longer exist, e.g. after they were uploaded"""
+        with self.lock:
+            stale = [name for name in self.entries if not (Path(video_dir) / name).exists()
+                     and not (Path(video_dir) / name).with_suffix('.mp4').exists()]
+            for name in stale:
+                del self.entries[name]
+            if stale:
+                self.save()
+
+    def save(self):
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        write_json_atomic(self.path, self.entries)
+
+
+class VideoConverter:
+
+    def __init__(self, video_dir, manifest_path, framerate=30, max_workers=1, niceness=19, max_attempts=3,
+                 metrics=None, on_converted=None):
+        """
+        converts h264 files to mp4 in background threads at low CPU and IO priority, tracked in a ConversionManifest
+        :param video_dir: directory holding the h264 files
+        :param manifest_path: path of the conversion manifest
+        :param framerate: framerate the videos were recorded at
+        :param max_workers: max number of concurrent conversions
+        :param niceness: niceness ffmpeg is run with (0-19). Above 0, ffmpeg also gets idle IO priority if possible
+        :param max_attempts: number of times a file is tried before it is given up on
+        :param metrics: optional Metrics to record conversion times and counts to
+        :param on_converted: optional function called with the path of each newly converted mp4
+        """
+        logger.debug('Beginning VideoConverter initialization')
+        self.on_converted = on_converted
+        self.video_dir = Path(video_dir)
+        self.manifest = ConversionManifest(manifest_path)
+        self.framerate = framerate
+        self.max_attempts = max_attempts
+        self.metrics = metrics or NULL_METRICS
+        self.priority_prefix = []
+        if niceness and shutil.which('nice'):
+            self.priority_prefix += ['nice', '-n', str(niceness)]
+        if niceness and shutil.which('ionice'):
+            self.priority_prefix += ['ionice', '-c', '3']
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='video_converter')
+        self.futures = {}
+        self.lock = threading.Lock()
+        logger.info(f'VideoConverter successfully initialized with {max(1, max_workers)} worker(s)')
+
+    def submit(self, h264_path):
+        """queue a closed h264 file for background conversion"""
+        h264_path = Path(h264_path)
+        with self.lock:
+            if h264_path.name in self.futures and not self.futures[h264_path.name].done():
+                return self.futures[h264_path.name]
+            self.manifest.mark(h264_path.name, 'pending')
+            future = self.executor.submit(self.convert, h264_path)
+            self.futures[h264_path.name] = future
+        logger.debug(f'queued {h264_path.name} for conversion')
+        return future
+
+    def resume(self):
+        """queue every file the manifest lists as pending, e.g. after a restart"""
+        for name in self.manifest.names('pending'):
+            if (self.video_dir / name).exists():
+                self.submit(self.video_dir / name)
+
+    def in_progress(self, name):
+        with self.lock:
+            return name in self.futures and not self.futures[name].done()
+
+    def convert(self, h264_path):
+        """
+        convert one h264 file to mp4, deleting the h264 if the conversion succeeded
+        :return: True if the file was converted
+        """
+        h264_path = Path(h264_path)
+        entry = self.manifest.get(h264_path.name)
+        mp4_path = h264_path.with_suffix('.mp4')
+        if entry['status'] == 'converted' and mp4_path.exists():
+            # converted before a crash, but the h264 was not yet removed
+            if h264_path.exists():
+                os.remove(h264_path)
+            return True
+        if entry['attempts'] >= self.max_attempts:
+            if entry['status'] != 'failed':
+                self.manifest.mark(h264_path.name, 'failed')
+            logger.warning(f'skipping conversion of {h264_path.name} after {entry["attempts"]} failed attempts')
+            return False
+        self.manifest.mark(h264_path.name, 'converting')
+        command = self.priority_prefix + ['ffmpeg', '-y', '-analyzeduration', '100M', '-probesize', '100M', '-r',
+                                          str(self.framerate), '-i', str(h264_path), '-threads', '1', '-c:v', 'copy',
+                                          '-r', str(self.framerate), str(mp4_path)]
+        with self.metrics.timer('video_conversion'):
+            out = sp.run(command, capture_output=True, encoding='utf-8')
+        if os.path.exists(mp4_path) and (os.path.getsize(mp4_path) > os.path.getsize(h264_path)):
+            self.manifest.mark(h264_path.name, 'converted')
+            os.remove(h264_path)
+            self.metrics.increment('videos_converted')
+            logger.debug(f'converted {h264_path.name}')
+            if self.on_converted is not None:
+                self.on_converted(mp4_path)
+            return True
+        logger.warning(f'failed to convert {h264_path.name} with error {out.stderr}')
+        self.metrics.increment('video_conversion_failures')
+        if os.path.exists(mp4_path):
+            os.remove(mp4_path)
+        self.manifest.mark(h264_path.name, 'failed' if entry['attempts'] + 1 >= self.max_attempts else 'pending')
+        return False
+
+    def wait(self):
+        """block until every queued conversion is finished"""
+        with self.lock:
+            futures = list(self.futures.values())
+        wait(futures)
+        with self.lock:
+            self.futures = {name: f for name, f in self.futures.items() if not f.done()}
+
+    def shutdown(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
+
+
+class UploadManifest:
+
+    def __init__(self, path):
+        """
+        size, mtime, sha1, and remote state of each project file as of its last upload, rewritten atomically
+        :param path: path of the manifest json file
+        """
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if self.path.exists():
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f'could not read upload manifest {self.path} ({e}). Starting a new one')
+
+    def get(self, rel_path):
+        with self.lock:
+            return dict(self.entries.get(rel_path, {}))
+
+    def update(self, rel_path, **fields):
+        with self.lock:
+            self.entries.setdefault(rel_path, {}).update(fields)
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            write_json_atomic(self.path, self.entries)
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class UploadEngine:
+
+    def __init__(self, local_project_dir, cloud_project_dir, manifest_path, rclone='rclone', workers=2,
+                 bwlimit_kbps=None, max_attempts=3, backoff_initial=5, backoff_max=300, move_dirs=('Videos',),
+                 exclude=(), time_func=time.time, sleep_func=time.sleep, metrics=None):
+        """
+        uploads project files one at a time with rclone, skipping files that are unchanged since their last upload
+        :param local_project_dir: local project directory
+        :param cloud_project_dir: rclone destination, e.g. 'remote:/path/to/project'
+        :param manifest_path: path of the upload manifest. Excluded from uploads while they run
+        :param rclone: rclone executable (or a stand-in that accepts the same moveto/copyto arguments)
+        :param workers: number of files transferred at the same time
+        :param bwlimit_kbps: total bandwidth limit in KiB/s, shared evenly between the workers. None for no limit
+        :param max_attempts: attempts per file before it is marked failed for this pass
+        :param backoff_initial: seconds to wait before the first retry of a file, doubling for each later retry
+        :param backoff_max: max seconds between retries of a file
+        :param move_dirs: directories (relative to the project) whose files are deleted locally once uploaded
+        :param exclude: additional names of files and directories never uploaded
+        :param time_func: returns the current time in seconds since the epoch
+        :param sleep_func: sleeps for the given number of seconds
+        :param metrics: optional Metrics to record transfer counts and times to
+        """
+        logger.debug('Beginning UploadEngine initialization')
+        self.local_project_dir = Path(local_project_dir)
+        self.cloud_project_dir = PurePosixPath(cloud_project_dir)
+        self.manifest = UploadManifest(manifest_path)
+        self.rclone = rclone
+        self.workers = max(1, workers)
+        self.bwlimit_kbps = bwlimit_kbps
+        self.max_attempts = max_attempts
+        self.backoff_initial, self.backoff_max = backoff_initial, backoff_max
+        self.move_dirs = set(move_dirs)
+        self.exclude = set(exclude) | {Path(manifest_path).name}
+        self.time_func, self.sleep_func = time_func, sleep_func
+        self.metrics = metrics or NULL_METRICS
+        self.trickle_executor = None
+        self.trickle_bwlimit_kbps = None
+        self.trickled = set()
+        # sha1 of files hashed by needs_upload, with the size and mtime they were hashed at, for upload_file to reuse
+        self.hashes = {}
+        logger.info(f'UploadEngine successfully initialized with {self.workers} worker(s)')
+
+    def rel_path(self, path):
+        return Path(path).relative_to(self.local_project_dir).as_posix()
+
+    def is_moved(self, rel_path):
+        return rel_path.split('/')[0] in self.move_dirs
+
+    def needs_upload(self, path):
+        """compare a file against its manifest entry, only hashing it if the size or mtime changed"""
+        entry = self.manifest.get(self.rel_path(path))
+        if entry.get('remote') != 'uploaded':
+            return True
+        stat = path.stat()
+        if entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+            return False
+        if entry.get('size') != stat.st_size:
+            return True
+        sha1 = file_sha1(path)
+        if entry.get('sha1') == sha1:
+            self.manifest.update(self.rel_path(path), mtime=stat.st_mtime)
+            return False
+        self.hashes[self.rel_path(path)] = (stat.st_size, stat.st_mtime, sha1)
+        return True
+
+    def scan(self):
+        """:return: files in the project directory that are new or changed since their last upload"""
+        paths = [p for p in sorted(self.local_project_dir.rglob('*')) if p.is_file() and not p.name.endswith('.tmp')
+                 and self.exclude.isdisjoint(p.relative_to(self.local_project_dir).parts)]
+        return [p for p in paths if self.needs_upload(p)]
+
+    def transfer(self, path, bwlimit_kbps=None):
+        """run one rclone transfer, judged by its return code. :return: (success, stderr)"""
+        rel_path = self.rel_path(path)
+        command = [self.rclone, 'moveto' if self.is_moved(rel_path) else 'copyto', str(path),
+                   str(self.cloud_project_dir / rel_path), '--retries', '1']
+        if bwlimit_kbps:
+            command += ['--bwlimit', f'{max(1, int(bwlimit_kbps))}K']
+        try:
+            out = sp.run(command, capture_output=True, encoding='utf-8')
+        except OSError as e:
+            return False, str(e)
+        return out.returncode == 0, out.stderr
+
+    def upload_file(self, path, bwlimit_kbps=None):
+        """
+        upload one file, retrying with exponential backoff, and record the sha1 needs_upload computed, if any
+        :return: True if the file was uploaded
+        """
+        path = Path(path)
+        rel_path = self.rel_path(path)
+        stat = path.stat()
+        size, mtime, sha1 = self.hashes.pop(rel_path, (None, None, None))
+        if (size, mtime) != (stat.st_size, stat.st_mtime):
+            sha1 = None
+        delay = self.backoff_initial
+        for attempt in range(1, self.max_attempts + 1):
+            with self.metrics.timer('upload_file'):
+                success, stderr = self.transfer(path, bwlimit_kbps)
+            if success:
+                self.manifest.update(rel_path, size=stat.st_size, mtime=stat.st_mtime, sha1=sha1, remote='uploaded',
+                                     uploaded_at=self.time_func(), attempts=attempt)
+                self.metrics.increment('files_uploaded')
+                self.metrics.increment('upload_bytes', stat.st_size)
+                logger.debug(f'uploaded {rel_path}')
+                return True
+            logger.debug(f'upload of {rel_path} failed (attempt {attempt} of {self.max_attempts}): {stderr}')
+            self.metrics.increment('upload_retries')
+            if attempt < self.max_attempts:
+                self.sleep_func(delay)
+                delay = min(2 * delay, self.backoff_max)
+        logger.warning(f'failed to upload {rel_path} after {self.max_attempts} attempts: {stderr}')
+        self.manifest.update(rel_path, size=stat.st_size, mtime=stat.st_mtime, sha1=sha1, remote='failed',
+                             attempts=self.max_attempts)
+        self.metrics.increment('upload_failures')
+        return False
+
+    def sync(self):
+        """
+        upload every new or changed file, videos first since they are moved rather than copied
+        :return: (number of files uploaded, number of files that failed)
+        """
+        paths = sorted(self.scan(), key=lambda p: not self.is_moved(self.rel_path(p)))
+        logger.info(f'uploading {len(paths)} new or changed file(s)')
+        bwlimit = self.bwlimit_kbps / self.workers if self.bwlimit_kbps else None
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='upload') as executor:
+            results = list(executor.map(lambda p: self.upload_file(p, bwlimit), paths))
+        uploaded = sum(results)
+        logger.info(f'upload complete: {uploaded} file(s) uploaded, {len(results) - uploaded} failed')
+        return uploaded, len(results) - uploaded
+
+    def start_trickle(self, bwlimit_kbps):
+        """start accepting files (see trickle) to upload one at a time in the background, within bwlimit_kbps"""
+        if self.trickle_executor is None:
+            self.trickle_bwlimit_kbps = bwlimit_kbps
+            self.trickle_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload_trickle')
+            logger.debug(f'trickle uploads started with a {bwlimit_kbps} KiB/s budget')
+
+    @property
+    def trickling(self):
+        return self.trickle_executor is not None
+
+    def trickle(self, path):
+        """queue a finished file for background upload, if trickle uploads are running and it is not queued yet"""
+        if self.trickle_executor is not None and Path(path) not in self.trickled:
+            self.trickled.add(Path(path))
+            future = self.trickle_executor.submit(self.upload_file, path, self.trickle_bwlimit_kbps)
+            future.add_done_callback(lambda f: self.trickle_done(Path(path), f))
+
+    def trickle_waiting(self, directory, pattern):
+        """like trickle, for every file in directory matching pattern that needs uploading"""
+        if self.trickle_executor is not None:
+            self.trickle_executor.submit(self.upload_waiting, Path(directory), pattern).add_done_callback(
+                lambda f: self.trickle_done(Path(directory), f))
+
+    def upload_waiting(self, directory, pattern):
+        for path in sorted(directory.glob(pattern)):
+            try:
+                if path in self.trickled or not self.needs_upload(path):
+                    continue
+            except FileNotFoundError:
+                # moved by an upload that finished in the meantime
+                continue
+            self.trickled.add(path)
+            try:
+                self.upload_file(path, self.trickle_bwlimit_kbps)
+            finally:
+                self.trickled.discard(path)
+
+    def trickle_done(self, path, future):
+        """let a file be queued again once its upload finished, e.g. to retry it after it failed"""
+        self.trickled.discard(path)
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning(f'unexpected error uploading {path.name}: {future.exception()}')
+            self.metrics.increment('upload_failures')
+
+    def stop_trickle(self):
+        """wait for queued trickle uploads to finish, then stop accepting new ones"""
+        if self.trickle_executor is not None:
+            self.trickle_executor.shutdown(wait=True)
+            self.trickle_executor = None
+            self.trickled.clear()
+            logger.debug('trickle uploads stopped')
+
+
 class Uploader:
 
-    def __init__(self, local_project_dir, cloud_data_dir=None, video_framerate=30):
+    def __init__(self, local_project_dir, cloud_data_dir=None, video_framerate=30, metrics=None,
+                 conversion_workers=1, conversion_niceness=19, conversion_max_attempts=3, rclone='rclone',
+                 upload_workers=2, upload_bwlimit_kbps=None, upload_max_attempts=3, upload_trickle_kbps=None,
+                 upload_exclude=(), time_func=time.time, sleep_func=time.sleep):
+        """
+        :param conversion_workers: max number of videos converted concurrently
+        :param conversion_niceness: niceness of the ffmpeg conversion processes (0 to run them at normal priority)
+        :param conversion_max_attempts: number of times conversion of a video is tried before it is given up on
+        :param rclone: rclone executable
+        :param upload_workers: number of files uploaded at the same time
+        :param upload_bwlimit_kbps: total upload bandwidth limit in KiB/s, or None
+        :param upload_max_attempts: attempts per file and upload pass
+        :param upload_trickle_kbps: if set, bandwidth (KiB/s) for uploading videos during active mode once converted
+        :param upload_exclude: names of files and directories in the project directory that are never uploaded
+        :param time_func: returns the current time in seconds since the epoch
+        :param sleep_func: sleeps for the given number of seconds, e.g. between upload retries
+        """
         logger.debug('Beginning Uploader initialization')
+        self.metrics = metrics or NULL_METRICS
         self.local_project_dir = Path(local_project_dir)
         if cloud_data_dir is None:
             self.attempt_uploads = False
@@ -18,7 +425,26 @@ class Uploader:
             self.cloud_data_dir = PurePosixPath(cloud_data_dir)
             self.cloud_project_dir = self.cloud_data_dir / self.local_project_dir.name
             logger.debug(f'uploads will be sent to {self.cloud_project_dir}')
+            self.upload_engine = UploadEngine(self.local_project_dir, self.cloud_project_dir,
+                                              self.local_project_dir / 'upload_manifest.json',
+                                              rclone=rclone,
+                                              workers=upload_workers,
+                                              bwlimit_kbps=upload_bwlimit_kbps,
+                                              max_attempts=upload_max_attempts,
+                                              exclude=upload_exclude,
+                                              time_func=time_func,
+                                              sleep_func=sleep_func,
+                                              metrics=self.metrics)
+        self.trickle_kbps = upload_trickle_kbps if self.attempt_uploads else None
         self.framerate = video_framerate
+        self.converter = VideoConverter(self.local_project_dir / 'Videos',
+                                        self.local_project_dir / 'conversion_manifest.json',
+                                        framerate=video_framerate,
+                                        max_workers=conversion_workers,
+                                        niceness=conversion_niceness,
+                                        max_attempts=conversion_max_attempts,
+                                        metrics=self.metrics,
+                                        on_converted=self.upload_engine.trickle if self.attempt_uploads else None)
         logger.info('Uploader successfully initialized')
 
     def convert_and_upload(self):
@@ -26,39 +452,54 @@ class Uploader:
         if self.attempt_uploads:
             self.upload_project()
 
+    def queue_conversion(self, h264_path):
+        """convert a closed video segment in the background"""
+        if h264_path is not None:
+            self.converter.submit(h264_path)
+
     def convert_h264s_to_mp4s(self):
         logger.debug('converting h264s to mp4s')
+        self.converter.wait()
         local_video_dir = self.local_project_dir / 'Videos'
-        h264_paths = local_video_dir.glob('*.h264')
-        for h264_p in h264_paths:
-            mp4_path = h264_p.with_suffix('.mp4')
-            command = ['ffmpeg', '-analyzeduration', '100M', '-probesize', '100M', '-r',
-                       str(self.framerate), '-i', h264_p, '-threads', '1', '-c:v', 'copy', '-r',
-                       str(self.framerate), mp4_path]
-            out = sp.run(command, capture_output=True, encoding='utf-8')
-            if os.path.exists(mp4_path) and (os.path.getsize(mp4_path) > os.path.getsize(h264_p)):
-                os.remove(h264_p)
-            else:
-                logger.warning(f'failed to convert {h264_p.name} with error {out.stderr}')
-                if os.path.exists(mp4_path):
-                    os.remove(mp4_path)
+        for h264_p in sorted(local_video_dir.glob('*.h264')):
+            if self.converter.manifest.get(h264_p.name)['status'] != 'failed':
+                self.converter.convert(h264_p)
+        self.converter.manifest.prune(local_video_dir)
         logger.debug('conversion complete')
 
-    def upload_project(self):
-        logger.debug('initiating upload')
-        local_video_dir = self.local_project_dir / 'Videos'
-        cloud_video_dir = self.cloud_project_dir / 'Videos'
-        logger.debug(f'moving {local_video_dir} to {cloud_video_dir} (Local copies will be deleted)')
-        vid_move_cmd = ['rclone', 'move', str(local_video_dir), str(cloud_video_dir)]
-        vid_move_out = sp.run(vid_move_cmd, capture_output=True, encoding='utf-8')
-        if vid_move_out.stderr:
-            logger.warning(f'moving videos to cloud may have failed: \n {vid_move_out.stderr}')
-        logger.debug(f'copying remaining project files to cloud (local copies will be preserved)')
-        copy_cmd = ['rclone', 'copy', str(self.local_project_dir), str(self.cloud_project_dir)]
-        copy_out = sp.run(copy_cmd, capture_output=True, encoding='utf-8')
-        if copy_out.stderr:
-            logger.warning(f'copying project files to cloud may have failed: \n {copy_out.stderr}')
-        logger.debug('upload complete')
+    def start_trickle(self):
+        """during active mode, upload videos in the background as soon as they are converted"""
+        if self.trickle_kbps:
+            self.upload_engine.start_trickle(self.trickle_kbps)
 
+    def stop_trickle(self):
+        if self.attempt_uploads:
+            self.upload_engine.stop_trickle()
 
+    def expedite(self):
+        """
+        start trickle uploads if needed and queue every converted video, rather than waiting for passive mode
+        :return: True if uploads were queued, False if uploads are disabled
+        """
+        if not self.attempt_uploads:
+            return False
+        if not self.upload_engine.trickling:
+            logger.info('starting background uploads early')
+            self.upload_engine.start_trickle(self.trickle_kbps)
+        self.upload_engine.trickle_waiting(self.local_project_dir / 'Videos', '*.mp4')
+        self.converter.resume()
+        return True
 
+    def is_uploaded(self, path):
+        """:return: whether path is unchanged since it was last uploaded"""
+        try:
+            return self.attempt_uploads and not self.upload_engine.needs_upload(Path(path))
+        except FileNotFoundError:
+            return False
+
+    def upload_project(self):
+        """upload new and changed project files, deleting the local copies of videos once they are uploaded"""
+        logger.debug('initiating upload')
+        self.stop_trickle()
+        with self.metrics.timer('upload'):
+            self.upload_engine.sync()
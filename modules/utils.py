@@ -1,5 +1,8 @@
+import json
+import os
 import pathlib
 import sys
+from functools import lru_cache
 
 FILE = pathlib.Path(__file__).resolve()
 MODULE_DIR = FILE.parent  # repository root
@@ -8,3 +11,20 @@ MODEL_DIR = REPO_ROOT_DIR / 'models'
 if str(REPO_ROOT_DIR) not in sys.path:
     sys.path.append(str(REPO_ROOT_DIR))
 
+
+# opencv is slow to import, so the modules that use it import it on first use rather than at startup
+@lru_cache(maxsize=None)
+def cv2_api():
+    """:return: the cv2 module"""
+    import cv2
+    return cv2
+
+
+def write_json_atomic(path, obj):
+    """write obj to a json file through a temporary file, so that readers never see a partly written file"""
+    tmp_path = pathlib.Path(path).with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
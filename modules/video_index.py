@@ -0,0 +1,185 @@
+"""code for indexing recorded video segments by wall-clock time and cutting full-resolution clips out of them"""
+
+import logging
+import shutil
+import subprocess as sp
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+logger = logging.getLogger(__name__)
+
+# picamera is only available on the raspberry pi. Index files can still be read, and clips extracted, without it
+try:
+    import picamera
+except ImportError:
+    picamera = None
+
+INDEX_SUFFIX = '.index.csv'
+INDEX_HEADER = 'time,frame,offset'
+
+
+def index_path(video_path):
+    """:return: path of the sidecar index of a video segment (shared by the h264 and the mp4 it is converted to)"""
+    video_path = Path(video_path)
+    return video_path.with_name(video_path.stem + INDEX_SUFFIX)
+
+
+class IndexedOutput:
+
+    def __init__(self, video_path, camera, time_func=time.time):
+        """
+        picamera output writing an h264 segment and a sidecar index of each keyframe's time, frame number, and offset
+        :param video_path: path of the h264 file to write
+        :param camera: the PiCamera doing the recording, whose frame attribute describes the data passed to write
+        :param time_func: returns the current time in seconds since the epoch
+        """
+        self.video_path = Path(video_path)
+        self.camera = camera
+        self.time_func = time_func
+        self.file = open(self.video_path, 'wb')
+        self.index_file = open(index_path(self.video_path), 'w')
+        self.index_file.write(INDEX_HEADER + '\n')
+        self.position = 0
+        self.frame_count = 0
+        self.last_frame = None
+
+    def write(self, buf):
+        frame = self.camera.frame
+        # picamera may deliver one frame in several writes, so a frame is identified by its index and type. SPS
+        # headers share the index of the frame before them
+        frame_key = (frame.index, frame.frame_type)
+        if frame_key != self.last_frame:
+            self.last_frame = frame_key
+            if frame.frame_type == picamera.PiVideoFrameType.sps_header:
+                # flush first, so that the index never points past the data on disk
+                self.file.flush()
+                self.index_file.write(f'{self.time_func():.6f},{self.frame_count},{self.position}\n')
+                self.index_file.flush()
+            else:
+                self.frame_count += 1
+        self.file.write(buf)
+        self.position += len(buf)
+        return len(buf)
+
+    def flush(self):
+        self.file.flush()
+        self.index_file.flush()
+
+    def close(self):
+        self.file.close()
+        self.index_file.close()
+
+
+def read_index(path):
+    """:return: structured array of (time, frame, offset) rows, one per keyframe"""
+    rows = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2,
+                      dtype=[('time', np.float64), ('frame', np.int64), ('offset', np.int64)])
+    return rows.reshape(-1)
+
+
+def find_segments(video_dir, start, end):
+    """
+    :param start: start of the time range, in seconds since the epoch
+    :param end: end of the time range, in seconds since the epoch
+    :return: list of (h264 path, or mp4 once converted, index rows) of the indexed segments overlapping the range
+    """
+    segments = []
+    for path in sorted(Path(video_dir).glob('*' + INDEX_SUFFIX)):
+        rows = read_index(path)
+        if len(rows) == 0:
+            continue
+        stem = path.name[:-len(INDEX_SUFFIX)]
+        video_path = next((p for p in (path.with_name(stem + '.h264'), path.with_name(stem + '.mp4')) if p.exists()),
+                          None)
+        if video_path is None:
+            logger.debug(f'no video found for index {path.name}')
+            continue
+        segments.append((video_path, rows))
+    segments.sort(key=lambda segment: segment[1]['time'][0])
+    overlapping = []
+    for i, (video_path, rows) in enumerate(segments):
+        # a segment runs until the next one starts. The last one runs until its last keyframe, plus up to one more
+        # keyframe interval that the index cannot vouch for
+        segment_end = segments[i + 1][1]['time'][0] if i + 1 < len(segments) else np.inf
+        if rows['time'][0] <= end and segment_end > start:
+            overlapping.append((video_path, rows))
+    return overlapping
+
+
+class ClipExtractor:
+
+    def __init__(self, video_dir, framerate=30, ffmpeg='ffmpeg'):
+        """
+        cuts time ranges out of indexed video segments with stream copy, widened to the keyframes around them
+        :param video_dir: directory holding the segments and their index files
+        :param framerate: framerate the segments were recorded at
+        :param ffmpeg: ffmpeg executable
+        """
+        logger.debug('Beginning ClipExtractor initialization')
+        self.video_dir = Path(video_dir)
+        self.framerate = framerate
+        self.ffmpeg = ffmpeg
+        logger.info('ClipExtractor successfully initialized')
+
+    @staticmethod
+    def cut_points(rows, start, end):
+        """:return: positions in rows of the first keyframe of the cut, and of the keyframe ending it (or None)"""
+        first = max(int(np.searchsorted(rows['time'], start, side='right')) - 1, 0)
+        last = int(np.searchsorted(rows['time'], end, side='right'))
+        return first, (last if last < len(rows) else None)
+
+    def extract(self, start, end, output_path):
+        """
+        :param start: start of the clip, in seconds since the epoch
+        :param end: end of the clip, in seconds since the epoch
+        :param output_path: path of the mp4 to write
+        :return: output_path, or None if no recorded video covers the range
+        """
+        output_path = Path(output_path)
+        segments = find_segments(self.video_dir, start, end)
+        if not segments:
+            logger.warning(f'no indexed video found between {start} and {end}')
+            return None
+        output_path.parent.mkdir(exist_ok=True, parents=True)
+        with tempfile.TemporaryDirectory(dir=output_path.parent) as tmp_dir:
+            pieces = [self.cut_segment(video_path, rows, start, end, Path(tmp_dir) / f'{i}.mp4')
+                      for i, (video_path, rows) in enumerate(segments)]
+            if len(pieces) == 1:
+                shutil.move(str(pieces[0]), str(output_path))
+            else:
+                concat_list = Path(tmp_dir) / 'concat.txt'
+                concat_list.write_text(''.join(f"file '{piece.name}'\n" for piece in pieces))
+                self.run_ffmpeg(['-f', 'concat', '-safe', '0', '-i', str(concat_list), '-c', 'copy',
+                                 str(output_path)])
+        logger.info(f'extracted {output_path.name} from {len(segments)} segment(s)')
+        return output_path
+
+    def cut_segment(self, video_path, rows, start, end, piece_path):
+        first, last = self.cut_points(rows, start, end)
+        if video_path.suffix == '.h264':
+            # h264 segments are cut by byte offset and wrapped in an mp4, so no seeking through the raw stream is needed
+            raw_path = piece_path.with_suffix('.h264')
+            with open(video_path, 'rb') as src, open(raw_path, 'wb') as dst:
+                src.seek(rows['offset'][first])
+                if last is None:
+                    shutil.copyfileobj(src, dst)
+                else:
+                    dst.write(src.read(rows['offset'][last] - rows['offset'][first]))
+            self.run_ffmpeg(['-r', str(self.framerate), '-i', str(raw_path), '-c:v', 'copy', '-r',
+                             str(self.framerate), str(piece_path)])
+        else:
+            # converted mp4s have a frame every 1 / framerate seconds, so frame numbers translate directly to times. The
+            # seek lands half a frame after the keyframe, and stream copy then starts at the keyframe itself
+            seek_time = (rows['frame'][first] + 0.5) / self.framerate
+            command = ['-ss', f'{seek_time:.6f}', '-i', str(video_path), '-c', 'copy']
+            if last is not None:
+                command += ['-frames:v', str(rows['frame'][last] - rows['frame'][first])]
+            self.run_ffmpeg(command + [str(piece_path)])
+        return piece_path
+
+    def run_ffmpeg(self, args):
+        out = sp.run([self.ffmpeg, '-y', '-loglevel', 'error'] + args, capture_output=True, encoding='utf-8')
+        if out.returncode != 0:
+            raise RuntimeError(f'ffmpeg failed with error {out.stderr}')
@@ -0,0 +1,39 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+@pytest.fixture
+def make_runner(tmp_path):
+    """build Runners on a simulated camera and stand-in detectors, in a project under tmp_path"""
+    from main import Runner
+    from modules.config_manager import ConfigManager
+    from modules.object_detection import StandInDetector
+    from modules.soak import SimulatedCamera, animal_boxes
+    runners = []
+
+    def make(clock, **overrides):
+        config_path = tmp_path / 'projects' / 'test' / 'config.yaml'
+        config_manager = ConfigManager(config_path)
+        if not config_path.exists():
+            config_manager.generate_new_config()
+        config_manager.config.update(dict({'h_resolution': 320, 'v_resolution': 240, 'detection_log_enabled': False,
+                                           'resource_check_interval': 0, 'storage_check_interval': 0,
+                                           'config_poll_interval': 0}, **overrides))
+        config_manager.write_config()
+        config_manager.load_config()
+        resolution = (config_manager.config['h_resolution'], config_manager.config['v_resolution'])
+        camera = SimulatedCamera(config_path.parent / 'Videos', clock, resolution)
+        detectors = (StandInDetector([camera.roi_box], name='roi_stand_in'),
+                     StandInDetector(animal_boxes(camera), name='ooi_stand_in'))
+        runner = Runner(config_path, detectors=detectors, collector=camera, clock=clock)
+        runners.append(runner)
+        return runner
+
+    yield make
+    for runner in runners:
+        runner.notifier.close(timeout=1)
+        runner.uploader.converter.shutdown()
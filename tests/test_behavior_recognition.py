@@ -0,0 +1,127 @@
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+from modules.behavior_recognition import BehaviorRecognizer
+
+
+def make_config(**overrides):
+    config = dict(behavior_check_window=10, behavior_min_individuals_roi=1, behavior_max_individuals_roi=3,
+                  behavior_min_fraction_for_notification=0.5, clip_window=None, framegrab_interval=0.2,
+                  thumbnail_format='jpeg', thumbnail_jpeg_quality=90)
+    config.update(overrides)
+    return SimpleNamespace(**config)
+
+
+def fill(recognizer, n, interval, occupancy=2):
+    thumbnail = np.full((48, 64, 3), 120, dtype=np.uint8)
+    for i in range(n):
+        recognizer.append_data(1000.0 + i * interval, occupancy, thumbnail, np.array([[4, 4, 20, 20]]))
+
+
+def read_clip(path):
+    video = cv2.VideoCapture(str(path))
+    fps, frames = video.get(cv2.CAP_PROP_FPS), int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    ok, frame = video.read()
+    video.release()
+    return fps, frames, frame if ok else None
+
+
+@pytest.mark.parametrize('thumbnail_format', ['jpeg', 'raw'])
+@pytest.mark.parametrize('framegrab_interval, expected_fps', [(0.2, 5), (0.4, 2.5), (2, 1)])
+def test_clips_play_at_the_framegrab_rate(tmp_path, thumbnail_format, framegrab_interval, expected_fps):
+    recognizer = BehaviorRecognizer(make_config(framegrab_interval=framegrab_interval,
+                                                thumbnail_format=thumbnail_format))
+    fill(recognizer, 5, framegrab_interval)
+    recognizer.thumbnails_to_mp4(tmp_path / 'clip.mp4')
+    fps, frames, frame = read_clip(tmp_path / 'clip.mp4')
+    assert fps == pytest.approx(expected_fps, rel=0.01)
+    assert frames == 5
+    assert frame.shape == (48, 64, 3)
+
+
+def test_clip_renderer_copies_the_buffer(tmp_path):
+    recognizer = BehaviorRecognizer(make_config())
+    fill(recognizer, 5, 0.2)
+    render = recognizer.clip_renderer()
+    # the buffer moves on before the clip is written, e.g. on the notification dispatcher thread
+    recognizer.reset()
+    fill(recognizer, 2, 0.2)
+    render(tmp_path / 'clip.mp4')
+    assert read_clip(tmp_path / 'clip.mp4')[1] == 5
+
+
+def reference_fraction(frames, window, min_individuals, max_individuals):
+    """activity fraction recomputed from scratch over the frames within window seconds of the newest"""
+    newest = frames[-1][0]
+    recent = [occupancy for timestamp, occupancy in frames if newest - timestamp <= window] or [frames[-1][1]]
+    return sum(min_individuals <= occupancy <= max_individuals for occupancy in recent) / len(recent)
+
+
+@pytest.mark.parametrize('clip_window', [None, 30])
+def test_running_fraction_matches_a_full_recount(clip_window):
+    recognizer = BehaviorRecognizer(make_config(clip_window=clip_window))
+    rng = np.random.default_rng(0)
+    timestamps = 1000.0 + np.cumsum(rng.uniform(0.05, 0.6, 2000))
+    # occasional capture gaps longer than the check window
+    timestamps[500:] += 15
+    timestamps[1500:] += 40
+    occupancies = rng.integers(0, 5, len(timestamps))
+    frames = []
+    for timestamp, occupancy in zip(timestamps.tolist(), occupancies.tolist()):
+        recognizer.append_data(timestamp, occupancy)
+        frames.append((timestamp, occupancy))
+        assert recognizer.calc_activity_fraction() == pytest.approx(reference_fraction(frames, 10, 1, 3))
+    recognizer.set_occupancy_range(2, 2)
+    assert recognizer.calc_activity_fraction() == pytest.approx(reference_fraction(frames, 10, 2, 2))
+
+
+def test_full_buffer_evicts_the_oldest_frame():
+    recognizer = BehaviorRecognizer(make_config())
+    # frames arriving faster than the framegrab interval fill the buffer before the window elapses
+    for i in range(recognizer.capacity + 10):
+        recognizer.append_data(1000.0 + i * 0.01, 2 if i < 10 else 0)
+    assert recognizer.size == recognizer.check_size == recognizer.capacity
+    assert recognizer.timestamps[recognizer.start] == pytest.approx(1000.1)
+    assert recognizer.calc_activity_fraction() == 0
+
+
+def test_checkpoint_round_trip():
+    recognizer = BehaviorRecognizer(make_config(clip_window=30))
+    fill(recognizer, 100, 0.2)
+    for i in range(20):
+        recognizer.append_data(1020.0 + i * 0.2, 0)
+    arrays = recognizer.checkpoint_arrays()
+    restored = BehaviorRecognizer(make_config(clip_window=30))
+    restored.restore(arrays['behavior_timestamps'], arrays['behavior_occupancies'])
+    assert len(restored) == len(recognizer)
+    assert restored.calc_activity_fraction() == recognizer.calc_activity_fraction()
+    # restored frames have no thumbnails to render
+    assert restored.clip_renderer() is None
+
+
+@pytest.mark.parametrize('thumbnail_format', ['jpeg', 'raw'])
+def test_restored_checkpoint_takes_the_next_thumbnail_shape(tmp_path, thumbnail_format):
+    recognizer = BehaviorRecognizer(make_config(thumbnail_format=thumbnail_format))
+    fill(recognizer, 3, 0.2)
+    arrays = recognizer.checkpoint_arrays()
+    recognizer.restore(arrays['behavior_timestamps'], arrays['behavior_occupancies'])
+    # e.g. the camera resolution changed across the restart
+    recognizer.append_data(1000.6, 2, np.full((96, 128, 3), 120, dtype=np.uint8))
+    recognizer.thumbnails_to_mp4(tmp_path / 'clip.mp4')
+    fps, frames, frame = read_clip(tmp_path / 'clip.mp4')
+    assert frames == 1
+    assert frame.shape == (96, 128, 3)
+
+
+@pytest.mark.parametrize('thumbnail_format', ['jpeg', 'raw'])
+def test_thumbnails_of_another_shape_join_the_clip(tmp_path, thumbnail_format):
+    recognizer = BehaviorRecognizer(make_config(thumbnail_format=thumbnail_format))
+    fill(recognizer, 3, 0.2)
+    recognizer.append_data(1000.6, 2, np.full((96, 128, 3), 120, dtype=np.uint8), np.array([[8, 8, 40, 40]]))
+    recognizer.thumbnails_to_mp4(tmp_path / 'clip.mp4')
+    fps, frames, frame = read_clip(tmp_path / 'clip.mp4')
+    assert frames == 4
+    assert frame.shape == (48, 64, 3)
@@ -0,0 +1,41 @@
+import tracemalloc
+
+import numpy as np
+
+from modules import benchmark
+from modules.benchmark import StageTimer
+
+
+def measure_allocations(timer):
+    timer.trace_allocations = True
+    tracemalloc.start()
+    try:
+        for _ in range(3):
+            with timer.measure('allocate'):
+                kept = np.ones(100000)
+    finally:
+        tracemalloc.stop()
+        timer.trace_allocations = False
+    return kept
+
+
+def test_stage_timer_records_latencies_and_allocations():
+    timer = StageTimer()
+    for _ in range(5):
+        with timer.measure('stage'):
+            pass
+    measure_allocations(timer)
+    stats = timer.summary()
+    assert stats['stage']['count'] == 5
+    assert stats['allocate']['alloc_mean_net_bytes'] >= 0
+    if benchmark.RESET_PEAK:
+        assert stats['allocate']['alloc_peak_bytes'] >= 800000
+
+
+def test_stage_timer_without_reset_peak(monkeypatch):
+    monkeypatch.setattr(benchmark, 'RESET_PEAK', False)
+    timer = StageTimer()
+    measure_allocations(timer)
+    stats = timer.summary()
+    assert stats['allocate']['alloc_peak_bytes'] is None
+    assert 'alloc_mean_net_bytes' in stats['allocate']
@@ -0,0 +1,61 @@
+from datetime import datetime
+
+import numpy as np
+
+from modules.checkpoint import RuntimeCheckpoint
+from modules.clock import VirtualClock
+
+
+def test_save_and_load_round_trip(tmp_path):
+    now = [1000.0]
+    checkpoint = RuntimeCheckpoint(tmp_path / 'checkpoint.npz', interval=10, max_age=60, time_func=lambda: now[0])
+    assert checkpoint.due() and checkpoint.load() is None
+    checkpoint.save({'count': 2}, {'values': np.arange(3)})
+    assert not checkpoint.due()
+    now[0] += 61
+    state, arrays = checkpoint.load()
+    assert state['count'] == 2 and state['saved_at'] == 1000.0
+    np.testing.assert_array_equal(arrays['values'], [0, 1, 2])
+    assert checkpoint.due() and not checkpoint.fresh(state)
+    checkpoint.clear()
+    checkpoint.clear()
+    assert checkpoint.load() is None
+
+
+def run_and_restart(make_runner, downtime):
+    clock = VirtualClock(datetime(2024, 6, 1, 10))
+    runner = make_runner(clock, checkpoint_max_age=600)
+    now = clock.now()
+    runner.reset_analysis_state(now)
+    for i in range(10):
+        runner.behavior_recognizer.append_data(clock.time() + i, 2)
+    runner.notifier.notification_count = 3
+    runner.notifier.last_notification_timestamp = clock.time() - 100
+    runner.frame_analyzer.roi_tracker.detected_at = now
+    runner.frame_analyzer.roi_box = (10, 10, 100, 100)
+    runner.save_checkpoint()
+    clock.advance(downtime)
+    restarted = make_runner(clock, checkpoint_max_age=600)
+    restarted.reset_analysis_state(clock.now())
+    restarted.restore_checkpoint(clock.now())
+    return restarted, clock
+
+
+def test_restart_within_max_age_restores_everything(make_runner):
+    restarted, _ = run_and_restart(make_runner, 60)
+    assert restarted.notifier.notification_count == 3
+    assert len(restarted.behavior_recognizer) == 10
+    assert restarted.frame_analyzer.restored_roi[0] == (10, 10, 100, 100)
+
+
+def test_restart_after_max_age_keeps_the_notification_counts(make_runner):
+    restarted, clock = run_and_restart(make_runner, 3600)
+    assert restarted.notifier.notification_count == 3
+    assert restarted.notifier.last_notification_timestamp == clock.time() - 3700
+    assert len(restarted.behavior_recognizer) == 0
+    assert restarted.frame_analyzer.restored_roi is None
+
+
+def test_restart_on_a_later_day_starts_over(make_runner):
+    restarted, _ = run_and_restart(make_runner, 86400)
+    assert restarted.notifier.notification_count == 0
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from modules.columnar_store import ColumnarLog, read_columns
+
+SCHEMA = {'timestamp': ('float64', ()), 'boxes': ('int32', (3, 4))}
+
+
+def append_rows(log, start, n):
+    for i in range(start, start + n):
+        log.append(timestamp=float(i), boxes=np.full((3, 4), i))
+
+
+def test_rows_are_written_in_chunks(tmp_path):
+    log = ColumnarLog(tmp_path / 'table', SCHEMA, chunk_rows=4, fsync=False)
+    append_rows(log, 0, 10)
+    # the last two rows are still buffered
+    assert len(log) == 10
+    assert log.read()['timestamp'].tolist() == list(range(8))
+    log.close()
+    columns = read_columns(tmp_path / 'table')
+    assert isinstance(columns['boxes'], np.memmap)
+    assert columns['timestamp'].tolist() == list(range(10))
+    assert columns['boxes'][:, 0, 0].tolist() == list(range(10))
+    loaded = read_columns(tmp_path / 'table', mmap=False)
+    assert not isinstance(loaded['boxes'], np.memmap)
+    assert np.array_equal(loaded['boxes'], columns['boxes'])
+
+
+def test_existing_tables_are_appended_to(tmp_path):
+    log = ColumnarLog(tmp_path / 'table', SCHEMA, chunk_rows=4)
+    append_rows(log, 0, 5)
+    log.close()
+    log = ColumnarLog(tmp_path / 'table')
+    append_rows(log, 5, 3)
+    log.close()
+    assert read_columns(tmp_path / 'table')['timestamp'].tolist() == list(range(8))
+
+
+def test_schemas_must_match(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        ColumnarLog(tmp_path / 'table')
+    ColumnarLog(tmp_path / 'table', SCHEMA).close()
+    with pytest.raises(ValueError):
+        ColumnarLog(tmp_path / 'table', {'timestamp': ('float32', ())})
+
+
+def test_torn_writes_are_trimmed_to_the_last_full_row(tmp_path):
+    log = ColumnarLog(tmp_path / 'table', SCHEMA, chunk_rows=2)
+    append_rows(log, 0, 4)
+    log.close()
+    # a crash after writing part of a chunk to one column
+    with open(tmp_path / 'table' / 'timestamp.bin', 'ab') as f:
+        f.write(np.arange(2, dtype=np.float64).tobytes() + b'\x00\x00')
+    assert len(read_columns(tmp_path / 'table')['timestamp']) == 4
+    log = ColumnarLog(tmp_path / 'table')
+    append_rows(log, 4, 2)
+    log.close()
+    columns = read_columns(tmp_path / 'table')
+    assert columns['timestamp'].tolist() == list(range(6))
+    assert columns['boxes'][:, 0, 0].tolist() == list(range(6))
@@ -0,0 +1,53 @@
+import pytest
+import yaml
+
+from modules.config_manager import ConfigManager, classify_parameter, check_range
+
+
+@pytest.fixture
+def config_manager(tmp_path):
+    config_manager = ConfigManager(tmp_path / 'project' / 'config.yaml')
+    config_manager.generate_new_config()
+    config_manager.load_config()
+    return config_manager
+
+
+def test_classify_parameter():
+    assert classify_parameter('min_notification_interval') == 'hot'
+    assert classify_parameter('framegrab_interval') == 'rebuild'
+    assert classify_parameter('h_resolution') == 'restart'
+
+
+def test_validate_changes_returns_only_changed_values(config_manager):
+    new_config = dict(config_manager.config, behavior_check_interval=10, framegrab_interval=0.5)
+    assert config_manager.validate_changes(new_config) == {'behavior_check_interval': 10, 'framegrab_interval': 0.5}
+
+
+@pytest.mark.parametrize('key, value', [('framegrab_interval', 0), ('framegrab_interval', -0.2),
+                                        ('behavior_check_window', 0), ('behavior_check_interval', -5),
+                                        ('roi_update_interval', 0), ('video_split_hours', 0),
+                                        ('behavior_min_fraction_for_notification', 1.5), ('start_hour', 24),
+                                        ('thumbnail_jpeg_quality', 101), ('checkpoint_interval', -1),
+                                        ('resource_ooi_stride', 0), ('framegrab_interval', 'fast')])
+def test_validate_changes_rejects_bad_values(config_manager, key, value):
+    with pytest.raises(ValueError, match=key):
+        config_manager.validate_changes(dict(config_manager.config, **{key: value}))
+
+
+def test_zero_disables_optional_intervals():
+    for key in ('checkpoint_interval', 'config_poll_interval', 'storage_check_interval', 'resource_check_interval'):
+        check_range(key, 0)
+    check_range('clip_window', None)
+
+
+def test_poll_changes_ignores_invalid_edits(config_manager):
+    now = [0.0]
+    config_manager.watch(1, time_func=lambda: now[0])
+    with open(config_manager.config_path, 'w') as f:
+        yaml.dump(dict(config_manager.config, framegrab_interval=0), f)
+    now[0] += 2
+    assert config_manager.poll_changes() == {}
+    with open(config_manager.config_path, 'w') as f:
+        yaml.dump(dict(config_manager.config, framegrab_interval=0.4, min_notification_interval=60), f)
+    now[0] += 2
+    assert config_manager.poll_changes() == {'framegrab_interval': 0.4, 'min_notification_interval': 60}
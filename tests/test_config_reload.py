@@ -0,0 +1,47 @@
+from datetime import datetime
+
+from modules.clock import VirtualClock
+
+
+def test_hot_and_rebuild_changes_apply_between_frames(make_runner):
+    clock = VirtualClock(datetime(2024, 6, 1, 10))
+    runner = make_runner(clock)
+    for i in range(20):
+        runner.behavior_recognizer.append_data(clock.time() + i * 0.2, 2)
+    scheduler = runner.scheduler
+    runner.apply_config_changes({'min_notification_interval': 60, 'behavior_check_window': 120,
+                                 'framegrab_interval': 0.5})
+    assert runner.notifier.min_notification_interval == 60
+    assert runner.behavior_recognizer.behavior_check_window == 120
+    assert len(runner.behavior_recognizer) == 20
+    assert runner.scheduler is not scheduler and runner.scheduler.interval == 0.5
+    assert runner.config_manager.config['framegrab_interval'] == 0.5
+
+
+def test_lowering_the_framegrab_interval_grows_the_behavior_buffer(make_runner):
+    clock = VirtualClock(datetime(2024, 6, 1, 10))
+    runner = make_runner(clock)
+    for i in range(20):
+        runner.behavior_recognizer.append_data(clock.time() + i * 0.2, 2)
+    recognizer = runner.behavior_recognizer
+    runner.apply_config_changes({'framegrab_interval': 0.05})
+    assert runner.behavior_recognizer is not recognizer and len(runner.behavior_recognizer) == 20
+    # a full check window of frames at the new interval fits, so behavior checks can run again
+    expected = runner.config.behavior_check_window / runner.scheduler.interval
+    assert runner.behavior_recognizer.capacity >= expected
+    start = clock.time() + 4
+    for i in range(int(expected)):
+        runner.behavior_recognizer.append_data(start + i * 0.05, 2)
+    assert len(runner.behavior_recognizer) >= expected // 2
+
+
+def test_changes_that_fail_to_apply_change_nothing(make_runner):
+    clock = VirtualClock(datetime(2024, 6, 1, 10))
+    runner = make_runner(clock)
+    scheduler = runner.scheduler
+    # values validate_changes would reject, applied directly
+    runner.apply_config_changes({'framegrab_interval': 0, 'min_notification_interval': 60})
+    runner.apply_config_changes({'start_hour': 25})
+    assert runner.scheduler is scheduler
+    assert runner.config.framegrab_interval == 0.2 and runner.config.start_hour == 7
+    assert runner.notifier.min_notification_interval == 600
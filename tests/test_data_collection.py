@@ -0,0 +1,113 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+from modules.clock import VirtualClock
+from modules import data_collection
+from modules.data_collection import DataCollector, FramePool, MockDataCollector
+from modules.pipeline import FramePacket
+
+
+def write_video(path, n_frames, fps=30, resolution=(64, 48)):
+    """mp4 whose nth frame has a blue channel of 4 * n, a green channel of 100, and a red channel of 200"""
+    video = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc('m', 'p', '4', 'v'), fps, resolution)
+    for n in range(n_frames):
+        frame = np.empty((resolution[1], resolution[0], 3), dtype=np.uint8)
+        frame[...] = (4 * n, 100, 200)
+        video.write(frame)
+    video.release()
+
+
+def test_pool_reuses_released_buffers():
+    pool = FramePool((4, 6, 3), size=2)
+    first = pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+    assert pool.checked_out() == 1
+
+
+def test_pool_grows_when_exhausted():
+    pool = FramePool((4, 6, 3), size=2)
+    buffers = [pool.acquire() for _ in range(3)]
+    assert len({id(b) for b in buffers}) == 3
+    assert len(pool.buffers) == 3 and pool.checked_out() == 3
+
+
+def test_pool_ignores_double_and_foreign_releases():
+    pool = FramePool((4, 6, 3), size=2)
+    buffer = pool.acquire()
+    pool.release(buffer)
+    pool.release(buffer)
+    pool.release(np.zeros((4, 6, 3), dtype=np.uint8))
+    assert len(pool.free) == 2
+
+
+@pytest.mark.parametrize('analysis_resolution, shape', [(None, (48, 64, 3)), ((32, 24), (24, 32, 3))])
+def test_mock_collector_captures_every_framestep_into_the_pool(tmp_path, analysis_resolution, shape):
+    write_video(tmp_path / 'source.mp4', 40)
+    collector = MockDataCollector(tmp_path / 'source.mp4', 0.2, analysis_resolution, frame_pool_size=2)
+    blues = []
+    while True:
+        image = collector.capture_frame()
+        if image is False:
+            break
+        assert image.shape == shape
+        # frames are converted to RGB
+        assert image[..., 0].mean() == pytest.approx(200, abs=4)
+        blues.append(image[..., 2].mean())
+        collector.release_frame(image)
+    # every 6th frame of the 30 fps video, starting with the 6th
+    assert blues == pytest.approx([4 * n for n in range(5, 40, 6)], abs=4)
+    assert len(collector.frame_pool.buffers) == 2
+
+
+class FailingCamera:
+    resolution = (64, 48)
+    closed = False
+
+    def capture(self, image, **kwargs):
+        raise RuntimeError('camera timed out')
+
+    def start_recording(self, output, **kwargs):
+        pass
+
+
+def test_failed_captures_return_their_buffer(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_collection, 'picamera', SimpleNamespace(PiCamera=FailingCamera))
+    collector = DataCollector(tmp_path / 'Videos', frame_pool_size=2)
+    for _ in range(5):
+        with pytest.raises(RuntimeError):
+            collector.capture_frame()
+    assert collector.frame_pool.checked_out() == 0
+    assert len(collector.frame_pool.buffers) == 2
+
+
+def test_segments_are_named_and_indexed_by_the_given_clock(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_collection, 'picamera', SimpleNamespace(PiCamera=FailingCamera))
+    monkeypatch.setattr(data_collection, 'sleep', lambda seconds: None)
+    clock = VirtualClock(datetime(2024, 6, 1, 10))
+    collector = DataCollector(tmp_path / 'Videos', time_func=clock.time)
+    collector.start_recording()
+    assert collector.h264_path.name == '2024-06-01T10_00_00.h264'
+    assert collector.output.time_func() == clock.time()
+    collector.output.close()
+
+
+def test_runner_returns_analyzed_and_dropped_frames(make_runner):
+    clock = VirtualClock(datetime(2024, 6, 1, 10))
+    runner = make_runner(clock)
+    pool = runner.collector.frame_pool
+    size = len(pool.buffers)
+    runner.reset_analysis_state(clock.now())
+    for i in range(3 * size):
+        packet = FramePacket(clock.now(), runner.collector.capture_frame())
+        if i % 2:
+            runner.drop_packet(packet)
+        else:
+            runner.process_frame(packet)
+        clock.advance(0.2)
+    assert pool.checked_out() == 0
+    assert len(pool.buffers) == size
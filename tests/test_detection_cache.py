@@ -0,0 +1,64 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from modules.config_manager import ConfigManager
+from modules.detection_cache import DetectionCache
+from modules.object_detection import StandInDetector
+from modules.replay import VideoReplayer
+from test_replay import write_video
+
+BOX = (0, 0, 160, 120)
+
+
+def test_entries_survive_reopening(tmp_path):
+    video_path = tmp_path / 'video.mp4'
+    video_path.write_bytes(b'video')
+    detector = StandInDetector([(1, 2, 3, 4), (5, 6, 7, 8)])
+    img = np.zeros((120, 160, 3), dtype=np.uint8)
+    cache = DetectionCache(tmp_path / 'cache', chunk_rows=4)
+    cache.open_video(video_path)
+    for frame_index in range(10):
+        cache.detect(detector, img, frame_index, BOX)
+    cache.close()
+    cache.open_video(video_path)
+    dets = cache.detect(detector, img, 7, BOX)
+    assert detector.inference_count == 10 and cache.hit_count == 1
+    assert dets.valid_boxes().tolist() == [[1, 2, 3, 4], [5, 6, 7, 8]]
+    assert dets.scores[:2].tolist() == [np.float32(0.9)] * 2
+
+
+def test_entries_are_keyed_by_input_model_threshold_and_video(tmp_path):
+    video_path = tmp_path / 'video.mp4'
+    video_path.write_bytes(b'video')
+    img = np.zeros((120, 160, 3), dtype=np.uint8)
+    detector = StandInDetector([(1, 2, 3, 4)], name='a')
+    cache = DetectionCache(tmp_path / 'cache')
+    cache.open_video(video_path)
+    cache.detect(detector, img, 0, BOX)
+    cache.detect(detector, img, 0, (10, 10, 100, 100))
+    cache.detect(StandInDetector([(1, 2, 3, 4)], name='b'), img, 0, BOX)
+    detector.set_confidence_thresh(0.6)
+    cache.detect(detector, img, 0, BOX)
+    # re-recorded under the same name, but a different size
+    video_path.write_bytes(b'other video')
+    cache.open_video(video_path)
+    detector.set_confidence_thresh(0.5)
+    cache.detect(detector, img, 0, BOX)
+    assert cache.hit_count == 0 and cache.miss_count == 5
+
+
+def test_second_replay_runs_no_inference(tmp_path):
+    config = SimpleNamespace(**dict(ConfigManager(tmp_path / 'config.yaml').default_config(), framegrab_interval=0.2))
+    video_path = tmp_path / '2024-06-01T10_00_00.mp4'
+    write_video(video_path, 5)
+    tables = []
+    for run in range(2):
+        roi_detector = StandInDetector([(20, 10, 140, 110)], name='roi')
+        ooi_detector = StandInDetector([(30, 30, 50, 50), (60, 60, 80, 80)], name='ooi')
+        replayer = VideoReplayer(config, roi_detector, ooi_detector, detection_cache=DetectionCache(tmp_path / 'cache'))
+        replayer.replay(video_path, tmp_path / f'out{run}')
+        tables.append([(tmp_path / f'out{run}' / f'{video_path.stem}_{name}.csv').read_text()
+                       for name in ('frames', 'detections', 'checks')])
+    assert roi_detector.inference_count == ooi_detector.inference_count == 0
+    assert tables[0] == tables[1]
@@ -0,0 +1,59 @@
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from modules.clock import VirtualClock
+from modules.detection_log import DetectionLog, read_detection_log
+from modules.object_detection import Detections
+from modules.pipeline import FramePacket
+
+
+def make_packet(timestamp, roi_box=(100, 50, 300, 250), boxes=((10, 20, 30, 40), (50, 60, 70, 80))):
+    packet = FramePacket(timestamp, None)
+    if roi_box is not None:
+        dets = Detections(25)
+        dets.boxes[:len(boxes)] = np.reshape(boxes, (-1, 4))
+        dets.scores[:len(boxes)] = 0.9
+        dets.count = len(boxes)
+        packet.dets, packet.occupancy, packet.roi_box, packet.inferred = dets, len(boxes), roi_box, True
+    return packet
+
+
+def test_frames_are_logged_in_full_frame_coordinates(tmp_path):
+    log = DetectionLog(tmp_path, chunk_rows=2, fsync=False)
+    start = datetime(2024, 6, 1, 10)
+    log.append(make_packet(start, roi_box=None))
+    log.append(make_packet(start + timedelta(seconds=0.2)))
+    log.append(make_packet(start + timedelta(seconds=0.4), boxes=()))
+    log.close()
+    columns = read_detection_log(tmp_path, date(2024, 6, 1))
+    assert columns['timestamp'].tolist() == [start.timestamp() + t for t in (0, 0.2, 0.4)]
+    assert columns['occupancy'].tolist() == [-1, 2, 0]
+    assert columns['roi_box'].tolist() == [[-1] * 4, [100, 50, 300, 250], [100, 50, 300, 250]]
+    assert columns['inferred'].tolist() == [False, True, True]
+    assert columns['boxes'][1, :2].tolist() == [[110, 70, 130, 90], [150, 110, 170, 130]]
+    assert not columns['boxes'][1, 2:].any() and not columns['boxes'][2].any()
+    assert columns['scores'][1].tolist() == [np.float32(0.9)] * 2 + [0] * 23
+
+
+def test_each_day_gets_its_own_table(tmp_path):
+    log = DetectionLog(tmp_path, fsync=False)
+    for timestamp in (datetime(2024, 6, 1, 23, 59, 59), datetime(2024, 6, 2, 0, 0, 1), datetime(2024, 6, 2, 7)):
+        log.append(make_packet(timestamp))
+    log.close()
+    assert len(read_detection_log(tmp_path, '2024-06-01')['timestamp']) == 1
+    assert len(read_detection_log(tmp_path, '2024-06-02')['timestamp']) == 2
+
+
+def test_runner_logs_every_analyzed_frame(make_runner):
+    clock = VirtualClock(datetime(2024, 6, 1, 10))
+    runner = make_runner(clock, detection_log_enabled=True)
+    runner.reset_analysis_state(clock.now())
+    for _ in range(7):
+        runner.process_frame(FramePacket(clock.now(), runner.collector.capture_frame()))
+        clock.advance(0.2)
+    runner.detection_log.close()
+    columns = read_detection_log(runner.project_dir / 'DetectionLog', '2024-06-01')
+    assert len(columns['timestamp']) == 7
+    assert (columns['occupancy'] >= 0).all()
+    assert (columns['roi_box'] == runner.frame_analyzer.roi_box).all()
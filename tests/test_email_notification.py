@@ -0,0 +1,97 @@
+import json
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from modules.email_notification import HttpTransport, Notification, NotificationDispatcher, Notifier
+
+
+class StandInServer:
+    """local http server answering each notification with the next of a list of status codes (200 once used up)"""
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                server.requests.append((time.time(), payload))
+                self.send_response(server.statuses.pop(0) if server.statuses else 200)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/notify'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def server():
+    stand_in = StandInServer()
+    yield stand_in
+    stand_in.close()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_queue_survives_a_restart(tmp_path, server):
+    server.statuses = [500]
+    dispatcher = NotificationDispatcher(tmp_path, HttpTransport(server.url), 'rba@example.com', backoff_initial=60)
+    dispatcher.enqueue(Notification('event', 'message'), 'user@example.com')
+    wait_for(lambda: len(server.requests) == 1)
+    dispatcher.close(timeout=1)
+    queued = list(tmp_path.glob('*.json'))
+    assert len(queued) == 1 and json.loads(queued[0].read_text())['attempts'] == 1
+
+    # the restarted dispatcher picks the notification up again once its retry is due
+    dispatcher = NotificationDispatcher(tmp_path, HttpTransport(server.url), 'rba@example.com',
+                                        time_func=lambda: time.time() + 60)
+    assert len(dispatcher.entries) == 1
+    wait_for(lambda: not list(tmp_path.glob('*.json')))
+    dispatcher.close(timeout=1)
+    assert len(server.requests) == 2
+    assert server.requests[1][1]['subject'] == 'event'
+
+
+def test_retries_back_off_then_move_to_failed(tmp_path, server):
+    server.statuses = [500, 503, 500]
+    dispatcher = NotificationDispatcher(tmp_path, HttpTransport(server.url), 'rba@example.com', max_attempts=3,
+                                        backoff_initial=0.1, backoff_max=0.15)
+    dispatcher.enqueue(Notification('event', 'message'), 'user@example.com')
+    wait_for(lambda: list((tmp_path / 'failed').glob('*.json')))
+    dispatcher.close(timeout=1)
+    times = [t for t, _ in server.requests]
+    assert len(times) == 3
+    assert times[1] - times[0] >= 0.1
+    assert times[2] - times[1] >= 0.15
+    assert not list(tmp_path.glob('*.json'))
+    failed = list((tmp_path / 'failed').glob('*.json'))
+    assert json.loads(failed[0].read_text())['attempts'] == 3
+
+
+def test_notifications_are_stamped_with_the_injected_clock(tmp_path, server):
+    now = datetime(2024, 6, 1, 12, 30).timestamp()
+    notifier = Notifier('user@example.com', 'rba@example.com', None, None, transport=HttpTransport(server.url),
+                        queue_dir=tmp_path, time_func=lambda: now)
+    notifier.notify(Notification('event', 'message'))
+    wait_for(lambda: server.requests)
+    notifier.close(timeout=1)
+    assert server.requests[0][1]['time'] == '2024-06-01T12:30:00'
+    assert notifier.last_notification_timestamp == now
@@ -0,0 +1,129 @@
+import threading
+
+import pytest
+
+from modules.config_manager import ConfigManager
+from modules.inference_scheduler import InferenceScheduler
+
+
+class Gate:
+    """process function that records each item and holds it until released"""
+
+    def __init__(self, log, name):
+        self.log, self.name = log, name
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.active, self.max_active = 0, 0
+        self.lock = threading.Lock()
+
+    def __call__(self, item):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        self.log.append((self.name, item))
+        self.started.set()
+        self.release.wait(5)
+        with self.lock:
+            self.active -= 1
+
+
+def test_sources_are_served_in_proportion_to_their_rates():
+    log = []
+    scheduler = InferenceScheduler(workers=1)
+    # a blocker holds the only worker while both sources fill their queues
+    blocker = Gate(log, 'blocker')
+    scheduler.add_source('blocker', blocker)
+    scheduler.submit('blocker', 0)
+    assert blocker.started.wait(5)
+    slow, fast = (lambda item: log.append(('slow', item))), (lambda item: log.append(('fast', item)))
+    scheduler.add_source('slow', slow, rate=5, maxsize=100)
+    scheduler.add_source('fast', fast, rate=10, maxsize=100)
+    for i in range(30):
+        scheduler.submit('slow', i)
+        scheduler.submit('fast', i)
+    blocker.release.set()
+    scheduler.remove_source('slow')
+    scheduler.remove_source('fast')
+    scheduler.stop()
+    first = [name for name, _ in log[1:31]]
+    assert first.count('fast') == 20 and first.count('slow') == 10
+    # each source's items stay in order
+    assert [item for name, item in log if name == 'slow'] == list(range(30))
+    assert [item for name, item in log if name == 'fast'] == list(range(30))
+
+
+def test_each_source_is_processed_by_one_worker_at_a_time():
+    log = []
+    scheduler = InferenceScheduler(workers=3)
+    gates = {name: Gate(log, name) for name in ('a', 'b')}
+    for name, gate in gates.items():
+        scheduler.add_source(name, gate, maxsize=10)
+        for i in range(3):
+            scheduler.submit(name, i)
+    # both sources start in parallel
+    assert all(gate.started.wait(5) for gate in gates.values())
+    for gate in gates.values():
+        gate.release.set()
+    stats = [scheduler.remove_source(name) for name in gates]
+    scheduler.stop()
+    assert [gate.max_active for gate in gates.values()] == [1, 1]
+    assert [s['processed'] for s in stats] == [3, 3]
+
+
+def test_full_queues_drop_the_oldest_item():
+    log, dropped = [], []
+    scheduler = InferenceScheduler(workers=1)
+    gate = Gate(log, 'a')
+    scheduler.add_source('a', gate, on_drop=dropped.append, maxsize=2)
+    scheduler.submit('a', 0)
+    assert gate.started.wait(5)
+    for i in range(1, 6):
+        scheduler.submit('a', i)
+    gate.release.set()
+    stats = scheduler.remove_source('a')
+    scheduler.stop()
+    assert [item for _, item in log] == [0, 4, 5]
+    assert dropped == [1, 2, 3]
+    assert stats['dropped'] == 3 and stats['submitted'] == 6
+
+
+def test_errors_stop_the_source_and_reach_the_submitter():
+    dropped = []
+    scheduler = InferenceScheduler(workers=1)
+    failed = threading.Event()
+
+    def process(item):
+        failed.set()
+        raise RuntimeError('detector failed')
+
+    scheduler.add_source('a', process, on_drop=dropped.append, maxsize=10)
+    scheduler.submit('a', 0)
+    assert failed.wait(5)
+    with pytest.raises(RuntimeError):
+        for i in range(1, 100):
+            scheduler.submit('a', i)
+            threading.Event().wait(0.01)
+    stats = scheduler.remove_source('a')
+    scheduler.stop()
+    assert stats['processed'] == 1 and stats['dropped'] == len(dropped)
+
+
+def test_source_names_are_unique():
+    scheduler = InferenceScheduler(workers=1)
+    scheduler.add_source('a', print)
+    with pytest.raises(ValueError):
+        scheduler.add_source('a', print)
+    scheduler.stop()
+
+
+def test_multi_runner_requires_matching_detector_options(tmp_path):
+    from main import MultiRunner
+    config_paths = []
+    for project_id, roi_model in (('tank_a', 'roi_a.tflite'), ('tank_b', 'roi_b.tflite')):
+        config_manager = ConfigManager(tmp_path / project_id / 'config.yaml')
+        config_manager.generate_new_config()
+        config_manager.config['roi_model'] = roi_model
+        config_manager.write_config()
+        config_paths.append(config_manager.config_path)
+    with pytest.raises(ValueError, match='roi_model'):
+        MultiRunner(config_paths)
@@ -0,0 +1,18 @@
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+
+def test_modes_needing_a_config_exit_when_it_is_missing(tmp_path):
+    project_id = 'test_missing_config_project'
+    for args in (['--replay', str(tmp_path)], ['--sweep', str(tmp_path)],
+                 ['--extract_clip', '2024-01-01T00:00:00', '2024-01-01T00:00:10']):
+        result = subprocess.run([sys.executable, str(REPO_ROOT / 'main.py'), '--project_id', project_id,
+                                 '--log_dir', str(tmp_path / 'logs')] + args,
+                                cwd=tmp_path, capture_output=True, text=True, timeout=60)
+        assert result.returncode == 1
+        assert 'config.yaml not found' in result.stderr
+        assert not (REPO_ROOT / 'projects' / project_id).exists()
+    assert (tmp_path / 'logs' / 'debug.log').exists()
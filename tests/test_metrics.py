@@ -0,0 +1,81 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from modules.clock import VirtualClock
+from modules.metrics import NULL_METRICS, Histogram, Metrics, init_metrics
+from modules.pipeline import FramePacket
+
+
+def test_histogram_quantiles_are_bucket_bounds_capped_at_the_max():
+    histogram = Histogram()
+    for value in [0.003] * 90 + [0.015] * 9 + [0.4]:
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert (snapshot['p50'], snapshot['p95'], snapshot['p99']) == (0.005, 0.02, 0.02)
+    assert histogram.quantile(1) == 0.4
+    assert snapshot['count'] == 100 and snapshot['mean'] == pytest.approx(0.00805)
+    assert snapshot['buckets'] == {'0.005': 90, '0.02': 9, '0.5': 1}
+
+
+def test_counters_are_thread_safe():
+    metrics = Metrics()
+    threads = [threading.Thread(target=lambda: [metrics.increment('frames') for _ in range(10000)])
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert metrics.snapshot()['counters']['frames'] == 40000
+
+
+def test_collectors_refresh_gauges_and_failures_are_skipped():
+    metrics = Metrics()
+    depth = [3]
+    collector = metrics.add_collector(lambda m: m.set_gauge('queue_depth', depth[0]))
+    metrics.add_collector(lambda m: 1 / 0)
+    assert metrics.snapshot()['gauges']['queue_depth'] == 3
+    depth[0] = 5
+    metrics.remove_collector(collector)
+    assert metrics.snapshot()['gauges']['queue_depth'] == 3
+
+
+def test_http_endpoint_and_final_snapshot(tmp_path):
+    metrics = Metrics()
+    metrics.increment('frames_captured', 7)
+    metrics.start_http_server(0)
+    url = f'http://127.0.0.1:{metrics.server.server_address[1]}'
+    with urllib.request.urlopen(f'{url}/metrics', timeout=5) as response:
+        assert json.load(response)['counters'] == {'frames_captured': 7}
+    with pytest.raises(urllib.error.HTTPError):
+        urllib.request.urlopen(f'{url}/other', timeout=5)
+    metrics.close(tmp_path / 'metrics.json')
+    assert json.loads((tmp_path / 'metrics.json').read_text())['counters'] == {'frames_captured': 7}
+
+
+def test_disabled_metrics_record_nothing(tmp_path):
+    metrics = init_metrics(SimpleNamespace(metrics_enabled=False), tmp_path)
+    assert metrics is NULL_METRICS
+    with metrics.timer('analyze_frame'):
+        metrics.increment('frames_captured')
+    assert metrics.snapshot() == {}
+
+
+def test_runner_times_each_frame(make_runner):
+    clock = VirtualClock(datetime(2024, 6, 1, 10))
+    runner = make_runner(clock, metrics_enabled=True, metrics_flush_interval=0)
+    runner.reset_analysis_state(clock.now())
+    for _ in range(5):
+        runner.process_frame(FramePacket(clock.now(), runner.collector.capture_frame()))
+        clock.advance(0.2)
+    snapshot = runner.metrics.snapshot()
+    assert snapshot['histograms']['analyze_frame']['count'] == 5
+    assert snapshot['histograms']['record_and_check']['count'] == 5
+    assert snapshot['gauges']['behavior_buffer_frames'] == 5
+    runner.close_metrics()
+    assert (runner.project_dir / 'metrics.json').exists()
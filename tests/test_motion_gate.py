@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import numpy as np
+
+from modules.config_manager import ConfigManager
+from modules.frame_analysis import FrameAnalyzer
+from modules.motion_gate import MotionGate
+from modules.object_detection import StandInDetector
+from modules.pipeline import FramePacket
+
+
+def scene(shift=0, size=(120, 160)):
+    """RGB frame of a bright square on a dark background, moved right by shift pixels"""
+    img = np.full(size + (3,), 30, dtype=np.uint8)
+    img[40:80, 40 + shift:80 + shift] = 220
+    return img
+
+
+def test_static_scene_is_skipped_until_max_skip():
+    gate = MotionGate(max_skip=3)
+    decisions = [gate.should_infer(scene()) for _ in range(9)]
+    assert decisions == [True, False, False, False, True, False, False, False, True]
+    assert gate.skip_fraction() == 6 / 9
+
+
+def test_change_is_measured_against_the_last_analyzed_frame():
+    gate = MotionGate(change_thresh=0.02, max_skip=100)
+    assert gate.should_infer(scene())
+    # each step alone moves too few pixels, but the drift adds up against the reference
+    decisions = [gate.should_infer(scene(shift)) for shift in range(1, 7)]
+    assert decisions[0] is False and any(decisions)
+    assert gate.should_infer(scene(30))
+
+
+def test_reset_and_new_shapes_force_an_inference():
+    gate = MotionGate(max_skip=100)
+    gate.should_infer(scene())
+    assert not gate.should_infer(scene())
+    gate.reset()
+    assert gate.should_infer(scene())
+    assert gate.should_infer(scene(size=(100, 160)))
+
+
+def test_analyzer_reuses_detections_while_the_roi_is_still(tmp_path):
+    config = dict(ConfigManager(tmp_path / 'config.yaml').default_config(), motion_gate_enabled=True,
+                  motion_gate_max_skip=4)
+    roi_detector = StandInDetector([(20, 10, 140, 110)], name='roi')
+    ooi_detector = StandInDetector([(30, 30, 50, 50), (60, 60, 80, 80)], name='ooi')
+    analyzer = FrameAnalyzer(SimpleNamespace(**config), roi_detector, ooi_detector)
+    start = datetime(2024, 6, 1, 10)
+    packets = [analyzer.analyze(FramePacket(start + timedelta(seconds=i), scene())) for i in range(10)]
+    assert [p.inferred for p in packets] == [True, False, False, False, False] * 2
+    assert ooi_detector.inference_count == 2
+    assert all(p.occupancy == 2 and p.dets is packets[0].dets for p in packets[:5])
+    assert analyzer.analyze(FramePacket(start + timedelta(seconds=10), scene(40))).inferred
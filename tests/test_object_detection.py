@@ -0,0 +1,139 @@
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from modules.object_detection import DetectorBase, DetectorPool, Detections
+
+
+class FakeInterpreter:
+    """stands in for a tflite Interpreter running an SSD-style detection model with fixed outputs"""
+
+    def __init__(self, input_dtype=np.uint8, input_size=(32, 24), outputs=None, boxes_first=False, device=None,
+                 delay=0.0, score_from_input=False):
+        self.device, self.delay, self.score_from_input = device, delay, score_from_input
+        width, height = input_size
+        self.input = np.zeros((1, height, width, 3), dtype=input_dtype)
+        outputs = outputs or {'boxes': [[0.0, 0.0, 1.0, 1.0]], 'scores': [0.9], 'class_ids': [0]}
+        n = 10
+        self.boxes = np.zeros((1, n, 4), dtype=np.float32)
+        self.scores = np.zeros((1, n), dtype=np.float32)
+        self.class_ids = np.zeros((1, n), dtype=np.float32)
+        count = len(outputs['scores'])
+        self.boxes[0, :count], self.scores[0, :count] = outputs['boxes'], outputs['scores']
+        self.class_ids[0, :count] = outputs['class_ids']
+        self.count = np.array([count], dtype=np.float32)
+        # TF1 detection models list boxes first, TF2 models list scores first
+        if boxes_first:
+            self.tensors = [self.input, self.boxes, self.class_ids, self.scores, self.count]
+        else:
+            self.tensors = [self.input, self.scores, self.boxes, self.count, self.class_ids]
+        self.invocations = 0
+
+    def allocate_tensors(self):
+        pass
+
+    def get_input_details(self):
+        return [{'index': 0, 'shape': np.array(self.input.shape), 'dtype': self.input.dtype}]
+
+    def get_output_details(self):
+        return [{'index': i} for i in range(1, 5)]
+
+    def _get_full_signature_list(self):
+        return {}
+
+    def tensor(self, index):
+        return lambda: self.tensors[index]
+
+    def invoke(self):
+        time.sleep(self.delay)
+        if self.score_from_input:
+            self.scores[0, 0] = self.input.mean() / 255
+        self.invocations += 1
+
+
+def make_detector(tmp_path, monkeypatch, **kwargs):
+    model_path = tmp_path / 'model.tflite'
+    model_path.write_bytes(b'model')
+    monkeypatch.setattr(DetectorBase, 'init_interpreter', staticmethod(lambda *args: FakeInterpreter(**kwargs)))
+    return DetectorBase(model_path)
+
+
+@pytest.mark.parametrize('input_dtype, direct_input', [(np.uint8, True), (np.float32, False)])
+def test_image_is_resized_into_the_input_tensor(tmp_path, monkeypatch, input_dtype, direct_input):
+    detector = make_detector(tmp_path, monkeypatch, input_dtype=input_dtype)
+    img = np.random.default_rng(0).integers(0, 255, (120, 160, 3), dtype=np.uint8)
+    detector.detect(img)
+    assert detector.direct_input == direct_input
+    assert np.array_equal(detector.interpreter.input[0], cv2.resize(img, (32, 24)))
+
+
+@pytest.mark.parametrize('boxes_first', [False, True])
+def test_detections_are_thresholded_sorted_and_scaled(tmp_path, monkeypatch, boxes_first):
+    outputs = {'boxes': [[0.1, 0.2, 0.5, 0.6], [0.0, 0.0, 1.2, 0.5], [0.5, 0.5, 0.6, 0.6]],
+               'scores': [0.5, 0.8, 0.1], 'class_ids': [1, 2, 3]}
+    detector = make_detector(tmp_path, monkeypatch, outputs=outputs, boxes_first=boxes_first)
+    result = detector.detect(np.zeros((200, 100, 3), dtype=np.uint8))
+    assert len(result) == 2
+    assert result.scores[:2].tolist() == pytest.approx([0.8, 0.5])
+    assert result.class_ids[:2].tolist() == [2, 1]
+    # (ymin, xmin, ymax, xmax) fractions become (xmin, ymin, xmax, ymax) pixels, clipped to the image
+    assert result.valid_boxes().tolist() == [[0, 0, 50, 200], [20, 20, 60, 100]]
+
+
+def test_result_is_reused_unless_copied(tmp_path, monkeypatch):
+    detector = make_detector(tmp_path, monkeypatch)
+    img = np.zeros((24, 32, 3), dtype=np.uint8)
+    first = detector.detect(img)
+    kept = first.copy()
+    detector.set_confidence_thresh(0.95)
+    assert detector.detect(img) is first
+    assert len(first) == 0 and len(kept) == 1
+    out = Detections(10)
+    assert detector.detect(img, out=out) is out
+    assert detector.inference_count == 3
+
+
+def make_pool(tmp_path, monkeypatch, delays=None, **kwargs):
+    """DetectorPool of fake interpreters. delays maps device strings to each interpreter's invoke time"""
+    model_path = tmp_path / 'model.tflite'
+    model_path.write_bytes(b'model')
+
+    def init_interpreter(model_path, device=None, num_threads=1):
+        return FakeInterpreter(device=device, delay=(delays or {}).get(device, 0.0), score_from_input=True)
+
+    monkeypatch.setattr(DetectorBase, 'init_interpreter', staticmethod(init_interpreter))
+    return DetectorPool(model_path, confidence_thresh=0.0, **kwargs)
+
+
+def test_pool_falls_back_to_one_cpu_interpreter(tmp_path, monkeypatch):
+    # pycoral is not installed here, so 'all' finds no Edge TPU
+    pool = make_pool(tmp_path, monkeypatch, edgetpu_devices='all')
+    assert [detector.device for detector in pool.detectors] == ['cpu']
+    pool.close()
+
+
+def test_pool_returns_batch_results_in_order(tmp_path, monkeypatch):
+    pool = make_pool(tmp_path, monkeypatch, delays={':0': 0.01, ':1': 0.01, 'cpu': 0.01},
+                     edgetpu_devices=[':0', ':1'], cpu_workers=1)
+    imgs = [np.full((24, 32, 3), 10 * i, dtype=np.uint8) for i in range(12)]
+    results = pool.detect_batch(imgs)
+    assert [round(float(r.scores[0]) * 255) for r in results] == [10 * i for i in range(12)]
+    assert len({id(r) for r in results}) == 12
+    assert sum(detector.inference_count for detector in pool.detectors) == 12
+    assert all(detector.inference_count for detector in pool.detectors)
+    pool.set_confidence_thresh(0.5)
+    assert all(detector.confidence_thresh == 0.5 for detector in pool.detectors)
+    pool.close()
+
+
+def test_pool_prefers_the_faster_detector(tmp_path, monkeypatch):
+    pool = make_pool(tmp_path, monkeypatch, delays={':0': 0.02}, edgetpu_devices=[':0'], cpu_workers=1)
+    img = np.zeros((24, 32, 3), dtype=np.uint8)
+    out = pool.new_result()
+    for _ in range(10):
+        assert pool.detect(img, out=out) is out
+    slow, fast = pool.detectors
+    assert slow.inference_count == 1 and fast.inference_count == 9
+    pool.close()
@@ -0,0 +1,41 @@
+import threading
+
+from modules.pipeline import Pipeline
+
+
+def test_only_the_first_queue_drops():
+    release = threading.Event()
+    inferred, analyzed, dropped = [], [], []
+
+    def infer(item):
+        inferred.append(item)
+        return item
+
+    def analyze(item):
+        release.wait(5)
+        analyzed.append(item)
+
+    pipeline = Pipeline([('inference', infer), ('analysis', analyze)], maxsize=1, drop_policy='drop_oldest',
+                        on_drop=dropped.append)
+    pipeline.start()
+    submitter = threading.Thread(target=lambda: [pipeline.submit(i) for i in range(50)])
+    submitter.start()
+    submitter.join(5)
+    release.set()
+    pipeline.stop(timeout=5)
+    stats = pipeline.stats()
+    assert stats['analysis']['drops'] == 0
+    assert analyzed == inferred
+    assert len(inferred) + len(dropped) == 50
+    assert stats['inference']['drops'] == len(dropped)
+
+
+def test_block_policy_drops_nothing():
+    analyzed = []
+    pipeline = Pipeline([('inference', lambda item: item), ('analysis', analyzed.append)], maxsize=1,
+                        drop_policy='block')
+    pipeline.start()
+    for i in range(20):
+        pipeline.submit(i)
+    pipeline.stop(timeout=5)
+    assert analyzed == list(range(20))
@@ -0,0 +1,53 @@
+import csv
+from datetime import datetime
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+from modules.config_manager import ConfigManager
+from modules.object_detection import StandInDetector
+from modules.replay import VideoReplayer, video_start_time
+
+
+def write_video(path, seconds, fps=10, resolution=(160, 120)):
+    video = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc('m', 'p', '4', 'v'), fps, resolution)
+    for _ in range(seconds * fps):
+        video.write(np.full((resolution[1], resolution[0], 3), 60, dtype=np.uint8))
+    video.release()
+
+
+def read_table(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_video_start_time():
+    assert video_start_time('Videos/2024-06-01T10_00_00.mp4') == datetime(2024, 6, 1, 10)
+    assert video_start_time('Videos/clip.mp4') == datetime.fromtimestamp(0)
+
+
+def test_replay_writes_frame_detection_and_check_tables(tmp_path):
+    config = SimpleNamespace(**dict(ConfigManager(tmp_path / 'config.yaml').default_config(), framegrab_interval=0.2,
+                                    behavior_check_window=4, behavior_check_interval=2, motion_gate_enabled=True,
+                                    motion_gate_max_skip=4))
+    video_path = tmp_path / '2024-06-01T10_00_00.mp4'
+    write_video(video_path, 10)
+    replayer = VideoReplayer(config, StandInDetector([(20, 10, 140, 110)], name='roi'),
+                             StandInDetector([(30, 30, 50, 50), (60, 60, 80, 80)], name='ooi'))
+    assert replayer.replay(video_path, tmp_path / 'out') == 50
+    frames = read_table(tmp_path / 'out' / '2024-06-01T10_00_00_frames.csv')
+    detections = read_table(tmp_path / 'out' / '2024-06-01T10_00_00_detections.csv')
+    checks = read_table(tmp_path / 'out' / '2024-06-01T10_00_00_checks.csv')
+    # every other frame of the 10 fps video, on a clock derived from the frame index
+    assert [int(row['frame_index']) for row in frames] == list(range(1, 100, 2))
+    assert float(frames[0]['timestamp']) == datetime(2024, 6, 1, 10, 0, 0, 100000).timestamp()
+    assert all(row['occupancy'] == '2' and row['roi_xmin'] == '20' for row in frames)
+    # detections are only written for frames where OOI inference ran, not when they were reused
+    inferred = [row['frame_index'] for row in frames if row['ooi_inferred'] == '1']
+    assert 0 < len(inferred) < len(frames)
+    assert [row['frame_index'] for row in detections] == [index for index in inferred for _ in range(2)]
+    start = datetime(2024, 6, 1, 10).timestamp()
+    assert [float(row['timestamp']) - start for row in checks] == pytest.approx([4.1, 6.1, 8.1])
+    assert all(row['behavior'] == '1' for row in checks)
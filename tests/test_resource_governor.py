@@ -0,0 +1,71 @@
+import csv
+from datetime import datetime
+from types import SimpleNamespace
+
+from main import Runner
+from modules.resource_governor import ResourceGovernor, SystemSensors, write_sensor_files
+from modules.soak import run_soak
+
+
+def make_config(sensor_root, **overrides):
+    config = dict(framegrab_interval=0.2, resource_check_interval=10, resource_sensor_root=str(sensor_root),
+                  resource_temp_high=75, resource_temp_low=65, resource_load_high=1.0, resource_load_low=0.7,
+                  resource_memory_low=0.1, resource_memory_high=0.2, resource_adjust_interval=60,
+                  resource_recovery_time=300, resource_thumbnail_scale=8, resource_ooi_stride=2,
+                  resource_max_interval_factor=3)
+    config.update(overrides)
+    return SimpleNamespace(**config)
+
+
+def test_sensor_files_round_trip(tmp_path):
+    write_sensor_files(tmp_path, temperature=82, frequency=600000, max_frequency=1500000, load=3.0, memory=0.25)
+    readings = SystemSensors(tmp_path, cpu_count=4).read()
+    assert readings['temperature'] == 82
+    assert readings['frequency'] == 0.4
+    assert readings['load'] == 0.75
+    assert abs(readings['memory'] - 0.25) < 1e-6
+    assert SystemSensors(tmp_path / 'missing').read() == {'temperature': None, 'frequency': None, 'load': None,
+                                                          'memory': None}
+
+
+def test_ladder_steps_down_under_pressure_and_back_up_after_recovery(tmp_path):
+    sensor_root = tmp_path / 'sensors'
+    write_sensor_files(sensor_root, temperature=50, load=0.4)
+    now = [1000.0]
+    governor = ResourceGovernor(make_config(sensor_root), log_path=tmp_path / 'resource_log.csv',
+                                time_func=lambda: now[0])
+    governor.sensors.cpu_count = 1
+    ladder = governor.ladder
+    assert [step['framegrab_factor'] for step in ladder] == [1, 1, 1, 2, 3]
+
+    def run(seconds):
+        steps = []
+        for _ in range(int(seconds // 10)):
+            if governor.check() is not None:
+                steps.append(governor.step)
+            now[0] += 10
+        return steps
+
+    assert run(120) == []
+    write_sensor_files(sensor_root, temperature=82, load=0.8)
+    # at most one step down per resource_adjust_interval, until the bottom of the ladder
+    assert run(600) == [1, 2, 3, 4]
+    assert governor.settings == {'framegrab_factor': 3, 'ooi_stride': 2, 'thumbnail_scale': 8}
+    # warm, but not hot: neither pressure nor calm, so nothing changes
+    write_sensor_files(sensor_root, temperature=70, load=0.4)
+    assert run(900) == []
+    write_sensor_files(sensor_root, temperature=55, load=0.4)
+    assert run(1600) == [3, 2, 1, 0]
+    with open(tmp_path / 'resource_log.csv', newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [int(row['step']) for row in rows] == [1, 2, 3, 4, 3, 2, 1, 0]
+    assert rows[3]['framegrab_interval'] == '0.600' and rows[3]['temperature'] == '82.000'
+
+
+def test_soak_reads_its_own_sensor_files(tmp_path):
+    write_sensor_files(tmp_path / 'sim' / 'sensors', temperature=90)
+    report = run_soak(Runner, tmp_path / 'report.json', days=0.02,
+                      start=datetime(2024, 6, 1, 10), sim_dir=tmp_path / 'sim',
+                      config_overrides={'h_resolution': 320, 'v_resolution': 240, 'detection_log_enabled': False,
+                                        'cloud_data_dir': None, 'resource_adjust_interval': 60})
+    assert report['metrics']['gauges']['resource_step'] >= 3
@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+
+from modules.roi_tracker import RoiTracker
+
+BOX = (80, 60, 240, 180)
+START = datetime(2024, 6, 1, 10)
+
+
+def tank(shift=0, animal=False):
+    """RGB frame of a tank outline at BOX, moved right by shift pixels, optionally with an animal on its edge"""
+    img = np.full((240, 320, 3), 40, dtype=np.uint8)
+    cv2.rectangle(img, (BOX[0] + shift, BOX[1]), (BOX[2] + shift, BOX[3]), (0, 200, 0), 3)
+    if animal:
+        for x in range(BOX[0], BOX[2], 20):
+            cv2.circle(img, (x + 10, BOX[1]), 8, (200, 120, 40), -1)
+    return img
+
+
+def make_tracker(**kwargs):
+    tracker = RoiTracker(**dict({'max_age': 600, 'check_interval': 2, 'confirm_checks': 3}, **kwargs))
+    tracker.set_roi(BOX, tank(), START)
+    return tracker
+
+
+def test_roi_is_redetected_at_max_age():
+    tracker = RoiTracker(max_age=600)
+    assert tracker.needs_detection(START)
+    tracker.set_roi(BOX, tank(), START)
+    assert not tracker.needs_detection(START + timedelta(seconds=599))
+    assert tracker.needs_detection(START + timedelta(seconds=600))
+
+
+def test_still_roi_passes_every_check():
+    tracker = make_tracker()
+    assert all(tracker.validate(tank()) for _ in range(20))
+    assert not tracker.needs_detection(START + timedelta(seconds=1))
+
+
+def test_moved_roi_is_detected_after_confirm_checks():
+    tracker = make_tracker()
+    # frames 2, 4, and 6 are checked
+    results = [tracker.validate(tank(shift=15)) for _ in range(6)]
+    assert results == [True] * 5 + [False]
+    assert tracker.needs_detection(START + timedelta(seconds=1))
+
+
+def test_brief_occlusion_does_not_count_as_drift():
+    tracker = make_tracker()
+    assert all(tracker.validate(tank(animal=True)) for _ in range(4))
+    assert tracker.failed_checks == 2
+    assert all(tracker.validate(frame) for frame in [tank()] * 2 + [tank(animal=True)] * 4)
+    assert not tracker.drifted
+
+
+def test_roi_without_edges_is_not_checked():
+    tracker = RoiTracker(check_interval=1, confirm_checks=1)
+    tracker.set_roi(BOX, np.full((240, 320, 3), 40, dtype=np.uint8), START)
+    assert tracker.validate(tank(shift=15))
+
+
+def test_failed_detections_back_off():
+    tracker = RoiTracker(retry_initial=1, retry_max=5)
+    delays = []
+    for _ in range(5):
+        tracker.report_failure(START)
+        delays.append((tracker.next_attempt - START).total_seconds())
+    assert delays == [1, 2, 4, 5, 5]
+    assert not tracker.needs_detection(START + timedelta(seconds=4))
+    assert tracker.needs_detection(START + timedelta(seconds=5))
@@ -0,0 +1,85 @@
+import pytest
+
+from modules.scheduler import FrameScheduler
+
+
+class Clock:
+    """time that only moves when the scheduler sleeps or the test does work"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def make_scheduler(clock, interval=0.25, **kwargs):
+    scheduler = FrameScheduler(interval, time_func=clock.time, sleep_func=clock.sleep, **kwargs)
+    scheduler.start(0.0)
+    return scheduler
+
+
+def run(scheduler, clock, work_times):
+    ticks = []
+    for work_time in work_times:
+        clock.now += work_time
+        ticks.append(scheduler.wait())
+    return ticks
+
+
+def test_ticks_stay_on_the_grid():
+    clock = Clock()
+    scheduler = make_scheduler(clock)
+    ticks = run(scheduler, clock, [0.0625, 0.125, 0.1875] * 100)
+    assert ticks == [0.25 * n for n in range(1, 301)]
+    assert clock.now == 75
+    assert scheduler.stats()['skipped'] == 0 and scheduler.stats()['max_lateness'] == 0
+
+
+def test_skip_jumps_to_the_latest_passed_tick():
+    clock = Clock()
+    scheduler = make_scheduler(clock, policy='skip')
+    assert run(scheduler, clock, [0.0, 0.875, 0.0]) == [0.25, 1.0, 1.25]
+    assert scheduler.stats()['skipped'] == 2
+
+
+def test_catch_up_returns_every_missed_tick():
+    clock = Clock()
+    scheduler = make_scheduler(clock, policy='catch_up', max_backlog=10)
+    assert run(scheduler, clock, [0.0, 0.875, 0.0, 0.0, 0.0]) == [0.25, 0.5, 0.75, 1.0, 1.25]
+    assert scheduler.stats()['skipped'] == 0
+
+
+def test_catch_up_skips_a_backlog_over_max_backlog():
+    clock = Clock()
+    scheduler = make_scheduler(clock, policy='catch_up', max_backlog=3)
+    assert run(scheduler, clock, [0.0, 5.0]) == [0.25, 5.25]
+
+
+def test_adaptive_interval_follows_the_load():
+    clock = Clock()
+    scheduler = make_scheduler(clock, adaptive=True, adapt_window=10)
+    run(scheduler, clock, [0.375] * 40)
+    assert scheduler.interval == 0.5
+    ticks = run(scheduler, clock, [0.0625] * 40)
+    assert scheduler.interval == 0.25
+    # every tick stays on the base grid
+    assert all(tick % 0.25 == 0 for tick in ticks)
+    assert scheduler.stats()['interval_changes'] == 2
+
+
+def test_min_step_holds_the_interval_up():
+    clock = Clock()
+    scheduler = make_scheduler(clock)
+    scheduler.set_min_step(3)
+    assert run(scheduler, clock, [0.0, 0.0]) == [0.75, 1.5]
+    scheduler.set_min_step(1)
+    assert scheduler.interval == 0.25
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        FrameScheduler(0.25, policy='wait')
@@ -0,0 +1,47 @@
+from datetime import datetime
+
+import pytest
+
+from main import Runner
+from modules.clock import VirtualClock
+from modules.soak import run_soak
+
+START = datetime(2024, 6, 1, 18, 30)
+
+
+def test_virtual_clock_moves_only_when_asked():
+    advances, stops = [], []
+    clock = VirtualClock(START, stop_at=datetime(2024, 6, 1, 18, 31), on_stop=lambda: stops.append(clock.time()),
+                         on_advance=advances.append)
+    clock.advance(0)
+    clock.sleep(0)
+    assert clock.time() == START.timestamp() + 0.001
+    clock.sleep_until(datetime(2024, 6, 1, 18, 30, 30))
+    assert clock.now() == datetime(2024, 6, 1, 18, 30, 30)
+    # sleeps never pass stop_at, and on_stop is called once
+    clock.sleep(3600)
+    clock.sleep(3600)
+    assert clock.now() == datetime(2024, 6, 1, 18, 31)
+    assert stops == [clock.time()]
+    assert len(advances) == 4
+
+
+def test_soak_runs_active_into_passive_mode_without_leaks(tmp_path):
+    report = run_soak(Runner, tmp_path / 'report.json', days=0.5, start=START, sim_dir=tmp_path / 'sim',
+                      config_overrides={'h_resolution': 320, 'v_resolution': 240, 'detection_log_enabled': False,
+                                        'framegrab_interval': 1, 'behavior_check_window': 60,
+                                        'behavior_check_interval': 30},
+                      sample_interval=600)
+    summary = report['summary']
+    # active mode runs from 18:30 until end_hour at 19:00
+    assert summary['frames'] == report['metrics']['counters']['frames_captured'] == 1800
+    assert summary['simulated_days'] == pytest.approx(0.5)
+    assert report['samples'][-1]['virtual_time'] == '2024-06-02T06:30:00'
+    # the segment recorded in active mode is converted and uploaded in passive mode
+    assert list((tmp_path / 'sim' / 'cloud' / 'soak' / 'Videos').glob('*.mp4'))
+    assert not list((tmp_path / 'sim' / 'projects' / 'soak' / 'Videos').glob('*.mp4'))
+    leaks = summary['growth_since_first_day']
+    for key in ('open_files', 'threads', 'frames_checked_out', 'frame_pool_growth', 'queued_notifications',
+                'unconverted_videos'):
+        assert leaks[key] == 0, key
+    assert (tmp_path / 'report.json').exists()
@@ -0,0 +1,16 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+
+@pytest.mark.parametrize('module', ['main', 'modules.soak'])
+def test_slow_modules_are_not_imported_at_startup(module):
+    code = (f'import sys, {module}; '
+            'print(",".join(m for m in ("cv2", "pycoral", "tflite_runtime", "sendgrid") if m in sys.modules))')
+    result = subprocess.run([sys.executable, '-c', code], cwd=REPO_ROOT, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == ''
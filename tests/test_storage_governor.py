@@ -0,0 +1,132 @@
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+import pytest
+
+from modules.clock import VirtualClock
+from modules.soak import write_stand_in_tools
+from modules.storage_governor import StorageGovernor, segment_start
+from modules.upload_automation import Uploader
+
+DiskUsage = namedtuple('DiskUsage', 'total used free')
+START = datetime(2024, 6, 1, 10).timestamp()
+
+
+class FakeDisk:
+    """filesystem whose free space is set by the test, less the size of the files in video_dir"""
+
+    def __init__(self, video_dir, free):
+        self.video_dir, self.free = video_dir, free
+
+    def __call__(self, path):
+        used = sum(p.stat().st_size for p in self.video_dir.iterdir())
+        return DiskUsage(10 * self.free, used, self.free - used)
+
+
+def segment_name(offset, suffix='.mp4'):
+    return datetime.fromtimestamp(START + offset).isoformat(timespec='seconds').replace(':', '_') + suffix
+
+
+def make_governor(tmp_path, free, now, **kwargs):
+    video_dir = tmp_path / 'Videos'
+    video_dir.mkdir(exist_ok=True)
+    disk = FakeDisk(video_dir, free)
+    governor = StorageGovernor(video_dir, tmp_path / 'storage_events.json', reserve_mb=0, upload_hours=12,
+                               degrade_hours=6, evict_hours=1, check_interval=60, time_func=lambda: now[0],
+                               disk_usage=disk, **kwargs)
+    return governor, video_dir, disk
+
+
+def record(governor, video_dir, now, seconds, size):
+    """record one segment of the given length and size, opening it at now[0]"""
+    path = video_dir / segment_name(now[0] - START, '.h264')
+    governor.segment_opened(path)
+    path.write_bytes(bytes(size))
+    now[0] += seconds
+    return governor.segment_closed(path)
+
+
+def test_segment_start():
+    assert segment_start(segment_name(3600)) == START + 3600
+    assert segment_start('eventclip_1717236000.mp4') is None
+
+
+def test_levels_follow_the_predicted_hours_left(tmp_path):
+    now = [START]
+    governor, video_dir, disk = make_governor(tmp_path, 0, now)
+    assert governor.check() is None
+    # 1 MB per minute = 60 MB per hour
+    record(governor, video_dir, now, 60, 1000000)
+    for free_mb, level, quality in ((1000, 'ok', 'normal'), (500, 'upload', 'normal'), (300, 'degrade', 'low'),
+                                    (700, 'upload', 'low'), (800, 'ok', 'normal')):
+        disk.free = free_mb * 1000000 + 1000000
+        governor.next_check = 0
+        assert governor.check() == level
+        assert governor.quality == quality
+
+
+def test_low_quality_is_kept_until_the_normal_rate_is_known(tmp_path):
+    now = [START]
+    governor, video_dir, disk = make_governor(tmp_path, 0, now)
+    governor.quality = 'low'
+    record(governor, video_dir, now, 60, 1000000)
+    disk.free = 10000 * 1000000
+    assert governor.check() == 'ok'
+    assert governor.quality == 'low'
+
+
+def test_eviction_spares_events_and_prefers_uploaded_segments(tmp_path):
+    now = [START]
+    uploaded = set()
+    governor, video_dir, disk = make_governor(tmp_path, 0, now, is_uploaded=lambda p: p.name in uploaded)
+    for i in range(5):
+        (video_dir / segment_name(i * 600)).write_bytes(bytes(1000000))
+    (video_dir / 'eventclip_1717236000.mp4').write_bytes(bytes(1000000))
+    uploaded.add(segment_name(2400))
+    governor.mark_event(START + 700, START + 800)
+    governor.segment_opened(video_dir / segment_name(3000, '.h264'))
+    (video_dir / segment_name(3000, '.h264')).write_bytes(bytes(1000000))
+    disk.free = 7000000
+    # free space is 0 with every file present; ask for room for two segments
+    assert governor.evict(2000000) == 2
+    remaining = sorted(p.name for p in video_dir.iterdir())
+    assert segment_name(2400) not in remaining and segment_name(0) not in remaining
+    assert segment_name(600) in remaining and 'eventclip_1717236000.mp4' in remaining
+    assert segment_name(3000, '.h264') in remaining
+    # events survive a restart
+    restarted, _, _ = make_governor(tmp_path, 0, now)
+    assert restarted.events == [(START + 700, START + 800)]
+
+
+def test_expedite_runs_off_the_calling_thread(tmp_path):
+    bin_dir = write_stand_in_tools(tmp_path / 'bin')
+    project_dir = tmp_path / 'project'
+    (project_dir / 'Videos').mkdir(parents=True)
+    (project_dir / 'Videos' / segment_name(0)).write_bytes(bytes(1000))
+    uploader = Uploader(project_dir, str(tmp_path / 'cloud'), rclone=str(bin_dir / 'rclone'))
+    threads = []
+    needs_upload = uploader.upload_engine.needs_upload
+
+    def recording_needs_upload(path):
+        threads.append(threading.current_thread())
+        return needs_upload(path)
+    uploader.upload_engine.needs_upload = recording_needs_upload
+    assert uploader.expedite()
+    uploader.stop_trickle()
+    uploader.converter.shutdown()
+    assert threads and threading.current_thread() not in threads
+    assert (tmp_path / 'cloud' / 'project' / 'Videos' / segment_name(0)).exists()
+
+
+def test_runner_expedites_uploads_only_when_the_level_changes(make_runner):
+    clock = VirtualClock(datetime(2024, 6, 1, 10))
+    runner = make_runner(clock)
+    runner.collector.start_recording()
+    levels = iter(['upload', None, 'upload', 'degrade', 'degrade', 'ok', 'upload'])
+    runner.storage_governor.check = lambda: next(levels)
+    calls = []
+    runner.uploader.expedite = lambda: calls.append(runner.storage_governor.check)
+    for _ in range(7):
+        runner.govern_storage()
+    assert len(calls) == 3
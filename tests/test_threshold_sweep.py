@@ -0,0 +1,97 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+
+from modules.behavior_recognition import BehaviorRecognizer
+from modules.email_notification import Notification, Notifier
+from modules.threshold_sweep import check_indices, split_days, sweep_thresholds
+
+FRAMEGRAB_INTERVAL = 1.0
+MIN_NOTIFICATION_INTERVAL = 120
+MAX_NOTIFICATIONS_PER_DAY = 3
+
+
+class RecordingTransport:
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, notification, from_email, to_email):
+        self.sent.append(notification)
+
+
+def make_series(seed=0):
+    """two days of jittered frames with bursts of activity and a capture gap that leaves some buffers short"""
+    rng = np.random.default_rng(seed)
+    timestamps, occupancies = [], []
+    for day in (datetime(2024, 6, 1, 8), datetime(2024, 6, 2, 8)):
+        t = np.arange(0, 1800, FRAMEGRAB_INTERVAL) + rng.uniform(0, 0.3, 1800)
+        t = t[(t < 700) | (t > 850)]
+        occupancy = rng.integers(0, 2, len(t))
+        occupancy[(t % 400) < 150] = rng.integers(2, 6, np.count_nonzero((t % 400) < 150))
+        timestamps.append(day.timestamp() + t)
+        occupancies.append(occupancy)
+    return np.concatenate(timestamps), np.concatenate(occupancies).astype(np.int32)
+
+
+def replay(timestamps, occupancies, window, interval, min_individuals, max_individuals, min_fraction):
+    """run the series through a real BehaviorRecognizer and Notifier the way the active mode runner does"""
+    config = SimpleNamespace(behavior_check_window=window, behavior_min_individuals_roi=min_individuals,
+                             behavior_max_individuals_roi=max_individuals,
+                             behavior_min_fraction_for_notification=min_fraction, clip_window=None,
+                             framegrab_interval=FRAMEGRAB_INTERVAL, thumbnail_format='raw', thumbnail_jpeg_quality=90)
+    now = [0.0]
+    transport = RecordingTransport()
+    notifier = Notifier('user@example.com', 'rba@example.com', None, None, MIN_NOTIFICATION_INTERVAL,
+                        MAX_NOTIFICATIONS_PER_DAY, transport=transport, time_func=lambda: now[0])
+    n_checks, n_positive, notifications = 0, 0, []
+    for start, stop in split_days(timestamps):
+        recognizer = BehaviorRecognizer(config)
+        notifier.reset()
+        next_check = timestamps[start] + window
+        for ts, occupancy in zip(timestamps[start:stop], occupancies[start:stop]):
+            now[0] = ts
+            recognizer.append_data(ts, occupancy)
+            if ts >= next_check:
+                if len(recognizer) >= (window / FRAMEGRAB_INTERVAL) // 2:
+                    n_checks += 1
+                    if recognizer.check_for_behavior():
+                        n_positive += 1
+                        if notifier.check_conditions():
+                            notifier.notify(Notification('possible behavioral event', ''))
+                            notifications.append(ts)
+                next_check = ts + interval
+    assert len(transport.sent) == len(notifications)
+    return n_checks, n_positive, notifications
+
+
+def test_sweep_matches_replay():
+    timestamps, occupancies = make_series()
+    grid = {'behavior_check_window': [60, 300], 'behavior_check_interval': [7, 30],
+            'behavior_min_individuals_roi': [0, 2], 'behavior_max_individuals_roi': [1, 10],
+            'behavior_min_fraction_for_notification': [0.3, 0.6]}
+    results = sweep_thresholds(timestamps, occupancies, grid, FRAMEGRAB_INTERVAL, MIN_NOTIFICATION_INTERVAL,
+                               MAX_NOTIFICATIONS_PER_DAY)
+    assert len(results) == 2 * 2 * 3 * 2
+    short_buffers = False
+    for row in results:
+        n_checks, n_positive, notifications = replay(
+            timestamps, occupancies, row['behavior_check_window'], row['behavior_check_interval'],
+            row['behavior_min_individuals_roi'], row['behavior_max_individuals_roi'],
+            row['behavior_min_fraction_for_notification'])
+        assert row['n_checks'] == n_checks
+        assert row['n_positive_checks'] == n_positive
+        np.testing.assert_array_equal(row['notification_timestamps'], notifications)
+        all_checks = sum(len(check_indices(timestamps[a:b], row['behavior_check_window'],
+                                           row['behavior_check_interval'])) for a, b in split_days(timestamps))
+        short_buffers |= n_checks < all_checks
+    # the capture gap makes some buffers fall below the minimum viable length
+    assert short_buffers
+
+
+def test_check_indices_follow_the_frame_that_ran_each_check():
+    timestamps = np.array([0.0, 4.0, 10.5, 11.0, 16.0, 21.0, 22.0])
+    # due at 10, runs at 10.5; next due at 15.5, runs at 16; next due at 21.5, runs at 22
+    np.testing.assert_array_equal(check_indices(timestamps, 10, 5.5), [2, 4, 6])
+    assert len(check_indices(timestamps, 30, 5)) == 0
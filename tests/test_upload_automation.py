@@ -0,0 +1,185 @@
+import json
+import os
+import stat
+
+import pytest
+
+from modules import upload_automation
+from modules.soak import write_stand_in_tools
+from modules.upload_automation import ConversionManifest, UploadEngine, VideoConverter
+
+FAILING_RCLONE = '#!/bin/sh\necho "stand-in transfer failure" >&2\nexit 1\n'
+FAILING_FFMPEG = '#!/bin/sh\necho "stand-in conversion failure" >&2\nexit 1\n'
+
+
+@pytest.fixture
+def project(tmp_path):
+    project_dir = tmp_path / 'project'
+    (project_dir / 'Videos').mkdir(parents=True)
+    (project_dir / 'Videos' / 'segment.mp4').write_bytes(b'v' * 1000)
+    (project_dir / 'config.yaml').write_text('framerate: 30\n')
+    return project_dir
+
+
+def make_engine(project_dir, rclone, **kwargs):
+    return UploadEngine(project_dir, str(project_dir.parent / 'cloud' / 'project'),
+                        project_dir / 'upload_manifest.json', rclone=str(rclone), **kwargs)
+
+
+def count_hashes(monkeypatch):
+    calls = []
+    original = upload_automation.file_sha1
+
+    def counting_sha1(path):
+        calls.append(path.name)
+        return original(path)
+    monkeypatch.setattr(upload_automation, 'file_sha1', counting_sha1)
+    return calls
+
+
+def test_sync_moves_videos_copies_other_files_and_skips_unchanged(tmp_path, project, monkeypatch):
+    rclone = write_stand_in_tools(tmp_path / 'bin') / 'rclone'
+    hashes = count_hashes(monkeypatch)
+    engine = make_engine(project, rclone)
+    assert engine.sync() == (2, 0)
+    cloud = tmp_path / 'cloud' / 'project'
+    assert (cloud / 'Videos' / 'segment.mp4').read_bytes() == b'v' * 1000
+    assert not (project / 'Videos' / 'segment.mp4').exists()
+    assert (cloud / 'config.yaml').exists() and (project / 'config.yaml').exists()
+    # new files are uploaded without being hashed
+    assert hashes == []
+    assert engine.sync() == (0, 0)
+
+    manifest = json.loads((project / 'upload_manifest.json').read_text())
+    assert manifest['config.yaml']['remote'] == 'uploaded'
+
+
+def test_excluded_files_and_directories_are_not_uploaded(tmp_path, project):
+    rclone = write_stand_in_tools(tmp_path / 'bin') / 'rclone'
+    (project / 'NotificationQueue' / 'failed').mkdir(parents=True)
+    (project / 'NotificationQueue' / '1.json').write_text('{"to_email": "user@example.com"}')
+    (project / 'NotificationQueue' / 'failed' / '2.json').write_text('{"to_email": "user@example.com"}')
+    (project / 'checkpoint.npz').write_bytes(b'c')
+    engine = make_engine(project, rclone, exclude=('NotificationQueue', 'checkpoint.npz'))
+    assert engine.sync() == (2, 0)
+    cloud = tmp_path / 'cloud' / 'project'
+    assert not (cloud / 'NotificationQueue').exists() and not (cloud / 'checkpoint.npz').exists()
+
+
+def test_changed_files_are_hashed_once(tmp_path, project, monkeypatch):
+    rclone = write_stand_in_tools(tmp_path / 'bin') / 'rclone'
+    engine = make_engine(project, rclone)
+    engine.sync()
+    hashes = count_hashes(monkeypatch)
+    config_path = project / 'config.yaml'
+    # same size, new contents: hashed by the scan, and the hash is reused for the manifest
+    config_path.write_text('framerate: 15\n')
+    os.utime(config_path, (1e9, 1e9))
+    assert engine.sync() == (1, 0)
+    assert hashes == ['config.yaml']
+    assert (tmp_path / 'cloud' / 'project' / 'config.yaml').read_text() == 'framerate: 15\n'
+    # touched but unchanged: hashed, matched, and not uploaded again
+    os.utime(config_path, (2e9, 2e9))
+    assert engine.sync() == (0, 0)
+    assert hashes == ['config.yaml', 'config.yaml']
+
+
+def test_failed_uploads_back_off_and_are_marked_failed(tmp_path, project):
+    rclone = tmp_path / 'rclone'
+    rclone.write_text(FAILING_RCLONE)
+    rclone.chmod(rclone.stat().st_mode | stat.S_IXUSR)
+    sleeps = []
+    engine = make_engine(project, rclone, max_attempts=4, backoff_initial=5, backoff_max=12, workers=1,
+                         sleep_func=sleeps.append)
+    assert engine.upload_file(project / 'config.yaml') is False
+    assert sleeps == [5, 10, 12]
+    assert engine.manifest.get('config.yaml')['remote'] == 'failed'
+    assert engine.needs_upload(project / 'config.yaml')
+
+
+def test_uploads_are_timestamped_by_the_given_clock(tmp_path, project):
+    rclone = write_stand_in_tools(tmp_path / 'bin') / 'rclone'
+    engine = make_engine(project, rclone, time_func=lambda: 1717228800.0)
+    assert engine.upload_file(project / 'config.yaml')
+    assert engine.manifest.get('config.yaml')['uploaded_at'] == 1717228800.0
+
+
+def test_trickle_uploads_in_the_background(tmp_path, project):
+    rclone = write_stand_in_tools(tmp_path / 'bin') / 'rclone'
+    engine = make_engine(project, rclone)
+    engine.trickle(project / 'Videos' / 'segment.mp4')
+    assert not engine.trickled
+    engine.start_trickle(100)
+    engine.trickle(project / 'Videos' / 'segment.mp4')
+    engine.stop_trickle()
+    assert (tmp_path / 'cloud' / 'project' / 'Videos' / 'segment.mp4').exists()
+
+
+def test_trickle_errors_are_logged_and_the_file_can_be_queued_again(tmp_path, project, monkeypatch, caplog):
+    rclone = write_stand_in_tools(tmp_path / 'bin') / 'rclone'
+    engine = make_engine(project, rclone)
+
+    def broken_upload(path, bwlimit_kbps=None):
+        raise OSError('disk error')
+    monkeypatch.setattr(engine, 'upload_file', broken_upload)
+    engine.start_trickle(100)
+    path = project / 'Videos' / 'segment.mp4'
+    engine.trickle(path)
+    engine.trickle_executor.submit(lambda: None).result()
+    assert path not in engine.trickled
+    assert 'disk error' in caplog.text
+    monkeypatch.undo()
+    engine.trickle(path)
+    engine.stop_trickle()
+    assert not path.exists()
+
+
+@pytest.fixture
+def stand_in_path(tmp_path, monkeypatch):
+    """put the stand-in ffmpeg first on PATH. :return: its directory"""
+    bin_dir = write_stand_in_tools(tmp_path / 'bin')
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    return bin_dir
+
+
+def test_converter_converts_in_the_background(tmp_path, project, stand_in_path):
+    h264_path = project / 'Videos' / '2024-06-01T10_00_00.h264'
+    h264_path.write_bytes(b'h' * 1000)
+    converted = []
+    converter = VideoConverter(project / 'Videos', project / 'conversion_manifest.json', on_converted=converted.append)
+    assert converter.submit(h264_path).result(timeout=30) is True
+    converter.shutdown()
+    assert not h264_path.exists()
+    assert converted == [h264_path.with_suffix('.mp4')]
+    assert ConversionManifest(project / 'conversion_manifest.json').get(h264_path.name)['status'] == 'converted'
+
+
+def test_failed_conversions_are_retried_then_given_up(tmp_path, project, stand_in_path):
+    (stand_in_path / 'ffmpeg').write_text(FAILING_FFMPEG)
+    h264_path = project / 'Videos' / '2024-06-01T10_00_00.h264'
+    h264_path.write_bytes(b'h' * 1000)
+    converter = VideoConverter(project / 'Videos', project / 'conversion_manifest.json', max_attempts=2)
+    results = [converter.submit(h264_path).result(timeout=30) for _ in range(3)]
+    converter.shutdown()
+    assert results == [False] * 3
+    assert converter.manifest.get(h264_path.name) == {'status': 'failed', 'attempts': 2}
+    assert h264_path.exists() and not h264_path.with_suffix('.mp4').exists()
+
+
+def test_conversions_interrupted_by_a_crash_resume(tmp_path, project, stand_in_path):
+    video_dir = project / 'Videos'
+    for name in ('a.h264', 'b.h264', 'c.h264'):
+        (video_dir / name).write_bytes(b'h' * 1000)
+    # c was converted, but the crash came before its h264 was deleted
+    (video_dir / 'c.mp4').write_bytes(b'converted')
+    (project / 'conversion_manifest.json').write_text(json.dumps({
+        'a.h264': {'status': 'converting', 'attempts': 1}, 'b.h264': {'status': 'pending', 'attempts': 0},
+        'c.h264': {'status': 'converted', 'attempts': 1}, 'gone.h264': {'status': 'pending', 'attempts': 0}}))
+    converter = VideoConverter(video_dir, project / 'conversion_manifest.json')
+    converter.resume()
+    converter.convert(video_dir / 'c.h264')
+    converter.shutdown()
+    assert sorted(p.name for p in video_dir.iterdir()) == ['a.mp4', 'b.mp4', 'c.mp4', 'segment.mp4']
+    assert (video_dir / 'c.mp4').read_bytes() == b'converted'
+    converter.manifest.prune(video_dir)
+    assert sorted(converter.manifest.entries) == ['a.h264', 'b.h264', 'c.h264']
@@ -0,0 +1,11 @@
+import json
+
+from modules.utils import write_json_atomic
+
+
+def test_write_json_atomic_replaces_file(tmp_path):
+    path = tmp_path / 'state.json'
+    write_json_atomic(path, {'a': 1})
+    write_json_atomic(path, {'a': 2, 'b': [1, 2]})
+    assert json.loads(path.read_text()) == {'a': 2, 'b': [1, 2]}
+    assert [p.name for p in tmp_path.iterdir()] == ['state.json']
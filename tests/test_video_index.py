@@ -0,0 +1,126 @@
+import json
+import stat
+import sys
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from modules import video_index
+from modules.video_index import ClipExtractor, IndexedOutput, find_segments, index_path, read_index
+
+START = datetime(2024, 6, 1, 10).timestamp()
+
+# copies its input to its output (concatenating the pieces listed by a concat input), and logs its arguments
+STAND_IN_FFMPEG = '''#!{python}
+import json, os, sys
+args = sys.argv[1:]
+with open(os.path.join(os.path.dirname(sys.argv[0]), 'calls.jsonl'), 'a') as log:
+    log.write(json.dumps(args) + '\\n')
+source = args[args.index('-i') + 1]
+if '-f' in args:
+    names = [line[len("file '"):-1] for line in open(source).read().splitlines()]
+    data = b''.join(open(os.path.join(os.path.dirname(source), name), 'rb').read() for name in names)
+else:
+    data = open(source, 'rb').read()
+open(args[-1], 'wb').write(data)
+'''
+
+
+class FakeCamera:
+    """stands in for the PiCamera whose frame attribute describes the data being written"""
+
+    def __init__(self):
+        self.frame = None
+
+
+def write_segment(video_dir, offset, keyframes, suffix='.h264'):
+    """
+    write a segment starting offset seconds after START with a keyframe every 2 seconds, 10 bytes per frame at 5 fps
+    :return: path of the video
+    """
+    name = datetime.fromtimestamp(START + offset).isoformat(timespec='seconds').replace(':', '_')
+    video_path = video_dir / (name + suffix)
+    video_path.write_bytes(bytes(range(100)) * keyframes)
+    index_path(video_path).write_text('time,frame,offset\n' + ''.join(
+        f'{START + offset + 2 * k:.6f},{10 * k},{100 * k}\n' for k in range(keyframes)))
+    return video_path
+
+
+@pytest.fixture
+def stand_in_ffmpeg(tmp_path):
+    path = tmp_path / 'bin' / 'ffmpeg'
+    path.parent.mkdir()
+    path.write_text(STAND_IN_FFMPEG.format(python=sys.executable))
+    path.chmod(path.stat().st_mode | stat.S_IXUSR)
+    return path
+
+
+def ffmpeg_calls(ffmpeg):
+    return [json.loads(line) for line in (ffmpeg.parent / 'calls.jsonl').read_text().splitlines()]
+
+
+def test_output_indexes_each_sps_header(tmp_path, monkeypatch):
+    monkeypatch.setattr(video_index, 'picamera', SimpleNamespace(PiVideoFrameType=SimpleNamespace(
+        frame='frame', key_frame='key_frame', sps_header='sps_header')))
+    camera, now = FakeCamera(), [START]
+    output = IndexedOutput(tmp_path / 'segment.h264', camera, time_func=lambda: now[0])
+    writes = [(0, 'sps_header', 8), (0, 'key_frame', 50), (0, 'key_frame', 50), (1, 'frame', 20), (2, 'frame', 20),
+              (2, 'sps_header', 8), (3, 'key_frame', 60)]
+    for index, frame_type, size in writes:
+        camera.frame = SimpleNamespace(index=index, frame_type=frame_type)
+        output.write(b'x' * size)
+        now[0] += 0.1
+    output.close()
+    rows = read_index(index_path(tmp_path / 'segment.h264'))
+    assert rows['frame'].tolist() == [0, 3]
+    assert rows['offset'].tolist() == [0, 148]
+    assert rows['time'].tolist() == pytest.approx([START, START + 0.5])
+    assert (tmp_path / 'segment.h264').stat().st_size == 216
+
+
+def test_find_segments_returns_overlapping_segments_in_order(tmp_path):
+    first = write_segment(tmp_path, 0, 30)
+    second = write_segment(tmp_path, 60, 30, suffix='.mp4')
+    # an index whose video was deleted is skipped
+    index_path(tmp_path / '2024-06-01T09_00_00.h264').write_text('time,frame,offset\n1,0,0\n')
+    assert [p for p, _ in find_segments(tmp_path, START + 10, START + 20)] == [first]
+    assert [p for p, _ in find_segments(tmp_path, START + 50, START + 70)] == [first, second]
+    assert [p for p, _ in find_segments(tmp_path, START + 500, START + 600)] == [second]
+    assert find_segments(tmp_path, START - 100, START - 50) == []
+
+
+def test_cut_points():
+    rows = np.array([(START + t, 10 * i, 100 * i) for i, t in enumerate([0, 2, 4, 6])],
+                    dtype=[('time', np.float64), ('frame', np.int64), ('offset', np.int64)])
+    assert ClipExtractor.cut_points(rows, START + 2.5, START + 3) == (1, 2)
+    assert ClipExtractor.cut_points(rows, START + 2, START + 4) == (1, 3)
+    assert ClipExtractor.cut_points(rows, START - 5, START + 7) == (0, None)
+
+
+def test_h264_clips_are_cut_at_keyframe_offsets(tmp_path, stand_in_ffmpeg):
+    video_path = write_segment(tmp_path, 0, 30)
+    extractor = ClipExtractor(tmp_path, framerate=5, ffmpeg=str(stand_in_ffmpeg))
+    assert extractor.extract(START + 5, START + 9, tmp_path / 'clips' / 'clip.mp4') == tmp_path / 'clips' / 'clip.mp4'
+    # keyframes at 4 and 10 seconds bound the clip
+    assert (tmp_path / 'clips' / 'clip.mp4').read_bytes() == video_path.read_bytes()[200:500]
+    assert [p.name for p in (tmp_path / 'clips').iterdir()] == ['clip.mp4']
+
+
+def test_clips_spanning_segments_are_concatenated(tmp_path, stand_in_ffmpeg):
+    first = write_segment(tmp_path, 0, 30)
+    second = write_segment(tmp_path, 60, 30, suffix='.mp4')
+    extractor = ClipExtractor(tmp_path, framerate=5, ffmpeg=str(stand_in_ffmpeg))
+    extractor.extract(START + 55, START + 63, tmp_path / 'clip.mp4')
+    mp4_call = next(args for args in ffmpeg_calls(stand_in_ffmpeg) if str(second) in args)
+    # the mp4 piece seeks to half a frame past its first keyframe and copies up to the keyframe after the end
+    assert mp4_call[mp4_call.index('-ss') + 1] == '0.100000'
+    assert mp4_call[mp4_call.index('-frames:v') + 1] == '20'
+    assert (tmp_path / 'clip.mp4').read_bytes() == first.read_bytes()[2700:] + second.read_bytes()
+
+
+def test_ranges_without_video(tmp_path, stand_in_ffmpeg):
+    write_segment(tmp_path, 0, 30)
+    extractor = ClipExtractor(tmp_path, ffmpeg=str(stand_in_ffmpeg))
+    assert extractor.extract(START - 100, START - 50, tmp_path / 'clip.mp4') is None